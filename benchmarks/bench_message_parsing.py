@@ -0,0 +1,79 @@
+"""
+Compares the baseline ingestion path (a full json.loads of every chess information frame) with MessageParser, which
+peeks at the event name, selectively decodes `pgn` frames and skips duplicate positions.
+
+Usage: python benchmarks/bench_message_parsing.py [--dump-file data/example_data_dump.txt] [--repeat 200]
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+ROOT_PATH = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_PATH / "src"))
+
+from services.message_parser import MessageParser, json_loads  # noqa: E402
+
+
+def baseline_ingestion(messages: list[str]) -> int:
+    handled_count = 0
+    for message in messages:
+        payload = json.loads(message[2:])
+        if payload[0] == "pgn":
+            game_data = payload[1]
+            _ = (game_data["Headers"]["White"], game_data["Headers"]["Black"], game_data["Moves"][-1]["fen"])
+            handled_count += 1
+        if payload[0] == "liveeval":
+            _ = (payload[1]["engine"], payload[1]["eval"], payload[1]["pv"])
+            handled_count += 1
+    return handled_count
+
+
+def selective_ingestion(messages: list[str]) -> int:
+    handled_count = 0
+    message_parser = MessageParser()
+    for message in messages:
+        event_name = message_parser.peek_event_name(message)
+        if event_name == "pgn":
+            game_data = message_parser.parse_game_data(message)
+            if game_data:
+                _ = (game_data["Headers"]["White"], game_data["Headers"]["Black"], game_data["Moves"][-1]["fen"])
+                handled_count += 1
+        if event_name == "liveeval":
+            live_eval_data = message_parser.parse_live_eval_data(message)
+            _ = (live_eval_data["engine"], live_eval_data["eval"], live_eval_data["pv"])
+            handled_count += 1
+    return handled_count
+
+
+def time_function(function, messages: list[str], repeat: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        function(messages)
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dump-file", type=Path, default=ROOT_PATH / "data" / "example_data_dump.txt")
+    parser.add_argument("--repeat", type=int, default=200)
+    arguments = parser.parse_args()
+
+    with open(arguments.dump_file, "r") as file:
+        messages = [line.rstrip("\n") for line in file if line.startswith("42")]
+    total_bytes = sum(len(message) for message in messages)
+
+    print(f"{len(messages)} chess information frames, {total_bytes / 1024:.0f} KiB, repeated {arguments.repeat} times")
+    print(f"JSON backend: {json_loads.__module__}")
+    results = {}
+    for name, function in (("baseline", baseline_ingestion), ("selective", selective_ingestion)):
+        elapsed_seconds = time_function(function=function, messages=messages, repeat=arguments.repeat)
+        results[name] = elapsed_seconds
+        per_frame_microseconds = elapsed_seconds / (len(messages) * arguments.repeat) * 1e6
+        print(f"{name:>10}: {elapsed_seconds:.3f} s total, {per_frame_microseconds:.1f} us/frame")
+    print(f"speedup: {results['baseline'] / results['selective']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
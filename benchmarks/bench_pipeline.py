@@ -0,0 +1,283 @@
+"""
+Replays a dump through SocketConnector._handle_message fully offline: the LLM is a fake backend, speech synthesis
+returns silence and the audio goes to a null sink, each with a configurable latency. Measures the hot paths of the
+ingestion on their own (message type dispatch, JSON handling of the chess information frames, board updates of the
+position tracker), then the end-to-end throughput of the whole pipeline and its peak memory. The end-to-end runs can be
+profiled with cProfile or tracemalloc, over all the threads of the pipeline.
+
+Usage: python benchmarks/bench_pipeline.py [--dump-file data/example_data_dump.txt] [--repeat 200] [--runs 3]
+       [--llm-latency 0.2] [--tts-real-time-factor 0.05] [--audio-latency 0] [--message-interval 0] [--silent]
+       [--profile cprofile|tracemalloc] [--profile-output pipeline.prof]
+"""
+import argparse
+import cProfile
+import os
+import pstats
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+
+ROOT_PATH = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_PATH / "src"))
+# Required by the settings, never used offline
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("VOICE_MODEL_FILE_LOCATION", "unused")
+
+from conf.settings import settings  # noqa: E402
+from entities.entities import PlayedMove  # noqa: E402
+from services.audio_player import AudioPlayer  # noqa: E402
+from services.audio_sinks import NullAudioSink  # noqa: E402
+from services.commentary_scheduler import CommentaryScheduler  # noqa: E402
+from services.llm_backend import FakeLLMBackend  # noqa: E402
+from services.message_parser import MessageParser  # noqa: E402
+from services.position_tracker import PositionTracker  # noqa: E402
+from services.replay import DumpReplayer  # noqa: E402
+from services.session_manager import SessionManager, SharedResources  # noqa: E402
+from services.socket_connection import SocketConnector  # noqa: E402
+from services.speech_synthesizer import FakeSpeechSynthesizer  # noqa: E402
+
+PROFILE_TOP_COUNT = 30
+
+
+@dataclass
+class PipelineRun:
+    elapsed_seconds: float
+    llm_call_count: int
+    coalesced_count: int
+    audio_seconds: float
+
+
+def time_function(function, repeat: int) -> float:
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return time.perf_counter() - start_time
+
+
+def dispatch_messages(messages: list[str]) -> None:
+    for message in messages:
+        SocketConnector._get_message_type(message)
+
+
+def parse_messages(messages: list[str]) -> None:
+    # A new parser every time, since it skips the frames it has already seen
+    message_parser = MessageParser()
+    for message in messages:
+        event_name = message_parser.peek_event_name(message)
+        if event_name == "pgn":
+            message_parser.parse_game_data(message)
+        elif event_name in ("liveeval", "liveeval1"):
+            message_parser.parse_live_eval_data(message)
+
+
+def update_boards(frames: list[tuple[str, tuple[PlayedMove, ...]]]) -> None:
+    position_trackers: dict[str, PositionTracker] = {}
+    for game_key, moves in frames:
+        position_tracker = position_trackers.setdefault(game_key, PositionTracker())
+        position_tracker.update(fen_position=moves[-1].fen_position, last_move=moves[-1].san, moves=moves)
+
+
+def get_game_frames(messages: list[str]) -> list[tuple[str, tuple[PlayedMove, ...]]]:
+    """
+    :return: Game and moves of every `pgn` frame, as passed to the position tracker of the commentator
+    """
+    message_parser = MessageParser()
+    frames = []
+    for message in messages:
+        if message_parser.peek_event_name(message) != "pgn":
+            continue
+        game_data = message_parser.parse_game_data(message)
+        if game_data and game_data.get("Moves"):
+            moves = tuple(
+                PlayedMove(san=move_data["m"], fen_position=move_data["fen"]) for move_data in game_data["Moves"]
+            )
+            frames.append((str(game_data["Headers"]["Round"]), moves))
+    return frames
+
+
+def create_shared_resources(
+    llm_latency_seconds: float, tts_real_time_factor: float, audio_latency_seconds: float
+) -> SharedResources:
+    """
+    Creates shared resources that run offline: a fake LLM backend and, unless in SILENT_MODE, a fake speech synthesizer
+    playing on a null audio sink
+    """
+    llm_backend = FakeLLMBackend(
+        latency_seconds=llm_latency_seconds,
+        deadline_seconds=settings.LLM_CALL_DEADLINE_SECONDS,
+        max_retries=settings.LLM_MAX_RETRIES,
+        retry_base_delay_seconds=settings.LLM_RETRY_BASE_DELAY_SECONDS,
+        hedge_percentile=settings.LLM_HEDGE_PERCENTILE,
+        max_concurrent_requests=settings.HTTP_MAX_CONNECTIONS,
+    )
+    if settings.SILENT_MODE:
+        return SharedResources(
+            llm_backend=llm_backend,
+            commentary_scheduler=CommentaryScheduler(max_staleness_seconds=settings.COMMENTARY_MAX_STALENESS_SECONDS),
+        )
+    speech_synthesizer = FakeSpeechSynthesizer(real_time_factor=tts_real_time_factor)
+    audio_player = AudioPlayer(
+        sample_rate=speech_synthesizer.sample_rate,
+        sinks=[NullAudioSink(sample_rate=speech_synthesizer.sample_rate, write_latency_seconds=audio_latency_seconds)],
+    )
+    return SharedResources(
+        llm_backend=llm_backend,
+        commentary_scheduler=CommentaryScheduler(
+            max_staleness_seconds=settings.COMMENTARY_MAX_STALENESS_SECONDS, audio_player=audio_player
+        ),
+        speech_synthesizer=speech_synthesizer,
+        audio_player=audio_player,
+    )
+
+
+def run_pipeline(records: list[str], message_interval_seconds: float, **resource_parameters) -> PipelineRun:
+    """
+    Replays all the records through a new connector and session manager, until every commentary has been vocalized
+    """
+    shared_resources = create_shared_resources(**resource_parameters)
+    session_manager = SessionManager(shared_resources=shared_resources)
+    socket_connector = SocketConnector(session_manager=session_manager)
+    session_manager.start()
+    start_time = time.perf_counter()
+    for message in records:
+        socket_connector._handle_message(message)
+        if message_interval_seconds:
+            time.sleep(message_interval_seconds)
+    session_manager.wait_until_idle()
+    if shared_resources.audio_player:
+        shared_resources.audio_player.flush()
+    elapsed_seconds = time.perf_counter() - start_time
+
+    audio_seconds = 0.0
+    if shared_resources.audio_player:
+        audio_seconds = sum(sink.written_samples for sink in shared_resources.audio_player.sinks) / (
+            shared_resources.audio_player.sample_rate
+        )
+    coalesced_count = session_manager.coalesced_count
+    session_manager.stop()
+    return PipelineRun(
+        elapsed_seconds=elapsed_seconds,
+        llm_call_count=shared_resources.llm_backend.call_count,
+        coalesced_count=coalesced_count,
+        audio_seconds=audio_seconds,
+    )
+
+
+def run_cprofile(function, output_path: Path | None):
+    """
+    Runs a function under cProfile, including the threads it starts, and prints the functions taking the most time
+    """
+    profilers = [cProfile.Profile()]
+    if sys.version_info < (3, 12):
+        # Before 3.12 a profiler only sees the thread that enabled it, so every thread started meanwhile gets its own
+        def profile_thread(*_) -> None:
+            profiler = cProfile.Profile()
+            profilers.append(profiler)
+            profiler.enable()
+
+        threading.setprofile(profile_thread)
+    profilers[0].enable()
+    try:
+        result = function()
+    finally:
+        profilers[0].disable()
+        threading.setprofile(None)
+    stats = pstats.Stats(*profilers)
+    stats.sort_stats("tottime").print_stats(PROFILE_TOP_COUNT)
+    if output_path:
+        stats.dump_stats(output_path)
+        print(f"cProfile stats written to {output_path}")
+    return result
+
+
+def run_tracemalloc(function, output_path: Path | None):
+    """
+    Runs a function while tracing allocations, and prints its peak traced memory and the largest allocations left
+    """
+    tracemalloc.start()
+    try:
+        result = function()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    print(f"peak traced memory: {peak_bytes / 1024 ** 2:.1f} MiB")
+    for statistic in snapshot.statistics("lineno")[:PROFILE_TOP_COUNT]:
+        print(statistic)
+    if output_path:
+        snapshot.dump(str(output_path))
+        print(f"tracemalloc snapshot written to {output_path}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dump-file", type=Path, default=ROOT_PATH / "data" / "example_data_dump.txt")
+    parser.add_argument("--repeat", type=int, default=200, help="Repetitions of the ingestion hot paths")
+    parser.add_argument("--runs", type=int, default=3, help="End-to-end replays of the dump")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Seconds taken by every LLM request")
+    parser.add_argument("--tts-real-time-factor", type=float, default=0.05, help="Synthesis time over audio duration")
+    parser.add_argument("--audio-latency", type=float, default=0.0, help="Seconds taken by every audio write")
+    parser.add_argument("--message-interval", type=float, default=0.0, help="Seconds between replayed messages")
+    parser.add_argument("--silent", action="store_true", help="Run in SILENT_MODE, without synthesis nor audio")
+    parser.add_argument("--profile", choices=("cprofile", "tracemalloc"), default=None)
+    parser.add_argument("--profile-output", type=Path, default=None)
+    arguments = parser.parse_args()
+
+    settings.SILENT_MODE = arguments.silent
+    # Nothing is written to disk. The shared resources have no commentary cache, so every run requests its commentary
+    settings.DUMP_RAW_MESSAGES = False
+
+    records = [message for _, message in DumpReplayer.iter_records(arguments.dump_file)]
+    messages = [message for message in records if message.startswith("42")]
+    frames = get_game_frames(messages)
+    print(f"{len(records)} messages, {len(messages)} chess information frames, {len(frames)} game frames")
+
+    for name, function, count in (
+        ("dispatch", lambda: dispatch_messages(records), len(records)),
+        ("JSON handling", lambda: parse_messages(messages), len(messages)),
+        ("board updates", lambda: update_boards(frames), len(frames)),
+    ):
+        elapsed_seconds = time_function(function=function, repeat=arguments.repeat)
+        per_item_microseconds = elapsed_seconds / (count * arguments.repeat) * 1e6
+        print(f"{name:>14}: {elapsed_seconds:.3f} s total, {per_item_microseconds:.1f} us/message")
+
+    def run_all() -> list[PipelineRun]:
+        return [
+            run_pipeline(
+                records=records,
+                message_interval_seconds=arguments.message_interval,
+                llm_latency_seconds=arguments.llm_latency,
+                tts_real_time_factor=arguments.tts_real_time_factor,
+                audio_latency_seconds=arguments.audio_latency,
+            )
+            for _ in range(arguments.runs)
+        ]
+
+    if arguments.profile == "cprofile":
+        runs = run_cprofile(run_all, output_path=arguments.profile_output)
+    elif arguments.profile == "tracemalloc":
+        runs = run_tracemalloc(run_all, output_path=arguments.profile_output)
+    else:
+        runs = run_all()
+
+    for index, run in enumerate(runs):
+        print(
+            f"end-to-end run {index + 1}: {run.elapsed_seconds:.2f} s, {len(records) / run.elapsed_seconds:.0f} "
+            f"messages/s, {run.llm_call_count} LLM calls, {run.coalesced_count} messages coalesced, "
+            f"{run.audio_seconds:.0f} s of audio"
+        )
+    median_seconds = statistics.median(run.elapsed_seconds for run in runs)
+    print(f"end-to-end median: {median_seconds:.2f} s, {len(records) / median_seconds:.0f} messages/s")
+    # Kilobytes on Linux, bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"peak resident memory: {max_rss / (1024 ** 2 if sys.platform == 'darwin' else 1024):.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Measures cold start costs, each in a fresh interpreter: the import time of the CLI and of the commentary services, the
+time to create the shared resources of the session manager, and, if a voice model is available, the time until the
+voice is loaded and warmed up in the background and the latency of the first synthesis once it is.
+
+Usage: python benchmarks/bench_startup.py [--voice-model voices/en_US-lessac-medium.onnx] [--repeat 5]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT_PATH = Path(__file__).resolve().parent.parent
+SOURCE_PATH = ROOT_PATH / "src"
+
+IMPORT_CLI_SCRIPT = """
+import time
+start_time = time.perf_counter()
+import manage
+print(time.perf_counter() - start_time)
+"""
+
+IMPORT_SERVICES_SCRIPT = """
+import time
+start_time = time.perf_counter()
+import services.session_manager, services.socket_connection
+print(time.perf_counter() - start_time)
+"""
+
+CREATE_RESOURCES_SCRIPT = """
+import time
+from services.session_manager import SharedResources
+start_time = time.perf_counter()
+shared_resources = SharedResources.create()
+print(time.perf_counter() - start_time)
+"""
+
+VOICE_READY_SCRIPT = """
+import time
+from services.speech_synthesizer import SpeechSynthesizer
+start_time = time.perf_counter()
+speech_synthesizer = SpeechSynthesizer(model_path={voice_model!r}, worker_count=1, intra_op_threads=2)
+created_seconds = time.perf_counter() - start_time
+while not speech_synthesizer.is_ready:
+    time.sleep(0.001)
+ready_seconds = time.perf_counter() - start_time
+synthesis_start_time = time.perf_counter()
+next(speech_synthesizer.synthesize(["White castles and the game is balanced."]))
+print(created_seconds, ready_seconds, time.perf_counter() - synthesis_start_time)
+"""
+
+COLD_SYNTHESIS_SCRIPT = """
+import time
+from piper import PiperVoice
+voice = PiperVoice.load({voice_model!r})
+synthesis_start_time = time.perf_counter()
+next(iter(voice.synthesize_stream_raw("White castles and the game is balanced.")))
+print(time.perf_counter() - synthesis_start_time)
+"""
+
+
+def run_script(script: str, environment: dict[str, str]) -> list[float]:
+    """
+    Runs a script in a fresh interpreter
+    :return: Numbers printed by the script
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", script], cwd=SOURCE_PATH, env=environment, capture_output=True, text=True, check=True
+    ).stdout
+    return [float(value) for value in output.split()]
+
+
+def report(name: str, samples: list[list[float]], labels: list[str]) -> None:
+    for index, label in enumerate(labels):
+        values = [sample[index] * 1000 for sample in samples]
+        print(f"{name:<22} {label:>21}: median {statistics.median(values):8.1f} ms, min {min(values):8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--voice-model", type=Path, default=None)
+    parser.add_argument("--repeat", type=int, default=5)
+    arguments = parser.parse_args()
+
+    environment = {
+        **os.environ,
+        "PYTHONPATH": str(SOURCE_PATH),
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "benchmark"),
+        "VOICE_MODEL_FILE_LOCATION": str(arguments.voice_model or "unused"),
+        "SILENT_MODE": "true",
+        "LLM_BACKEND": "fake",
+    }
+    for name, script in (
+        ("import manage.py", IMPORT_CLI_SCRIPT),
+        ("import services", IMPORT_SERVICES_SCRIPT),
+        ("create resources", CREATE_RESOURCES_SCRIPT),
+    ):
+        report(name, [run_script(script, environment) for _ in range(arguments.repeat)], ["total"])
+
+    if arguments.voice_model is None:
+        print("No --voice-model given, skipping voice measurements")
+        return
+    voice_model = str(arguments.voice_model.resolve())
+    report(
+        "background voice",
+        [run_script(VOICE_READY_SCRIPT.format(voice_model=voice_model), environment) for _ in range(arguments.repeat)],
+        ["constructor returned", "loaded and warmed up", "first synthesis"],
+    )
+    report(
+        "voice without warm up",
+        [
+            run_script(COLD_SYNTHESIS_SCRIPT.format(voice_model=voice_model), environment)
+            for _ in range(arguments.repeat)
+        ],
+        ["first synthesis"],
+    )
+
+
+if __name__ == "__main__":
+    main()
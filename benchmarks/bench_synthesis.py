@@ -0,0 +1,89 @@
+"""
+Measures the real-time factor (synthesis time over audio duration) of a multi-sentence commentary for several
+configurations of the speech synthesizer: the number of sentences synthesized in parallel and the number of ONNX
+Runtime threads used within each of them. The baseline is a single voice with the ONNX Runtime defaults, synthesizing
+the sentences one after the other. Requires a Piper voice model.
+
+Usage: python benchmarks/bench_synthesis.py --voice-model voices/en_US-lessac-medium.onnx [--configurations 1x4 2x2 4x1]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT_PATH = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_PATH / "src"))
+
+from services.speech_synthesizer import SpeechSynthesizer  # noqa: E402
+
+COMMENTARY = [
+    "White has just played knight to f5, a bold move that puts pressure on the kingside.",
+    "Black cannot take the knight, since the queen would then land on g4 with a devastating attack.",
+    "The engines agree that white is now clearly better, with an evaluation of about one and a half pawns.",
+    "Expect black to consolidate with rook to e8 and try to trade the dangerous knight as soon as possible.",
+    "It will be interesting to see whether white keeps the initiative or converts it into a material advantage.",
+]
+
+
+def baseline_real_time_factor(voice_model: Path, sample_rate: int) -> float:
+    from piper import PiperVoice
+
+    voice = PiperVoice.load(str(voice_model))
+    for _ in voice.synthesize_stream_raw(COMMENTARY[0]):
+        pass
+    start_time = time.perf_counter()
+    audio_bytes = sum(len(audio) for sentence in COMMENTARY for audio in voice.synthesize_stream_raw(sentence))
+    return (time.perf_counter() - start_time) / (audio_bytes / 2 / sample_rate)
+
+
+def synthesizer_real_time_factor(voice_model: Path, worker_count: int, intra_op_threads: int) -> tuple[float, float]:
+    """
+    :return: Real-time factor of the whole commentary, and time until the audio of the first sentence is available
+    """
+    speech_synthesizer = SpeechSynthesizer(
+        model_path=voice_model, worker_count=worker_count, intra_op_threads=intra_op_threads
+    )
+    while not speech_synthesizer.is_ready:
+        time.sleep(0.01)
+    start_time = time.perf_counter()
+    first_audio_seconds = None
+    audio_bytes = 0
+    for audio in speech_synthesizer.synthesize(COMMENTARY):
+        if first_audio_seconds is None:
+            first_audio_seconds = time.perf_counter() - start_time
+        audio_bytes += len(audio)
+    synthesis_seconds = time.perf_counter() - start_time
+    speech_synthesizer.close()
+    return synthesis_seconds / (audio_bytes / 2 / speech_synthesizer.sample_rate), first_audio_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--voice-model", type=Path, required=True)
+    parser.add_argument(
+        "--configurations",
+        nargs="+",
+        default=["1x4", "2x2", "4x1"],
+        help="Configurations to compare, as <workers>x<intra-op threads>",
+    )
+    arguments = parser.parse_args()
+
+    voice_model = arguments.voice_model.resolve()
+    sample_rate = json.loads(Path(f"{voice_model}.json").read_text())["audio"]["sample_rate"]
+    print(f"{os.cpu_count()} cores, {len(COMMENTARY)} sentences")
+    print(f"{'baseline':<12} real-time factor {baseline_real_time_factor(voice_model, sample_rate):.3f}")
+    for configuration in arguments.configurations:
+        worker_count, intra_op_threads = (int(value) for value in configuration.split("x"))
+        real_time_factor, first_audio_seconds = synthesizer_real_time_factor(
+            voice_model=voice_model, worker_count=worker_count, intra_op_threads=intra_op_threads
+        )
+        print(
+            f"{configuration:<12} real-time factor {real_time_factor:.3f}, "
+            f"first sentence after {first_audio_seconds * 1000:.0f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
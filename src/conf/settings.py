@@ -1,6 +1,9 @@
 import os
+import threading
 from pathlib import Path
 from typing import Literal
+
+from pydantic import Field, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 env_file_path = os.path.join(os.path.dirname(__file__), ".env")
@@ -21,7 +24,22 @@ class Settings(BaseSettings):
 
     DATA_DUMP_FILE_PATH: Path = "data_dump.txt"
     """
-    Filepath at which to dump messages
+    Filepath at which to dump messages. The suffix of the compression is added if missing
+    """
+
+    DUMP_COMPRESSION: Literal["none", "gzip", "zstd"] = "none"
+    """
+    Compression of the dumped messages. zstd requires the zstandard package
+    """
+
+    DUMP_FLUSH_INTERVAL_SECONDS: float = 5
+    """
+    Maximum time dumped messages are buffered in memory before being written to disk
+    """
+
+    DUMP_FLUSH_MAX_BYTES: int = 1024 * 1024
+    """
+    Size of the dumped messages buffer above which it is written to disk immediately
     """
 
     LOCAL_SOURCE_FILE_PATH: Path = "data_dump.txt"
@@ -44,5 +62,318 @@ class Settings(BaseSettings):
     Makes it so no audio is generated. The commentary is logged in the console instead
     """
 
+    STREAM_COMMENTARY: bool = True
+    """
+    If true, the commentary is streamed from the LLM and each sentence is vocalized as soon as it is complete, instead
+    of waiting for the whole message
+    """
+
+    CHAT_HISTORY_MAX_VERBATIM_TURNS: int = 6
+    """
+    Number of most recent commentary turns sent verbatim to the LLM. Older turns are folded into a rolling summary
+    """
+
+    COMMENTARY_CACHE_ENABLED: bool = True
+    """
+    If true, move commentary is cached on disk and reused whenever the same move is played in the same position
+    """
+
+    COMMENTARY_CACHE_FILE_PATH: Path = "data/commentary_cache.sqlite3"
+    """
+    Filepath of the commentary cache
+    """
+
+    COMMENTARY_CACHE_MAX_ENTRIES: int = 50_000
+    """
+    Maximum number of cached commentaries. The least recently used ones are evicted first
+    """
+
+    COMMENTARY_CACHE_BYPASS: bool = False
+    """
+    If true, cached commentary is never reused, but newly generated commentary is still stored in the cache
+    """
+
+    AUDIO_CACHE_ENABLED: bool = True
+    """
+    If true, synthesized audio is cached on disk and replayed whenever the same sentence is vocalized again
+    """
+
+    AUDIO_CACHE_FILE_PATH: Path = "data/audio_cache.pcm"
+    """
+    Filepath of the memory-mapped audio cache segment. The index is stored next to it
+    """
+
+    AUDIO_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+    """
+    Size of the audio cache segment in bytes. When full, the oldest cached audio is overwritten first
+    """
+
+    EVAL_SWING_THRESHOLD_PAWNS: float = 1.0
+    """
+    Change of the engines evaluation, in pawns, since the last commentated evaluation that triggers new commentary
+    """
+
+    EVAL_SWING_THRESHOLD_SCORE: float = 0.1
+    """
+    Change of the engines expected score (computed from win/draw/loss) since the last commentated evaluation that
+    triggers new commentary
+    """
+
+    EVAL_DISAGREEMENT_THRESHOLD_PAWNS: float = 1.5
+    """
+    Difference between the evaluations of different engines, in pawns, that triggers commentary on their disagreement
+    """
+
+    EVAL_MIN_DEPTH: int = 20
+    """
+    Engine evaluations with a lower search depth are too noisy to trigger commentary
+    """
+
+    EVAL_COALESCING_WINDOW_SECONDS: float = 10
+    """
+    Evaluations of different engines received within this window are combined into a single consensus evaluation
+    """
+
+    EVAL_COMMENTARY_MIN_INTERVAL_SECONDS: float = 30
+    """
+    Minimum time between two commentaries on the evaluation of the same game
+    """
+
+    PV_MAX_PLIES: int = 6
+    """
+    Number of plies of the engines best line that are sent to the LLM
+    """
+
+    LLM_BACKEND: Literal["openai", "fake"] = "openai"
+    """
+    Backend generating the commentary. "fake" answers locally with canned commentary, without network access
+    """
+
+    LLM_MODEL_NAME: str = "gpt-4-turbo"
+    """
+    Name of the model generating the commentary
+    """
+
+    LLM_BASE_URL: str | None = None
+    """
+    URL of an OpenAI compatible API, e.g. a local server. The OpenAI API is used if not set
+    """
+
+    LLM_REQUEST_TIMEOUT_SECONDS: float = 10
+    """
+    Maximum duration of a single request to the LLM
+    """
+
+    LLM_CALL_DEADLINE_SECONDS: float = 20
+    """
+    Maximum time to get a commentary from the LLM, retries and hedged requests included. Commentary that is not ready
+    by then is skipped
+    """
+
+    LLM_MAX_RETRIES: int = 2
+    """
+    Maximum number of retries of a failed request to the LLM
+    """
+
+    LLM_RETRY_BASE_DELAY_SECONDS: float = 0.5
+    """
+    Base of the jittered exponential backoff between retries
+    """
+
+    LLM_HEDGE_PERCENTILE: float | None = Field(default=None, ge=1, le=99)
+    """
+    When a request takes longer than this percentile of the recent latencies, e.g. 95, a second request is sent and the
+    first response is used. Requests are never hedged if not set or empty
+    """
+
+    METRICS_EXPORT: Literal["none", "http", "file"] = "none"
+    """
+    How latency and throughput metrics are exported, in the Prometheus text format: served over HTTP, periodically
+    written to a file, or not at all
+    """
+
+    METRICS_HTTP_PORT: int = 9464
+    """
+    Port on which metrics are served on /metrics, when exported over HTTP
+    """
+
+    METRICS_FILE_PATH: Path = "data/metrics.prom"
+    """
+    File metrics are written to, when exported to a file
+    """
+
+    METRICS_FILE_INTERVAL_SECONDS: float = 15
+    """
+    Interval between two writes of the metrics file
+    """
+
+    TTS_WORKERS: int = 2
+    """
+    Number of sentences synthesized in parallel, each worker loading its own copy of the voice model
+    """
+
+    TTS_INTRA_OP_THREADS: int = 2
+    """
+    Number of threads ONNX Runtime uses within the synthesis of a single sentence. TTS_WORKERS * TTS_INTRA_OP_THREADS
+    should not exceed the number of cores
+    """
+
+    COMMENTARY_MAX_STALENESS_SECONDS: float = 30
+    """
+    Maximum time between receiving a message and speaking its commentary. Older commentary is skipped, or interrupted
+    if already being spoken, so that the speech never lags far behind the board
+    """
+
+    SPECULATION_ENABLED: bool = False
+    """
+    If true, the commentary of the moves predicted by the engines is prepared before they are played, and used straight
+    away if the prediction is right
+    """
+
+    SPECULATION_MAX_PREDICTIONS_PER_POSITION: int = 2
+    """
+    Maximum number of different predicted moves whose commentary is prepared from the same position
+    """
+
+    SPECULATION_MAX_CALLS_PER_HOUR: int = 120
+    """
+    Maximum number of speculative LLM calls per hour, over all games
+    """
+
+    SPECULATION_PRESYNTHESIZE: bool = True
+    """
+    If true, prepared commentary is also synthesized ahead of time. Ignored in SILENT_MODE
+    """
+
+    BATCH_OUTPUT_DIR_PATH: Path = "data/batch"
+    """
+    Directory the transcripts and audio of the batch command are written to, unless given on the command line
+    """
+
+    BATCH_MAX_CONCURRENT_GAMES: int = 4
+    """
+    Number of games commentated at the same time by the batch command. The moves of a game are always commentated in
+    order
+    """
+
+    BATCH_MAX_REQUESTS_PER_MINUTE: float = 60
+    """
+    Maximum number of requests sent to the LLM per minute by the batch command, over all games. Chat history
+    summaries and retries count too. Calls wait for their turn before their deadline starts, and requests are only
+    hedged when the limit is not reached
+    """
+
+    AUDIO_SINKS: list[Literal["sounddevice", "file", "http"]] = ["sounddevice"]
+    """
+    Outputs of the commentary audio: the local sound device, WAV recordings and a local HTTP stream. The audio is
+    synthesized once and shared by all of them. Ignored in SILENT_MODE
+    """
+
+    AUDIO_SINK_BUFFER_SECONDS: float = 30
+    """
+    Maximum amount of audio waiting to be written to a recording or sent to a stream listener. Audio that does not fit
+    is dropped from recordings, and stream listeners that fall that far behind are disconnected
+    """
+
+    AUDIO_RECORDING_DIR_PATH: Path = "data/recordings"
+    """
+    Directory the WAV recordings are written to, when recording
+    """
+
+    AUDIO_RECORDING_SEGMENT_SECONDS: float | None = 3600
+    """
+    Duration of audio after which a new recording is started. A single recording is written if not set
+    """
+
+    AUDIO_RECORDING_MAX_SEGMENTS: int | None = 24
+    """
+    Maximum number of recordings kept, the oldest are deleted. All are kept if not set
+    """
+
+    AUDIO_STREAM_HOST: str = "127.0.0.1"
+    """
+    Interface the audio stream is served on, when streaming
+    """
+
+    AUDIO_STREAM_PORT: int = 8008
+    """
+    Port the audio stream is served on, as WAV on /stream.wav and raw PCM on /stream.pcm
+    """
+
+    AUDIO_STREAM_MAX_LISTENERS: int = 16
+    """
+    Maximum number of listeners connected to the audio stream at the same time
+    """
+
+    WORK_QUEUE_MAX_SIZE: int = 16
+    """
+    Maximum number of pending messages waiting to be commentated. Newer positions and evaluations of the same game
+    replace pending ones, when the queue is full the oldest pending message is dropped
+    """
+
+    SOCKET_URLS: list[str] = ["wss://tcec-chess.com/socket.io/?EIO=3&transport=websocket"]
+    """
+    Websockets to receive games from. Every game received on any of them is commentated in its own session
+    """
+
+    SOCKET_RECONNECT_BASE_DELAY_SECONDS: float = 1
+    """
+    Delay before the first attempt to reconnect to a websocket. It doubles after every failed attempt, with jitter
+    """
+
+    SOCKET_RECONNECT_MAX_DELAY_SECONDS: float = 60
+    """
+    Maximum delay between attempts to reconnect to a websocket
+    """
+
+    MAX_CONCURRENT_COMMENTARIES: int = 2
+    """
+    Maximum number of games whose commentary is generated at the same time. Games take turns fairly when more of them
+    have pending messages
+    """
+
+    MAX_SESSIONS: int = 8
+    """
+    Maximum number of games with a commentary session. When exceeded, the least recently active idle session is closed
+    """
+
+    SESSION_IDLE_TIMEOUT_SECONDS: float = 1800
+    """
+    Commentary sessions of games that received no message for this long are closed
+    """
+
+    HTTP_MAX_CONNECTIONS: int = 10
+    """
+    Size of the pool of HTTP connections to the LLM provider, shared by all commentary sessions
+    """
+
+    @field_validator("LLM_HEDGE_PERCENTILE", mode="before")
+    @classmethod
+    def parse_empty_as_none(cls, value):
+        """
+        Lets optional numbers be unset from the environment with an empty value or null
+        """
+        if isinstance(value, str) and value.strip().lower() in ("", "null", "none"):
+            return None
+        return value
+
+
+class LazySettings:
+    """
+    Creates the settings on first access, so that importing a module never reads the environment and commands that do
+    not need the settings, e.g. --help, work without a complete .env file
+    """
+
+    def __init__(self):
+        self._settings: Settings | None = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        if self._settings is None:
+            with self._lock:
+                if self._settings is None:
+                    self._settings = Settings()
+        return getattr(self._settings, name)
+
 
-settings: Settings = Settings()
+settings: Settings = LazySettings()  # type: ignore[assignment]
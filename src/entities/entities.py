@@ -1,4 +1,7 @@
-from enum import StrEnum
+from dataclasses import dataclass
+from enum import IntEnum, StrEnum
+
+from entities.types import FenPosition, GameKey
 
 
 class MessageTypeEnum(StrEnum):
@@ -6,3 +9,77 @@ class MessageTypeEnum(StrEnum):
     UnknownMessageType = "unknown"
     FirstPingMessageType = "0"
     EmptyPostPingMessageType = "4"
+    PingMessageType = "2"
+    PongMessageType = "3"
+
+
+class EvalCommentaryReasonEnum(StrEnum):
+    EvaluationSwing = "evaluation_swing"
+    EngineDisagreement = "engine_disagreement"
+
+
+class CommentaryPriorityEnum(IntEnum):
+    """
+    Urgency of a commentary, lower values being more urgent
+    """
+
+    NewGame = 0
+    Move = 1
+    Evaluation = 2
+
+
+class PositionUpdateKindEnum(StrEnum):
+    Initial = "initial"
+    Duplicate = "duplicate"
+    Moves = "moves"
+    Resync = "resync"
+    NewGame = "new_game"
+
+
+@dataclass(frozen=True)
+class PlayedMove:
+    san: str
+    fen_position: FenPosition
+    """
+    Position after the move
+    """
+
+
+@dataclass(frozen=True)
+class PositionData:
+    """
+    Position information extracted from a `pgn` message, ready to be commentated
+    """
+
+    game_key: GameKey
+    fen_position: FenPosition
+    last_move: str
+    white_name: str
+    black_name: str
+    opening: str | None = None
+    received_time: float | None = None
+    """
+    Monotonic time at which the message was received, used to measure latencies
+    """
+    moves: tuple[PlayedMove, ...] = ()
+    """
+    Latest moves of the game sent with the message, in chronological order. The last one leads to fen_position
+    """
+
+
+@dataclass(frozen=True)
+class PositionEvaluationData:
+    """
+    Evaluation information extracted from a `liveeval` message, ready to be commentated
+    """
+
+    game_key: GameKey
+    engine_name: str
+    position_evaluation: str
+    best_line: str
+    wdl: str | None = None
+    depth: str | None = None
+    received_time: float | None = None
+    """
+    Monotonic time at which the message was received, used to measure latencies
+    """
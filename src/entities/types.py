@@ -1,3 +1,4 @@
 from typing import TypeAlias
 
 FenPosition: TypeAlias = str
+GameKey: TypeAlias = str
@@ -1,10 +1,15 @@
 import threading
+from pathlib import Path
 
 import click
 
 from conf.settings import settings
-from services.socket_connection import SocketConnector
-from utils.logger import init_logger
+from services.metrics_exporter import MetricsExporter
+from services.replay import parse_replay_speed
+from utils.logger import global_logger, init_logger
+from utils.metrics import global_metrics
+
+# Commentary services pull in LangChain, OpenAI and Piper, so they are imported by the commands that use them only
 
 
 @click.group()
@@ -16,31 +21,111 @@ def setup():
     init_logger(settings.LOG_LEVEL)
 
 
+def create_metrics_exporter() -> MetricsExporter:
+    return MetricsExporter(
+        metrics_registry=global_metrics,
+        export=settings.METRICS_EXPORT,
+        http_port=settings.METRICS_HTTP_PORT,
+        file_path=settings.METRICS_FILE_PATH,
+        file_interval_seconds=settings.METRICS_FILE_INTERVAL_SECONDS,
+    )
+
+
 @click.command(name="connect-socket")
 def run():
+    from services.session_manager import SessionManager
+    from services.socket_connection import SocketConnector
+
     setup()
-    socket_connection = SocketConnector()
+    metrics_exporter = create_metrics_exporter()
+    metrics_exporter.start()
+    # Games received on all the sockets are commentated by the same sessions, sharing the voice and audio output
+    session_manager = SessionManager()
+    socket_connections = [
+        SocketConnector(session_manager=session_manager, socket_url=socket_url) for socket_url in settings.SOCKET_URLS
+    ]
+    connection_threads = [
+        # Every connection reconnects on its own until disconnected
+        threading.Thread(target=socket_connection.connect, name="socket-connection", daemon=True)
+        for socket_connection in socket_connections
+    ]
 
     try:
-        socket_connection.connect()
-        # Check to keep the connection alive running on a separate thread
-        keep_alive_thread = threading.Thread(target=socket_connection.keep_alive)
-        keep_alive_thread.start()
+        for connection_thread in connection_threads:
+            connection_thread.start()
+        for connection_thread in connection_threads:
+            connection_thread.join()
     except KeyboardInterrupt:
-        socket_connection.stop_thread_event.set()
-        keep_alive_thread.join()
-        socket_connection.disconnect()
+        for socket_connection in socket_connections:
+            socket_connection.disconnect()
+        session_manager.stop()
+        metrics_exporter.close()
+
+
+def parse_speed_option(_context: click.Context, _parameter: click.Parameter, value: str) -> float:
+    try:
+        return parse_replay_speed(value)
+    except ValueError as error:
+        raise click.BadParameter(str(error))
 
 
 @click.command(name="run-from-local-dump")
-def run_from_local_dump():
+@click.option(
+    "--speed",
+    default="realtime",
+    show_default=True,
+    callback=parse_speed_option,
+    help='Replay speed: "realtime", an acceleration factor such as "10x", or "asap" to replay as fast as possible',
+)
+@click.option("--game", default=None, help='Round of the game from which to start replaying, e.g. "29.4"')
+def run_from_local_dump(speed: float, game: str | None):
+    from services.session_manager import SessionManager
+    from services.socket_connection import SocketConnector
+
+    setup()
+    metrics_exporter = create_metrics_exporter()
+    metrics_exporter.start()
+    socket_connection = SocketConnector(session_manager=SessionManager())
+    socket_connection.run_from_local_dump(
+        dump_data_filepath=settings.LOCAL_SOURCE_FILE_PATH, speed=speed, game_round=game
+    )
+    metrics_exporter.close()
+
+
+@click.command(name="batch")
+@click.argument(
+    "input_paths", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False, path_type=Path)
+)
+@click.option(
+    "--output-dir",
+    "output_dir_path",
+    default=None,
+    type=click.Path(file_okay=False, path_type=Path),
+    help="Directory the commentary is written to, BATCH_OUTPUT_DIR_PATH if not set",
+)
+def run_batch(input_paths: tuple[Path, ...], output_dir_path: Path | None):
+    """
+    Commentates the games of PGN files or dumps offline, rendering each game to a WAV file
+    """
+    from services.batch_commentator import create_batch_commentator, read_games
+
     setup()
-    socket_connection = SocketConnector()
-    socket_connection.run_from_local_dump(dump_data_filepath=settings.LOCAL_SOURCE_FILE_PATH)
+    metrics_exporter = create_metrics_exporter()
+    metrics_exporter.start()
+    games = [game for input_path in input_paths for game in read_games(input_path)]
+    global_logger.info(f"Commentating {len(games)} games")
+    batch_commentator = create_batch_commentator(output_dir_path=output_dir_path or settings.BATCH_OUTPUT_DIR_PATH)
+    try:
+        summary = batch_commentator.commentate_games(games)
+    finally:
+        batch_commentator.close()
+        metrics_exporter.close()
+    global_logger.info(summary.format())
 
 
 cli.add_command(run)
 cli.add_command(run_from_local_dump)
+cli.add_command(run_batch)
 
 if __name__ == "__main__":
     cli()
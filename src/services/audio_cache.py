@@ -0,0 +1,170 @@
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from utils.logger import global_logger
+
+
+class SynthesizedAudioCache:
+    """
+    Persistent cache of synthesized int16 PCM audio keyed by voice model and text. Audio is stored in a fixed size
+    memory-mapped segment file used as a circular log: new entries are appended after the previous one and wrap around
+    to the start of the file when the end is reached, evicting the oldest entries they overwrite. The position and
+    checksum of every entry are kept in a JSON index stored next to the segment file. The index is written at most once
+    per interval rather than on every store: entries whose audio was overwritten after the index was last written, if
+    the process stopped without closing the cache, fail their checksum and are treated as misses.
+    """
+
+    INDEX_FILE_SUFFIX = ".index.json"
+    INDEX_SAVE_INTERVAL_SECONDS = 10
+    INDEX_VERSION = 2
+
+    def __init__(self, file_path: Path, max_bytes: int):
+        """
+        :param file_path: Path of the segment file. Created if missing
+        :param max_bytes: Size of the segment file, i.e. maximum number of bytes of cached audio
+        """
+        self.file_path = Path(file_path)
+        self.index_file_path = self.file_path.with_name(self.file_path.name + self.INDEX_FILE_SUFFIX)
+        self.max_bytes = max_bytes
+        self.hit_count = 0
+        self.miss_count = 0
+
+        self._lock = threading.Lock()
+        # Offset, length and CRC32 of the audio of every key
+        self._entries: dict[str, tuple[int, int, int]] = {}
+        self._write_offset = 0
+        self._index_save_time = time.monotonic()
+        self._is_index_dirty = False
+
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.file_path, "a+b")
+        self._file.truncate(max_bytes)
+        self._mmap = mmap.mmap(self._file.fileno(), max_bytes)
+        self._load_index()
+
+    @staticmethod
+    def make_key(voice_model: str, text: str) -> str:
+        """
+        Builds the cache key of a synthesized text
+        :param voice_model: Identifier of the voice model used for synthesis
+        :param text: Synthesized text
+        :return: Cache key
+        """
+        return hashlib.sha256(f"{voice_model}\x1f{text}".encode()).hexdigest()
+
+    def get(self, voice_model: str, text: str) -> bytes | None:
+        """
+        Looks up cached audio. The audio is copied out of the segment file, since it is kept by the synthesis workers,
+        the audio sinks and prepared commentary while later entries may overwrite it
+        :param voice_model: Identifier of the voice model used for synthesis
+        :param text: Synthesized text
+        :return: Cached int16 PCM, or None on a miss
+        """
+        key = self.make_key(voice_model=voice_model, text=text)
+        with self._lock:
+            entry = self._entries.get(key)
+            audio = None
+            if entry is not None:
+                offset, length, checksum = entry
+                audio = self._mmap[offset : offset + length]
+                if zlib.crc32(audio) != checksum:
+                    global_logger.warning("Cached audio was overwritten before the index was saved, discarding it")
+                    del self._entries[key]
+                    self._is_index_dirty = True
+                    audio = None
+            if audio is None:
+                self.miss_count += 1
+                return None
+            self.hit_count += 1
+            return audio
+
+    def put(self, voice_model: str, text: str, audio: bytes) -> None:
+        """
+        Stores synthesized audio, evicting the oldest entries it overwrites
+        :param voice_model: Identifier of the voice model used for synthesis
+        :param text: Synthesized text
+        :param audio: int16 PCM to store
+        """
+        length = len(audio)
+        if not length or length > self.max_bytes:
+            return
+
+        checksum = zlib.crc32(audio)
+        with self._lock:
+            offset = self._write_offset if self._write_offset + length <= self.max_bytes else 0
+            self._evict_overlapping(start=offset, end=offset + length)
+            self._mmap[offset : offset + length] = audio
+            self._entries[self.make_key(voice_model=voice_model, text=text)] = (offset, length, checksum)
+            self._write_offset = offset + length
+            self._is_index_dirty = True
+            if time.monotonic() - self._index_save_time >= self.INDEX_SAVE_INTERVAL_SECONDS:
+                self._mmap.flush()
+                self._save_index()
+
+    def close(self) -> None:
+        """
+        Persists the index and releases the memory-mapped segment file
+        """
+        with self._lock:
+            self._mmap.flush()
+            self._save_index()
+            self._mmap.close()
+            self._file.close()
+
+    def _evict_overlapping(self, start: int, end: int) -> None:
+        """
+        Removes from the index all entries overlapping with the given byte range
+        :param start: First byte of the range
+        :param end: First byte after the range
+        """
+        overlapping_keys = [
+            key for key, (offset, length, _) in self._entries.items() if offset < end and offset + length > start
+        ]
+        for key in overlapping_keys:
+            del self._entries[key]
+
+    def _load_index(self) -> None:
+        """
+        Loads the index from disk, discarding it if it does not match the current segment file size
+        """
+        if not self.index_file_path.exists():
+            return
+        try:
+            with open(self.index_file_path, "r") as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            global_logger.warning(f"Could not read audio cache index at {self.index_file_path}, starting empty")
+            return
+
+        if index.get("max_bytes") != self.max_bytes or index.get("version") != self.INDEX_VERSION:
+            global_logger.info("Audio cache size or format changed, starting empty")
+            return
+        self._write_offset = index["write_offset"]
+        self._entries = {key: tuple(entry) for key, entry in index["entries"].items()}
+
+    def _save_index(self) -> None:
+        """
+        Atomically writes the index to disk, if it changed since it was last written
+        """
+        self._index_save_time = time.monotonic()
+        if not self._is_index_dirty:
+            return
+        self._is_index_dirty = False
+        temporary_path = self.index_file_path.with_name(self.index_file_path.name + ".tmp")
+        with open(temporary_path, "w") as file:
+            json.dump(
+                {
+                    "version": self.INDEX_VERSION,
+                    "max_bytes": self.max_bytes,
+                    "write_offset": self._write_offset,
+                    "entries": self._entries,
+                },
+                file,
+            )
+        os.replace(temporary_path, self.index_file_path)
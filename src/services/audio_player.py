@@ -0,0 +1,106 @@
+import time
+
+import numpy as np
+
+from conf.settings import settings
+from services.audio_sinks import AudioSink, HttpStreamSink, SoundDeviceSink, WavFileSink
+
+
+class AudioPlayer:
+    """
+    Plays int16 mono PCM on every audio sink: the sound device, a recording, network listeners. The audio of each
+    synthesis is wrapped once in an array shared by all the sinks, without copies, and every sink buffers and outputs it
+    on its own thread, so callers never wait for audio to finish playing and a slow sink never stalls the others.
+    """
+
+    def __init__(self, sample_rate: int, sinks: list[AudioSink] | None = None):
+        """
+        :param sample_rate: Sample rate of the audio
+        :param sinks: Outputs of the audio. Only the sound device if None
+        """
+        self.sample_rate = sample_rate
+        self.sinks = sinks if sinks is not None else [SoundDeviceSink(sample_rate=sample_rate)]
+
+    @property
+    def buffered_samples(self) -> int:
+        """
+        Audio still to be output by the slowest sink, i.e. non zero while the commentary is being played
+        """
+        return max((sink.buffered_samples for sink in self.sinks), default=0)
+
+    def start(self) -> None:
+        """
+        Starts all the sinks, if not running already
+        """
+        for sink in self.sinks:
+            sink.start()
+
+    def play(self, audio: bytes | memoryview | np.ndarray) -> None:
+        """
+        Queues audio on every sink. Only blocks if the sound device buffer is full, i.e. if synthesis is far ahead of
+        playback
+        :param audio: int16 mono PCM, either raw bytes or an array. Must not be modified afterwards, it is shared by the
+        sinks
+        """
+        samples = audio if isinstance(audio, np.ndarray) else np.frombuffer(audio, dtype=np.int16)
+        for sink in self.sinks:
+            sink.write(samples)
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """
+        Blocks until all queued audio has been output by every sink
+        :param timeout: Maximum number of seconds to wait. Waits forever if None
+        :return: True if all audio was output
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for sink in self.sinks:
+            remaining_seconds = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+            if not sink.flush(timeout=remaining_seconds):
+                return False
+        return True
+
+    def interrupt(self) -> None:
+        """
+        Discards all queued audio on every sink
+        """
+        for sink in self.sinks:
+            sink.interrupt()
+
+    def close(self) -> None:
+        """
+        Stops and closes every sink
+        """
+        for sink in self.sinks:
+            sink.close()
+
+
+def create_audio_player(sample_rate: int) -> AudioPlayer:
+    """
+    Creates the audio player with the sinks selected in the settings. The sinks are started by `start`
+    :param sample_rate: Sample rate of the audio
+    :return: Audio player
+    """
+    sinks: list[AudioSink] = []
+    if "sounddevice" in settings.AUDIO_SINKS:
+        sinks.append(SoundDeviceSink(sample_rate=sample_rate))
+    if "file" in settings.AUDIO_SINKS:
+        sinks.append(
+            WavFileSink(
+                sample_rate=sample_rate,
+                dir_path=settings.AUDIO_RECORDING_DIR_PATH,
+                buffer_seconds=settings.AUDIO_SINK_BUFFER_SECONDS,
+                segment_seconds=settings.AUDIO_RECORDING_SEGMENT_SECONDS,
+                max_segments=settings.AUDIO_RECORDING_MAX_SEGMENTS,
+            )
+        )
+    if "http" in settings.AUDIO_SINKS:
+        sinks.append(
+            HttpStreamSink(
+                sample_rate=sample_rate,
+                host=settings.AUDIO_STREAM_HOST,
+                port=settings.AUDIO_STREAM_PORT,
+                buffer_seconds=settings.AUDIO_SINK_BUFFER_SECONDS,
+                max_listeners=settings.AUDIO_STREAM_MAX_LISTENERS,
+            )
+        )
+    return AudioPlayer(sample_rate=sample_rate, sinks=sinks)
@@ -0,0 +1,561 @@
+import socket
+import struct
+import threading
+import time
+import wave
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import TYPE_CHECKING, Literal
+
+import numpy as np
+
+from utils.logger import global_logger
+from utils.metrics import AUDIO_SINK_DROPS
+from utils.ring_buffer import PcmRingBuffer
+
+if TYPE_CHECKING:
+    import sounddevice
+
+AudioSinkName = Literal["sounddevice", "file", "http", "null"]
+
+
+class PcmChunkQueue:
+    """
+    Bounded, thread safe queue of int16 PCM chunks. Chunks are queued by reference, so that the same audio can be queued
+    on several sinks without copies. The producer never waits: chunks that do not fit are refused.
+    """
+
+    def __init__(self, capacity_samples: int):
+        self.capacity_samples = capacity_samples
+        self._chunks: deque[np.ndarray] = deque()
+        self._queued_samples = 0
+        self._condition = threading.Condition()
+
+    @property
+    def queued_samples(self) -> int:
+        with self._condition:
+            return self._queued_samples
+
+    def put(self, samples: np.ndarray) -> bool:
+        """
+        Queues a chunk, unless the queue is too full to hold it
+        :param samples: int16 samples. Not copied, must not be modified afterwards
+        :return: True if the chunk was queued
+        """
+        with self._condition:
+            if self._queued_samples + len(samples) > self.capacity_samples:
+                return False
+            self._chunks.append(samples)
+            self._queued_samples += len(samples)
+            self._condition.notify_all()
+            return True
+
+    def get(self, timeout: float | None = None) -> np.ndarray | None:
+        """
+        Removes the oldest chunk, blocking until one is available
+        :param timeout: Maximum number of seconds to wait. Waits forever if None
+        :return: Oldest chunk, None if the timeout expired
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._chunks, timeout=timeout):
+                return None
+            samples = self._chunks.popleft()
+            self._queued_samples -= len(samples)
+            self._condition.notify_all()
+            return samples
+
+    def clear(self) -> None:
+        with self._condition:
+            self._chunks.clear()
+            self._queued_samples = 0
+            self._condition.notify_all()
+
+    def wait_until_empty(self, timeout: float | None = None) -> bool:
+        """
+        :param timeout: Maximum number of seconds to wait. Waits forever if None
+        :return: True if the queue is empty
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._chunks, timeout=timeout)
+
+
+class AudioSink(ABC):
+    """
+    Destination of the synthesized audio. Every sink buffers the audio on its own and outputs it on its own thread, so
+    that a slow sink never delays the others.
+    """
+
+    name: AudioSinkName
+
+    def __init__(self, sample_rate: int):
+        self.sample_rate = sample_rate
+
+    @property
+    def buffered_samples(self) -> int:
+        """
+        Audio given to the sink that is still to be output
+        """
+        return 0
+
+    def start(self) -> None:
+        """
+        Starts the output thread of the sink, if not running already
+        """
+
+    @abstractmethod
+    def write(self, samples: np.ndarray) -> None:
+        """
+        Queues audio for output
+        :param samples: int16 mono PCM, shared with the other sinks. Must not be modified
+        """
+
+    def interrupt(self) -> None:
+        """
+        Discards the queued audio
+        """
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """
+        Blocks until all queued audio has been output
+        :param timeout: Maximum number of seconds to wait. Waits forever if None
+        :return: True if all audio was output
+        """
+        return True
+
+    @abstractmethod
+    def close(self) -> None:
+        """
+        Stops the output thread, discarding queued audio, and releases the output
+        """
+
+
+class SoundDeviceSink(AudioSink):
+    """
+    Plays the audio on a single long-lived sounddevice output stream. Audio is queued in a ring buffer and written to
+    the device by a dedicated playback thread. Unlike other sinks, writing blocks when the buffer is full, which bounds
+    how far ahead of playback the synthesis can run.
+    """
+
+    name = "sounddevice"
+    BUFFER_SECONDS = 120
+    BLOCK_FRAMES = 1024
+    READ_TIMEOUT_SECONDS = 0.5
+
+    def __init__(self, sample_rate: int):
+        super().__init__(sample_rate=sample_rate)
+        self.ring_buffer = PcmRingBuffer(capacity_samples=self.BUFFER_SECONDS * sample_rate)
+
+        self._stream: "sounddevice.OutputStream | None" = None
+        self._thread: threading.Thread | None = None
+        self._stop_event = threading.Event()
+        self._idle_event = threading.Event()
+        self._idle_event.set()
+
+    @property
+    def buffered_samples(self) -> int:
+        return self.ring_buffer.available_samples
+
+    def start(self) -> None:
+        """
+        Opens the output stream and starts the playback thread, if not running already
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        # Imported here since it loads PortAudio, which is not needed until audio is played
+        import sounddevice
+
+        self._stream = sounddevice.OutputStream(samplerate=self.sample_rate, channels=1, dtype="int16")
+        self._stream.start()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="audio-playback", daemon=True)
+        self._thread.start()
+
+    def write(self, samples: np.ndarray) -> None:
+        self._idle_event.clear()
+        self.ring_buffer.write(samples)
+
+    def interrupt(self) -> None:
+        """
+        Discards all queued audio. Playback stops after the block currently being written to the device
+        """
+        self.ring_buffer.clear()
+
+    def flush(self, timeout: float | None = None) -> bool:
+        return self.ring_buffer.wait_until_empty(timeout=timeout) and self._idle_event.wait(timeout=timeout)
+
+    def close(self) -> None:
+        self._stop_event.set()
+        self.interrupt()
+        if self._thread:
+            self._thread.join()
+        if self._stream:
+            self._stream.stop()
+            self._stream.close()
+            self._stream = None
+
+    def _run(self) -> None:
+        """
+        Main loop of the playback thread, moving blocks of audio from the ring buffer to the output stream
+        """
+        import sounddevice
+
+        while not self._stop_event.is_set():
+            block = self.ring_buffer.read(max_samples=self.BLOCK_FRAMES, timeout=self.READ_TIMEOUT_SECONDS)
+            if not len(block):
+                self._idle_event.set()
+                continue
+            try:
+                self._stream.write(block)
+            except sounddevice.PortAudioError:
+                global_logger.exception("Failed to write audio block to the output stream")
+            if not self.ring_buffer.available_samples:
+                self._idle_event.set()
+
+
+class NullAudioSink(AudioSink):
+    """
+    Discards the audio after an optional delay, only counting it. Used to run the pipeline without any audio output,
+    e.g. in benchmarks
+    """
+
+    name = "null"
+
+    def __init__(self, sample_rate: int, write_latency_seconds: float = 0.0):
+        """
+        :param sample_rate: Sample rate of the audio
+        :param write_latency_seconds: Time taken by every write, to simulate a slow output
+        """
+        super().__init__(sample_rate=sample_rate)
+        self.write_latency_seconds = write_latency_seconds
+        self.written_samples = 0
+
+    def write(self, samples: np.ndarray) -> None:
+        if self.write_latency_seconds:
+            time.sleep(self.write_latency_seconds)
+        self.written_samples += len(samples)
+
+    def close(self) -> None:
+        pass
+
+
+class WavFileSink(AudioSink):
+    """
+    Records the audio to WAV files, e.g. as a rolling recording of a broadcast. A new file is started after every
+    segment of audio and, if a maximum number of segments is set, the oldest recordings are deleted. Audio that does not
+    fit in the buffer, if the disk cannot keep up, is dropped.
+    """
+
+    name = "file"
+    FILE_PREFIX = "commentary_"
+    READ_TIMEOUT_SECONDS = 0.5
+
+    def __init__(
+        self,
+        sample_rate: int,
+        dir_path: Path,
+        buffer_seconds: float,
+        segment_seconds: float | None = None,
+        max_segments: int | None = None,
+    ):
+        """
+        :param sample_rate: Sample rate of the audio
+        :param dir_path: Directory the recordings are written to
+        :param buffer_seconds: Maximum amount of audio waiting to be written
+        :param segment_seconds: Duration of audio after which a new file is started. A single file is written if None
+        :param max_segments: Maximum number of recordings kept in the directory. All are kept if None
+        """
+        super().__init__(sample_rate=sample_rate)
+        self.dir_path = Path(dir_path)
+        self.segment_seconds = segment_seconds
+        self.max_segments = max_segments
+        self.queue = PcmChunkQueue(capacity_samples=int(buffer_seconds * sample_rate))
+
+        self._file: wave.Wave_write | None = None
+        self._thread: threading.Thread | None = None
+        self._stop_event = threading.Event()
+        self._idle_event = threading.Event()
+        self._idle_event.set()
+
+    @property
+    def buffered_samples(self) -> int:
+        return self.queue.queued_samples
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="audio-recording", daemon=True)
+        self._thread.start()
+
+    def write(self, samples: np.ndarray) -> None:
+        self._idle_event.clear()
+        if not self.queue.put(samples):
+            global_logger.warning(f"Recording buffer full, dropping {len(samples) / self.sample_rate:.1f} s of audio")
+            AUDIO_SINK_DROPS.inc(sink=self.name)
+
+    def interrupt(self) -> None:
+        self.queue.clear()
+
+    def flush(self, timeout: float | None = None) -> bool:
+        return self.queue.wait_until_empty(timeout=timeout) and self._idle_event.wait(timeout=timeout)
+
+    def close(self) -> None:
+        """
+        Writes the queued audio, then closes the current recording
+        """
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        """
+        Main loop of the recording thread, writing the queued audio to the current recording
+        """
+        try:
+            while not self._stop_event.is_set() or self.queue.queued_samples:
+                samples = self.queue.get(timeout=self.READ_TIMEOUT_SECONDS)
+                if samples is None:
+                    self._idle_event.set()
+                    continue
+                try:
+                    self._get_file().writeframes(samples)
+                except OSError:
+                    global_logger.exception("Failed to write the audio recording")
+                if not self.queue.queued_samples:
+                    self._idle_event.set()
+        finally:
+            self._close_file()
+            self._idle_event.set()
+
+    def _get_file(self) -> wave.Wave_write:
+        """
+        :return: Current recording, a new one if the current one is complete
+        """
+        if self._file and self.segment_seconds and self._file.tell() >= self.segment_seconds * self.sample_rate:
+            self._close_file()
+        if self._file is None:
+            file_path = self.dir_path / f"{self.FILE_PREFIX}{datetime.now():%Y%m%d_%H%M%S_%f}.wav"
+            self._file = wave.open(str(file_path), "wb")
+            self._file.setnchannels(1)
+            self._file.setsampwidth(2)
+            self._file.setframerate(self.sample_rate)
+            self._delete_old_segments()
+        return self._file
+
+    def _close_file(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _delete_old_segments(self) -> None:
+        if not self.max_segments:
+            return
+        # File names sort chronologically
+        for file_path in sorted(self.dir_path.glob(f"{self.FILE_PREFIX}*.wav"))[: -self.max_segments]:
+            file_path.unlink(missing_ok=True)
+
+
+class _StreamListener:
+    def __init__(self, connection: socket.socket, capacity_samples: int):
+        self.connection = connection
+        self.queue = PcmChunkQueue(capacity_samples=capacity_samples)
+        self.closed_event = threading.Event()
+
+
+class HttpStreamSink(AudioSink):
+    """
+    Streams the audio to any number of local listeners over HTTP, with chunked transfer encoding: as WAV on
+    /stream.wav, which most players can open, or as raw little-endian PCM on /stream.pcm. Every listener has its own
+    bounded buffer, and listeners that cannot keep up are disconnected instead of slowing down the commentary. Silence
+    is sent between commentaries, so that players do not time out.
+    """
+
+    name = "http"
+    WAV_PATH = "/stream.wav"
+    PCM_PATH = "/stream.pcm"
+    KEEP_ALIVE_SECONDS = 0.5
+    """
+    Duration of the silence sent whenever no audio was sent for as long
+    """
+
+    def __init__(self, sample_rate: int, host: str, port: int, buffer_seconds: float, max_listeners: int):
+        """
+        :param sample_rate: Sample rate of the audio
+        :param host: Interface the stream is served on
+        :param port: Port the stream is served on
+        :param buffer_seconds: Maximum amount of audio waiting to be sent to a listener before it is disconnected
+        :param max_listeners: Maximum number of listeners connected at the same time
+        """
+        super().__init__(sample_rate=sample_rate)
+        self.host = host
+        self.port = port
+        self.buffer_samples = int(buffer_seconds * sample_rate)
+        self.max_listeners = max_listeners
+
+        self._silence = np.zeros(int(self.KEEP_ALIVE_SECONDS * sample_rate), dtype=np.int16)
+        self._listeners: list[_StreamListener] = []
+        self._lock = threading.Lock()
+        self._http_server: ThreadingHTTPServer | None = None
+        self._thread: threading.Thread | None = None
+
+    @property
+    def listener_count(self) -> int:
+        with self._lock:
+            return len(self._listeners)
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._http_server = ThreadingHTTPServer((self.host, self.port), self._create_request_handler())
+        self._http_server.daemon_threads = True
+        self._thread = threading.Thread(target=self._http_server.serve_forever, name="audio-stream", daemon=True)
+        self._thread.start()
+        global_logger.info(f"Streaming audio on http://{self.host}:{self.port}{self.WAV_PATH}")
+
+    def write(self, samples: np.ndarray) -> None:
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            if not listener.queue.put(samples):
+                global_logger.warning("Audio listener too slow, disconnecting it")
+                AUDIO_SINK_DROPS.inc(sink=self.name)
+                self._disconnect(listener)
+
+    def interrupt(self) -> None:
+        with self._lock:
+            for listener in self._listeners:
+                listener.queue.clear()
+
+    def close(self) -> None:
+        """
+        Ends the streams, giving listeners a moment to receive the end of the response, then stops the server
+        """
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener.closed_event.set()
+        deadline = time.monotonic() + 2 * self.KEEP_ALIVE_SECONDS
+        while self.listener_count and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            self._disconnect(listener)
+        if self._http_server:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def get_wav_header(self) -> bytes:
+        """
+        :return: Header of a WAV file of unknown length, with the sizes set to their maximum as is usual for streams
+        """
+        byte_rate = self.sample_rate * 2
+        return (
+            b"RIFF"
+            + struct.pack("<I", 0xFFFFFFFF)
+            + b"WAVEfmt "
+            + struct.pack("<IHHIIHH", 16, 1, 1, self.sample_rate, byte_rate, 2, 16)
+            + b"data"
+            + struct.pack("<I", 0xFFFFFFFF)
+        )
+
+    def _add_listener(self, connection: socket.socket) -> _StreamListener | None:
+        """
+        :return: New listener, None if there are too many listeners already
+        """
+        with self._lock:
+            if len(self._listeners) >= self.max_listeners:
+                return None
+            listener = _StreamListener(connection=connection, capacity_samples=self.buffer_samples)
+            self._listeners.append(listener)
+            return listener
+
+    def _disconnect(self, listener: _StreamListener) -> None:
+        """
+        Stops sending audio to a listener. Its connection is shut down, so that a write blocked on a slow client fails
+        """
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+        listener.closed_event.set()
+        listener.queue.clear()
+        try:
+            listener.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _stream_to(self, listener: _StreamListener, write_chunk) -> None:
+        """
+        Sends the audio queued for a listener until it is disconnected. Runs on the thread of its request
+        :param listener: Listener to send the audio to
+        :param write_chunk: Writes a chunk of the response
+        """
+        last_write_time = time.monotonic()
+        while not listener.closed_event.is_set():
+            samples = listener.queue.get(timeout=self.KEEP_ALIVE_SECONDS)
+            if samples is None:
+                if time.monotonic() - last_write_time < self.KEEP_ALIVE_SECONDS:
+                    continue
+                samples = self._silence
+            if listener.closed_event.is_set():
+                break
+            write_chunk(memoryview(samples).cast("B"))
+            last_write_time = time.monotonic()
+
+    def _create_request_handler(self) -> type[BaseHTTPRequestHandler]:
+        """
+        :return: Handler of the HTTP requests, streaming the audio on WAV_PATH and PCM_PATH
+        """
+        sink = self
+
+        class AudioStreamRequestHandler(BaseHTTPRequestHandler):
+            # Chunked transfer encoding requires HTTP/1.1
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self) -> None:
+                path = self.path.split("?")[0]
+                if path not in (sink.WAV_PATH, sink.PCM_PATH):
+                    self.send_error(404)
+                    return
+                listener = sink._add_listener(connection=self.connection)
+                if listener is None:
+                    self.send_error(503, "Too many listeners")
+                    return
+                self.close_connection = True
+                global_logger.info(f"Audio listener connected from {self.client_address[0]}")
+                try:
+                    self.send_response(200)
+                    is_wav = path == sink.WAV_PATH
+                    self.send_header("Content-Type", "audio/wav" if is_wav else "application/octet-stream")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.send_header("Cache-Control", "no-cache")
+                    self.end_headers()
+                    if is_wav:
+                        self.write_chunk(sink.get_wav_header())
+                    sink._stream_to(listener=listener, write_chunk=self.write_chunk)
+                    self.wfile.write(b"0\r\n\r\n")
+                except OSError:
+                    pass
+                finally:
+                    sink._disconnect(listener)
+                    global_logger.info(f"Audio listener disconnected from {self.client_address[0]}")
+
+            def write_chunk(self, data: bytes | memoryview) -> None:
+                self.wfile.write(f"{len(data):X}\r\n".encode("ascii"))
+                self.wfile.write(data)
+                self.wfile.write(b"\r\n")
+
+            def log_message(self, format: str, *args) -> None:
+                # Connections are logged by do_GET
+                pass
+
+        return AudioStreamRequestHandler
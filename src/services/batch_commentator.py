@@ -0,0 +1,318 @@
+import re
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Sequence, TextIO
+
+import chess
+import chess.pgn
+
+from conf.settings import settings
+from entities.entities import MessageTypeEnum, PlayedMove, PositionUpdateKindEnum
+from services.commentary_cache import CommentaryCache, create_commentary_cache
+from services.llm_backend import LLMBackend, create_llm_backend
+from services.llm_manager import LLMManager
+from services.message_parser import MessageParser
+from services.position_features import extract_position_features
+from services.position_tracker import PositionTracker
+from services.replay import DumpReplayer
+from services.speech_synthesizer import SpeechSynthesizer, create_speech_synthesizer
+from utils.logger import global_logger
+from utils.rate_limiter import RateLimiter
+from utils.text import split_sentences
+
+PGN_SUFFIX = ".pgn"
+GAME_HEADERS = ("Event", "Site", "Date", "Round", "White", "Black", "ECO", "Opening")
+
+
+def read_pgn_games(pgn_file_path: Path) -> Iterator[chess.pgn.Game]:
+    """
+    Reads all the games of a PGN file
+    :param pgn_file_path: Path of the PGN file
+    :return: Iterator over the games
+    """
+    with open(pgn_file_path, "r", encoding="utf-8") as pgn_file:
+        while (game := chess.pgn.read_game(pgn_file)) is not None:
+            if game.errors:
+                global_logger.warning(f"Game {game.headers.get('Round')} of {pgn_file_path} has errors: {game.errors}")
+            yield game
+
+
+def read_dump_games(dump_file_path: Path) -> list[chess.pgn.Game]:
+    """
+    Rebuilds the games of a dump from its `pgn` frames. Every frame only carries the latest moves, so a game starts at
+    the first position received for it and is followed with a position tracker, catching up on missed frames
+    :param dump_file_path: Path of the dump file, compressed or not
+    :return: Games of the dump, in order of first appearance
+    """
+    message_parser = MessageParser()
+    games: list[chess.pgn.Game] = []
+    position_trackers: dict[str, PositionTracker] = {}
+    # Last node and position of the game of every round, None once moves of the game were missed
+    game_ends: dict[str, tuple[chess.pgn.GameNode, chess.Board] | None] = {}
+
+    for _, message in DumpReplayer.iter_records(dump_file_path):
+        if not message.startswith(MessageTypeEnum.ChessInformationMessageType):
+            continue
+        if message_parser.peek_event_name(message) != "pgn":
+            continue
+        game_data = message_parser.parse_game_data(message)
+        if not game_data or not game_data.get("Moves"):
+            continue
+
+        headers = game_data["Headers"]
+        game_round = str(headers["Round"])
+        moves = [PlayedMove(san=move_data["m"], fen_position=move_data["fen"]) for move_data in game_data["Moves"]]
+        position_tracker = position_trackers.setdefault(game_round, PositionTracker())
+        update = position_tracker.update(fen_position=moves[-1].fen_position, last_move=moves[-1].san, moves=moves)
+
+        if update.kind in (PositionUpdateKindEnum.Initial, PositionUpdateKindEnum.NewGame):
+            game = chess.pgn.Game()
+            game.setup(position_tracker.board)
+            for header in GAME_HEADERS:
+                if headers.get(header):
+                    game.headers[header] = str(headers[header])
+            games.append(game)
+            game_ends[game_round] = (game, position_tracker.board.copy(stack=False))
+        elif update.kind == PositionUpdateKindEnum.Moves and game_ends.get(game_round):
+            node, board = game_ends[game_round]
+            for san in update.skipped_moves:
+                node = node.add_main_variation(board.push_san(san))
+            node = node.add_main_variation(update.move)
+            board.push(update.move)
+            game_ends[game_round] = (node, board)
+        elif update.kind == PositionUpdateKindEnum.Resync and game_ends.get(game_round):
+            _, board = game_ends[game_round]
+            global_logger.warning(
+                f"Moves of game {game_round} are missing, it is only kept until move {board.fullmove_number}"
+            )
+            game_ends[game_round] = None
+    return games
+
+
+def read_games(file_path: Path) -> list[chess.pgn.Game]:
+    """
+    Reads the games of a PGN file, or rebuilds them from a dump of received messages
+    :param file_path: Path of a PGN file, recognised by its suffix, or of a dump
+    :return: Games of the file
+    """
+    file_path = Path(file_path)
+    if file_path.suffix.lower() == PGN_SUFFIX:
+        return list(read_pgn_games(file_path))
+    return read_dump_games(file_path)
+
+
+@dataclass
+class BatchSummary:
+    game_count: int = 0
+    failed_game_count: int = 0
+    commentary_count: int = 0
+    audio_seconds: float = 0.0
+    elapsed_seconds: float = 0.0
+
+    @property
+    def throughput_games_per_hour(self) -> float:
+        return self.game_count * 3600 / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+    def format(self) -> str:
+        """
+        :return: Human readable summary of the batch
+        """
+        return (
+            f"Commentated {self.game_count} games in {self.elapsed_seconds:.1f} s "
+            f"({self.throughput_games_per_hour:.1f} games/hour), {self.failed_game_count} failed. "
+            f"{self.commentary_count} commentaries, {self.audio_seconds / 60:.1f} min of audio"
+        )
+
+
+@dataclass
+class GameCommentary:
+    commentary_count: int = 0
+    audio_seconds: float = 0.0
+
+
+class BatchCommentator:
+    """
+    Commentates finished games offline, e.g. for post-event highlights. Games are commentated concurrently, each one
+    with its own chat history and its moves commentated in order, so that its context is the same as when commentated
+    live. All the LLM requests of the games, chat history summaries included, share the rate limit of the LLM backend.
+    The commentary of every game is written to a transcript and, unless in SILENT_MODE, rendered to a WAV file without
+    going through any audio device.
+    """
+
+    PAUSE_SECONDS = 0.6
+    """
+    Silence between two commentaries in the rendered audio
+    """
+
+    def __init__(
+        self,
+        llm_backend: LLMBackend,
+        output_dir_path: Path,
+        max_concurrent_games: int,
+        speech_synthesizer: SpeechSynthesizer | None = None,
+        commentary_cache: CommentaryCache | None = None,
+    ):
+        """
+        :param llm_backend: Backend shared by all games, bounding the number of requests in flight and their rate
+        :param output_dir_path: Directory the transcripts and audio files are written to
+        :param max_concurrent_games: Number of games commentated at the same time
+        :param speech_synthesizer: Synthesizer rendering the commentary. Only transcripts are written if None
+        :param commentary_cache: Cache of move commentary shared by all games, closed with the batch commentator
+        """
+        self.llm_backend = llm_backend
+        self.output_dir_path = Path(output_dir_path)
+        self.max_concurrent_games = max_concurrent_games
+        self.speech_synthesizer = speech_synthesizer
+        self.commentary_cache = commentary_cache
+        self._summary_executor = ThreadPoolExecutor(max_workers=max_concurrent_games, thread_name_prefix="chat-summary")
+
+    def commentate_games(self, games: Sequence[chess.pgn.Game]) -> BatchSummary:
+        """
+        Commentates all the games, and writes their commentary to the output directory
+        :param games: Games to commentate
+        :return: Throughput summary of the batch
+        """
+        self.output_dir_path.mkdir(parents=True, exist_ok=True)
+        summary = BatchSummary()
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_games, thread_name_prefix="batch-game") as executor:
+            futures = [
+                executor.submit(self._commentate_game, game=game, file_stem=self._get_file_stem(index=index, game=game))
+                for index, game in enumerate(games)
+            ]
+            for game, future in zip(games, futures):
+                try:
+                    game_commentary = future.result()
+                except Exception:
+                    global_logger.exception(f"Failed to commentate game {game.headers.get('Round')}")
+                    summary.failed_game_count += 1
+                    continue
+                summary.game_count += 1
+                summary.commentary_count += game_commentary.commentary_count
+                summary.audio_seconds += game_commentary.audio_seconds
+        summary.elapsed_seconds = time.perf_counter() - start_time
+        return summary
+
+    def close(self) -> None:
+        self._summary_executor.shutdown(wait=True, cancel_futures=True)
+        if self.speech_synthesizer:
+            self.speech_synthesizer.close()
+        if self.commentary_cache:
+            self.commentary_cache.close()
+        self.llm_backend.close()
+
+    def _commentate_game(self, game: chess.pgn.Game, file_stem: str) -> GameCommentary:
+        """
+        Commentates the initial position and every move of a game, in order. Runs on the executor
+        :param game: Game to commentate
+        :param file_stem: Name of the output files of the game, without suffix
+        :return: Amount of commentary of the game
+        """
+        llm_manager = LLMManager(
+            llm_backend=self.llm_backend,
+            commentary_cache=self.commentary_cache,
+            summary_executor=self._summary_executor,
+        )
+        headers = game.headers
+        opening = " ".join(filter(None, (headers.get("ECO"), headers.get("Opening")))) or None
+        board = game.board()
+        game_commentary = GameCommentary()
+
+        transcript_file_path = self.output_dir_path / f"{file_stem}.txt"
+        audio_file = None
+        if self.speech_synthesizer:
+            audio_file = wave.open(str(self.output_dir_path / f"{file_stem}.wav"), "wb")
+            audio_file.setnchannels(1)
+            audio_file.setsampwidth(2)
+            audio_file.setframerate(self.speech_synthesizer.sample_rate)
+        try:
+            with open(transcript_file_path, "w", encoding="utf-8") as transcript_file:
+                message = llm_manager.generate_new_game_commentating_message(
+                    fen_position=board.fen(),
+                    black_name=headers.get("Black", "?"),
+                    white_name=headers.get("White", "?"),
+                    opening=opening,
+                )
+                self._write_commentary(
+                    message=message,
+                    label=headers.get("Round", ""),
+                    transcript_file=transcript_file,
+                    audio_file=audio_file,
+                    game_commentary=game_commentary,
+                )
+                for move in game.mainline_moves():
+                    position_features = extract_position_features(board_before=board, move=move, opening=opening)
+                    last_move = board.san(move)
+                    board.push(move)
+                    message = llm_manager.generate_commentating_message(
+                        fen_position=board.fen(), last_move=last_move, position_facts=position_features.format()
+                    )
+                    self._write_commentary(
+                        message=message,
+                        label=position_features.move_label,
+                        transcript_file=transcript_file,
+                        audio_file=audio_file,
+                        game_commentary=game_commentary,
+                    )
+        finally:
+            llm_manager.close()
+            if audio_file:
+                audio_file.close()
+        global_logger.info(f"Commentated game {headers.get('Round')} to {transcript_file_path}")
+        return game_commentary
+
+    def _write_commentary(
+        self,
+        message: str,
+        label: str,
+        transcript_file: TextIO,
+        audio_file: wave.Wave_write | None,
+        game_commentary: GameCommentary,
+    ) -> None:
+        """
+        Appends a commentary to the transcript and to the audio of a game
+        :param message: Commentary. Skipped if empty, when no response was received in time
+        :param label: Move or position the commentary is about, written in the transcript
+        :param transcript_file: Transcript of the game
+        :param audio_file: Audio of the game, if rendered
+        :param game_commentary: Amount of commentary of the game, updated
+        """
+        if not message:
+            return
+        transcript_file.write(f"{label}: {message}\n")
+        game_commentary.commentary_count += 1
+        if audio_file is None:
+            return
+        for audio in self.speech_synthesizer.synthesize(split_sentences([message])):
+            audio_file.writeframes(audio)
+        audio_file.writeframes(bytes(int(self.PAUSE_SECONDS * self.speech_synthesizer.sample_rate) * 2))
+        game_commentary.audio_seconds = audio_file.tell() / self.speech_synthesizer.sample_rate
+
+    @staticmethod
+    def _get_file_stem(index: int, game: chess.pgn.Game) -> str:
+        """
+        :return: Name of the output files of a game, unique within the batch
+        """
+        headers = game.headers
+        name = f"{headers.get('Round', '')}_{headers.get('White', '')}_vs_{headers.get('Black', '')}"
+        return f"{index + 1:03d}_" + re.sub(r"[^A-Za-z0-9.-]+", "_", name).strip("_")
+
+
+def create_batch_commentator(output_dir_path: Path) -> BatchCommentator:
+    """
+    Creates the batch commentator according to the settings. Audio is rendered unless in SILENT_MODE
+    :param output_dir_path: Directory the commentary is written to
+    :return: Batch commentator
+    """
+    return BatchCommentator(
+        llm_backend=create_llm_backend(
+            rate_limiter=RateLimiter(max_calls_per_minute=settings.BATCH_MAX_REQUESTS_PER_MINUTE)
+        ),
+        output_dir_path=output_dir_path,
+        max_concurrent_games=settings.BATCH_MAX_CONCURRENT_GAMES,
+        speech_synthesizer=None if settings.SILENT_MODE else create_speech_synthesizer(),
+        commentary_cache=create_commentary_cache(),
+    )
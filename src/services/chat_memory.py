@@ -0,0 +1,170 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from langchain_core.prompts import PromptTemplate
+
+from services.llm_backend import LLMBackend, LLMCancelledError
+from utils.logger import global_logger
+
+
+class SummarizingChatMemory:
+    """
+    Chat history with a bounded size. The last turns are kept verbatim, while older turns are folded into a rolling
+    summary that is regenerated in the background, so that the prompt size stays roughly constant over long sessions.
+    A turn is a user message followed by the replies of the assistant to it.
+    """
+
+    SUMMARY_PROMPT = PromptTemplate.from_template(
+        "You are helping a chess commentator keep track of a long commentary session. Update the summary of the "
+        "commentary so far with the new messages below. Keep the names of the players, the current game, the key "
+        "moves and how the evaluation evolved. Answer with the updated summary only, in at most {max_summary_words} "
+        "words.\n\n"
+        "Current summary:\n{summary}\n\nNew messages:\n{new_messages}",
+        input_types={"max_summary_words": int, "summary": str, "new_messages": str},
+    )
+    SUMMARY_MESSAGE_PREFIX = "Summary of the commentary so far: "
+    MAX_SUMMARY_WORDS = 150
+
+    def __init__(
+        self,
+        llm_backend: LLMBackend,
+        max_verbatim_turns: int,
+        summary_executor: ThreadPoolExecutor | None = None,
+    ):
+        """
+        :param llm_backend: Backend generating the summaries
+        :param max_verbatim_turns: Number of last turns kept verbatim
+        :param summary_executor: Executor generating the summaries in the background, shared with other chat histories
+        and not shut down by this one. A single thread of its own is used if None
+        """
+        self.llm_backend = llm_backend
+        self.max_verbatim_turns = max_verbatim_turns
+
+        self.summary = ""
+        self._turns: list[list[BaseMessage]] = []
+        self._messages_to_summarize: list[BaseMessage] = []
+        self._lock = threading.Lock()
+        # Incremented on every clear and on close, so that summaries of a previous game are cancelled or discarded
+        self._generation = 0
+        self._is_closed = False
+        self._owns_summary_executor = summary_executor is None
+        self._summary_executor = summary_executor or ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="chat-summary"
+        )
+        self._summary_in_progress = False
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        """
+        Messages to send to the LLM: the rolling summary, if any, followed by the verbatim turns
+        """
+        with self._lock:
+            messages = [message for turn in self._turns for message in turn]
+            if self.summary:
+                messages.insert(0, SystemMessage(content=self.SUMMARY_MESSAGE_PREFIX + self.summary))
+            return messages
+
+    def add_user_message(self, message: str) -> None:
+        """
+        Starts a new turn with the given user message, evicting the oldest turn if there are too many
+        :param message: Content of the user message
+        """
+        with self._lock:
+            self._turns.append([HumanMessage(content=message)])
+            while len(self._turns) > self.max_verbatim_turns:
+                self._messages_to_summarize.extend(self._turns.pop(0))
+        self._schedule_summary()
+
+    def add_ai_message(self, message: str) -> None:
+        """
+        Adds a reply of the assistant to the current turn
+        :param message: Content of the assistant message
+        """
+        with self._lock:
+            if not self._turns:
+                self._turns.append([])
+            self._turns[-1].append(AIMessage(content=message))
+
+    def clear(self) -> None:
+        """
+        Forgets all turns and the summary. Summaries still being generated are discarded
+        """
+        with self._lock:
+            self.summary = ""
+            self._turns = []
+            self._messages_to_summarize = []
+            self._generation += 1
+
+    def close(self) -> None:
+        """
+        Stops summarizing. Summaries still being generated are cancelled and their results discarded
+        """
+        with self._lock:
+            self._generation += 1
+            self._is_closed = True
+        if self._owns_summary_executor:
+            self._summary_executor.shutdown(wait=False, cancel_futures=True)
+
+    def count_tokens(self, messages: list[BaseMessage] | None = None) -> int:
+        """
+        Counts the tokens of a list of messages with the tokenizer of the model
+        :param messages: Messages to count. If None, counts the messages currently in memory
+        :return: Number of tokens
+        """
+        return self.llm_backend.count_tokens(self.messages if messages is None else messages)
+
+    def _schedule_summary(self) -> None:
+        """
+        Starts regenerating the summary in the background if there are evicted messages and no summary is in progress
+        """
+        with self._lock:
+            if self._is_closed or self._summary_in_progress or not self._messages_to_summarize:
+                return
+            self._summary_in_progress = True
+            generation = self._generation
+            summary = self.summary
+            messages_to_summarize = self._messages_to_summarize
+            self._messages_to_summarize = []
+        self._summary_executor.submit(self._update_summary, generation, summary, messages_to_summarize)
+
+    def _update_summary(self, generation: int, summary: str, messages_to_summarize: list[BaseMessage]) -> None:
+        """
+        Folds evicted messages into the rolling summary. Runs on the background summary thread
+        :param generation: Generation of the memory when the summary was scheduled
+        :param summary: Summary at the moment the update was scheduled
+        :param messages_to_summarize: Evicted messages to fold into the summary
+        """
+        try:
+            new_messages = "\n".join(f"{message.type}: {message.content}" for message in messages_to_summarize)
+            response = self.llm_backend.invoke(
+                [
+                    HumanMessage(
+                        content=self.SUMMARY_PROMPT.format(
+                            max_summary_words=self.MAX_SUMMARY_WORDS, summary=summary or "-", new_messages=new_messages
+                        )
+                    )
+                ],
+                is_cancelled=lambda: generation != self._generation,
+            )
+        except LLMCancelledError:
+            # Only summaries of a cleared or closed chat history are cancelled, their messages are not needed anymore
+            with self._lock:
+                self._summary_in_progress = False
+            self._schedule_summary()
+            return
+        except Exception:
+            global_logger.exception("Failed to update the chat history summary")
+            with self._lock:
+                # Put the messages back in line, they will be summarized together with the next evicted turn
+                if generation == self._generation:
+                    self._messages_to_summarize = messages_to_summarize + self._messages_to_summarize
+                self._summary_in_progress = False
+            return
+
+        with self._lock:
+            if generation == self._generation:
+                self.summary = response
+            self._summary_in_progress = False
+        # Turns may have been evicted while the summary was being generated
+        self._schedule_summary()
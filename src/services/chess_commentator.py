@@ -1,29 +1,103 @@
-import datetime
-
-import chess
-import numpy as np
-import sounddevice
-from piper import PiperVoice
+import itertools
+import threading
+import time
+from typing import Iterable, Iterator, Sequence
 
 from conf.settings import settings
-from entities.types import FenPosition
+from entities.entities import CommentaryPriorityEnum, EvalCommentaryReasonEnum, PlayedMove, PositionUpdateKindEnum
+from entities.types import FenPosition, GameKey
+from services.audio_player import AudioPlayer, create_audio_player
+from services.commentary_cache import CommentaryCache, create_commentary_cache
+from services.commentary_scheduler import CommentaryJob, CommentaryScheduler
+from services.commentary_speculator import CommentarySpeculator, PreparedCommentary
+from services.eval_tracker import EvalCommentaryTrigger, EvalTracker
 from services.llm_manager import LLMManager
+from services.position_features import extract_position_features, get_first_move, truncate_best_line
+from services.position_tracker import PositionTracker
+from services.speech_synthesizer import SpeechSynthesizer, create_speech_synthesizer
 from utils.logger import global_logger
+from utils.metrics import COMMENTARY_PREEMPTIONS, MOVE_TO_SPEECH_LATENCY
+from utils.text import split_sentences
 
 
 class ChessCommentator:
-    COMMENTARY_VOICE = PiperVoice.load(settings.VOICE_MODEL_FILE_LOCATION)
-    EVALUATION_COMMENTARY_COOLDOWN_MINUTES = 10
+    DEFAULT_GAME_KEY = "current"
 
-    def __init__(self):
-        self.current_position = None
-        self.llm_manager = LLMManager()
-        self.time_last_spoken_eval = datetime.datetime.min
+    def __init__(
+        self,
+        llm_manager: LLMManager | None = None,
+        speech_synthesizer: SpeechSynthesizer | None = None,
+        audio_player: AudioPlayer | None = None,
+        speech_lock: "threading.Lock | None" = None,
+        commentary_scheduler: CommentaryScheduler | None = None,
+        game_key: GameKey = DEFAULT_GAME_KEY,
+        commentary_speculator: CommentarySpeculator | None = None,
+    ):
+        """
+        Resources not provided are created by the commentator itself. They are provided when several commentators,
+        one per game, share them
+        :param llm_manager: Manager of the LLM, holding the chat history of the game
+        :param speech_synthesizer: Synthesizer of the commentary, with its voices possibly still loading. Unused in
+        SILENT_MODE
+        :param audio_player: Player the commentary is queued on. Unused in SILENT_MODE
+        :param speech_lock: Held while the audio of a commentary is queued, so that commentaries of different games
+        sharing the audio player are not interleaved
+        :param commentary_scheduler: Scheduler deciding which commentary is preempted, shared by the commentators of
+        all games
+        :param game_key: Game commentated
+        :param commentary_speculator: If provided, the commentary of the moves predicted by the engines is prepared
+        before they are played
+        """
+        self.game_key = game_key
+        self.commentary_speculator = commentary_speculator
+        self.opening = None
+        self.position_tracker = PositionTracker()
+        self._owned_commentary_cache: CommentaryCache | None = None
+        self._owns_llm_manager = llm_manager is None
+        if llm_manager is None:
+            self._owned_commentary_cache = create_commentary_cache()
+            llm_manager = LLMManager(
+                is_stale=lambda: self.commentary_scheduler.is_stale(self.game_key),
+                commentary_cache=self._owned_commentary_cache,
+            )
+        self.llm_manager = llm_manager
+        self.eval_tracker = EvalTracker(
+            swing_threshold_pawns=settings.EVAL_SWING_THRESHOLD_PAWNS,
+            swing_threshold_score=settings.EVAL_SWING_THRESHOLD_SCORE,
+            disagreement_threshold_pawns=settings.EVAL_DISAGREEMENT_THRESHOLD_PAWNS,
+            min_depth=settings.EVAL_MIN_DEPTH,
+            coalescing_window_seconds=settings.EVAL_COALESCING_WINDOW_SECONDS,
+            min_interval_seconds=settings.EVAL_COMMENTARY_MIN_INTERVAL_SECONDS,
+        )
 
         self.startup_has_happened = False
+        self.speech_lock = speech_lock or threading.Lock()
+
+        self.speech_synthesizer = None
+        self.audio_player = None
+        self._owns_speech_synthesizer = False
+        if not settings.SILENT_MODE:
+            self.speech_synthesizer = speech_synthesizer
+            if self.speech_synthesizer is None:
+                self.speech_synthesizer = create_speech_synthesizer()
+                self._owns_speech_synthesizer = True
+            self.audio_player = audio_player
+            if self.audio_player is None:
+                self.audio_player = create_audio_player(sample_rate=self.speech_synthesizer.sample_rate)
+                self.audio_player.start()
+        self.commentary_scheduler = commentary_scheduler or CommentaryScheduler(
+            max_staleness_seconds=settings.COMMENTARY_MAX_STALENESS_SECONDS, audio_player=self.audio_player
+        )
 
     def process_position_data(
-        self, fen_position: FenPosition, last_move: str, black_name: str, white_name: str
+        self,
+        fen_position: FenPosition,
+        last_move: str,
+        black_name: str,
+        white_name: str,
+        opening: str | None = None,
+        received_time: float | None = None,
+        moves: Sequence[PlayedMove] = (),
     ) -> None:
         """
         Handles main logic on commentating on received main data.
@@ -31,95 +105,304 @@ class ChessCommentator:
         :param last_move: Last move of the board
         :param black_name: Name of the player with the black pieces
         :param white_name: Name of the player with the white pieces
+        :param opening: Name of the opening, if known
+        :param received_time: Monotonic time at which the position was received, to measure the move to speech latency
+        and skip the commentary once too old
+        :param moves: Latest moves of the game, in chronological order, used to catch up on missed positions
         """
-        received_board_position = chess.Board(fen=fen_position)
+        update = self.position_tracker.update(fen_position=fen_position, last_move=last_move, moves=moves)
 
-        if not self.current_position:
-            self._commentate_startup(
-                fen_position=fen_position, last_move=last_move, black_name=black_name, white_name=white_name
-            )
-            self.startup_has_happened = True
+        if update.kind == PositionUpdateKindEnum.Duplicate:
             return
-
-        if self.current_position == received_board_position:
+        self.opening = opening
+        prepared_commentary = None
+        if self.commentary_speculator:
+            if update.kind == PositionUpdateKindEnum.Moves and not update.skipped_moves:
+                prepared_commentary = self.commentary_speculator.take(
+                    board_before=update.board_before, move=update.move
+                )
+            else:
+                self.commentary_speculator.discard()
+        is_new_game = update.kind in (PositionUpdateKindEnum.Initial, PositionUpdateKindEnum.NewGame)
+        # The position is tracked even if its commentary is skipped, so that the next move can still be commentated
+        job = self._start_job(
+            priority=CommentaryPriorityEnum.NewGame if is_new_game else CommentaryPriorityEnum.Move,
+            received_time=received_time,
+        )
+        if job is None:
+            self.startup_has_happened = True
             return
+        try:
+            if update.kind == PositionUpdateKindEnum.Initial:
+                self._commentate_startup(
+                    fen_position=fen_position, black_name=black_name, white_name=white_name, opening=opening, job=job
+                )
+            elif update.kind == PositionUpdateKindEnum.NewGame:
+                self._commentate_new_game(
+                    fen_position=fen_position, black_name=black_name, white_name=white_name, opening=opening, job=job
+                )
+            elif prepared_commentary is not None:
+                self._commentate_prepared(prepared_commentary=prepared_commentary, job=job)
+            elif update.move is not None:
+                position_facts = extract_position_features(
+                    board_before=update.board_before, move=update.move, opening=opening
+                ).format()
+                if update.skipped_moves:
+                    skipped_moves = " ".join(update.skipped_moves)
+                    position_facts = f"Also played since the last commentary: {skipped_moves}. {position_facts}"
+                self._commentate(
+                    fen_position=fen_position,
+                    last_move=update.board_before.san(update.move),
+                    position_facts=position_facts,
+                    job=job,
+                )
+        finally:
+            self.startup_has_happened = True
+            self.commentary_scheduler.finish_job(job)
 
-        san_received_move = self.current_position.parse_san(last_move)
-        if san_received_move not in self.current_position.legal_moves:
-            self._commentate_new_game(fen_position=fen_position, black_name=black_name, white_name=white_name)
-        else:
-            self._commentate(fen_position=fen_position, last_move=last_move)
-
-        self.current_position = received_board_position
-
-    def process_position_evaluation_data(self, engine_name: str, position_evaluation: str, best_line: str) -> None:
+    def process_position_evaluation_data(
+        self,
+        engine_name: str,
+        position_evaluation: str,
+        best_line: str,
+        game_key: GameKey = DEFAULT_GAME_KEY,
+        wdl: str | None = None,
+        depth: str | None = None,
+        received_time: float | None = None,
+    ) -> None:
         """
         Handles logic of commentating on new received position evaluation. Since evaluation data comes very often, it
-        will only be vocalized after a timeout
+        is only vocalized when the evaluation changes significantly or the engines disagree with each other
         :param engine_name: Name of the engine that provides the evaluation
         :param position_evaluation: Evaluation of the position
         :param best_line: Best line proposed by the evaluating engine
+        :param game_key: Game the evaluation refers to
+        :param wdl: Win/draw/loss triplet, if provided by the engine
+        :param depth: Search depth, if provided by the engine
+        :param received_time: Monotonic time at which the evaluation was received, to skip it once too old
         """
-        if self.startup_has_happened and datetime.datetime.now() - self.time_last_spoken_eval > datetime.timedelta(
-            minutes=self.EVALUATION_COMMENTARY_COOLDOWN_MINUTES
-        ):
-            self._commentate_eval_data(
-                engine_name=engine_name, position_evaluation=position_evaluation, best_line=best_line
-            )
-            self.time_last_spoken_eval = datetime.datetime.now()
+        trigger = self.eval_tracker.add_evaluation(
+            game_key=game_key,
+            engine_name=engine_name,
+            position_evaluation=position_evaluation,
+            best_line=best_line,
+            wdl=wdl,
+            depth=depth,
+        )
+        if self.commentary_speculator and self.position_tracker.board is not None:
+            predicted_move = get_first_move(best_line)
+            if predicted_move:
+                self.commentary_speculator.speculate(
+                    board=self.position_tracker.board, san_move=predicted_move, opening=self.opening
+                )
+        if not self.startup_has_happened or not trigger:
+            return
+        job = self._start_job(priority=CommentaryPriorityEnum.Evaluation, received_time=received_time)
+        if job is None:
+            return
+        try:
+            self._commentate_eval_data(trigger=trigger, job=job)
+        finally:
+            self.commentary_scheduler.finish_job(job)
 
-    def _commentate_startup(self, fen_position: str, last_move: str, black_name: str, white_name: str) -> None:
+    def _start_job(self, priority: CommentaryPriorityEnum, received_time: float | None) -> CommentaryJob | None:
+        """
+        Starts the job of a commentary, unless the message is already too old to be worth commentating
+        :param priority: Urgency of the commentary
+        :param received_time: Monotonic time at which the commentated message was received, if known
+        :return: Job of the commentary, or None if it is skipped
+        """
+        job = self.commentary_scheduler.start_job(
+            game_key=self.game_key, priority=priority, received_time=received_time
+        )
+        if job.is_stale():
+            global_logger.info(f"Skipping {priority.name} commentary of game {self.game_key}, it is too old")
+            COMMENTARY_PREEMPTIONS.inc(action="expired")
+            self.commentary_scheduler.finish_job(job)
+            return None
+        return job
+
+    def _commentate_startup(
+        self, fen_position: str, black_name: str, white_name: str, opening: str | None, job: CommentaryJob
+    ) -> None:
         """
         Gets commentary message at startup and vocalizes it
         """
         message = self.llm_manager.generate_startup_commentating_message(
-            fen_position=fen_position, last_move=last_move, black_name=black_name, white_name=white_name
+            fen_position=fen_position,
+            black_name=black_name,
+            white_name=white_name,
+            opening=opening,
+            stream=settings.STREAM_COMMENTARY,
         )
-        self._vocalize_commentary(message=message)
+        self._vocalize_commentary(message=message, job=job)
 
-    def _commentate_new_game(self, fen_position: FenPosition, black_name: str, white_name: str) -> None:
+    def _commentate_new_game(
+        self,
+        fen_position: FenPosition,
+        black_name: str,
+        white_name: str,
+        opening: str | None,
+        job: CommentaryJob,
+    ) -> None:
         """
         Gets commentary message when a new game starts and vocalizes it
         """
         message = self.llm_manager.generate_new_game_commentating_message(
-            fen_position=fen_position, black_name=black_name, white_name=white_name
+            fen_position=fen_position,
+            black_name=black_name,
+            white_name=white_name,
+            opening=opening,
+            stream=settings.STREAM_COMMENTARY,
         )
-        self._vocalize_commentary(message=message)
+        self._vocalize_commentary(message=message, job=job)
 
-    def _commentate(self, fen_position: FenPosition, last_move: str) -> None:
+    def _commentate(
+        self, fen_position: FenPosition, last_move: str, position_facts: str, job: CommentaryJob
+    ) -> None:
         """
         Gets commentary message on a new move and vocalizes it
         """
-        message = self.llm_manager.generate_commentating_message(fen_position=fen_position, last_move=last_move)
-        self._vocalize_commentary(message=message)
+        message = self.llm_manager.generate_commentating_message(
+            fen_position=fen_position,
+            last_move=last_move,
+            position_facts=position_facts,
+            stream=settings.STREAM_COMMENTARY,
+        )
+        self._vocalize_commentary(message=message, job=job)
 
-    def _commentate_eval_data(self, engine_name: str, position_evaluation: str, best_line: str) -> None:
+    def _commentate_prepared(self, prepared_commentary: PreparedCommentary, job: CommentaryJob) -> None:
         """
-        Gets commentary message on new eval data and vocalizes it.
+        Vocalizes the commentary prepared for a predicted move, which was just played
         """
-        message = self.llm_manager.generate_eval_commentating_message(
-            engine_name=engine_name, position_evaluation=position_evaluation, best_line=best_line
+        self.llm_manager.add_prepared_message(prepared_commentary.prepared_message)
+        self._vocalize_commentary(
+            message=prepared_commentary.prepared_message.message, job=job, audio=prepared_commentary.audio
         )
-        self._vocalize_commentary(message=message)
 
-    @classmethod
-    def _vocalize_commentary(cls, message: str) -> None:
+    def _commentate_eval_data(self, trigger: EvalCommentaryTrigger, job: CommentaryJob) -> None:
         """
-        Takes the commentary and speaks it out loud. If environment is set to SILENT_MODE, just logs the commentary
-        instead
-        :param message: Received commentary message
+        Gets commentary message on new eval data and vocalizes it.
         """
-        if not settings.SILENT_MODE:
-            stream = sounddevice.OutputStream(
-                samplerate=cls.COMMENTARY_VOICE.config.sample_rate, channels=1, dtype="int16"
+        if trigger.reason == EvalCommentaryReasonEnum.EngineDisagreement:
+            message = self.llm_manager.generate_engine_disagreement_commentating_message(
+                engine_evaluations="; ".join(
+                    f"{evaluation.engine_name} evaluates the position as {evaluation.position_evaluation} with best "
+                    f"line {truncate_best_line(evaluation.best_line, max_plies=settings.PV_MAX_PLIES)}"
+                    for evaluation in trigger.evaluations
+                ),
+                stream=settings.STREAM_COMMENTARY,
+            )
+        else:
+            evaluation = trigger.evaluations[-1]
+            message = self.llm_manager.generate_eval_commentating_message(
+                engine_name=evaluation.engine_name,
+                position_evaluation=evaluation.position_evaluation,
+                best_line=truncate_best_line(evaluation.best_line, max_plies=settings.PV_MAX_PLIES),
+                stream=settings.STREAM_COMMENTARY,
             )
-            stream.start()
+        self._vocalize_commentary(message=message, job=job)
 
-            for audio_bytes in cls.COMMENTARY_VOICE.synthesize_stream_raw(message):
-                int_data = np.frombuffer(audio_bytes, dtype=np.int16)
-                stream.write(int_data)
+    def flush_audio(self, timeout: float | None = None) -> bool:
+        """
+        Blocks until all the commentary vocalized so far has been played
+        :param timeout: Maximum number of seconds to wait. Waits forever if None
+        :return: True if all commentary was played
+        """
+        if not self.audio_player:
+            return True
+        return self.audio_player.flush(timeout=timeout)
 
-            stream.stop()
-            stream.close()
+    def interrupt_audio(self) -> None:
+        """
+        Stops playback, discarding all the commentary that has not been played yet
+        """
+        if self.audio_player:
+            self.audio_player.interrupt()
+
+    def close(self) -> None:
+        """
+        Releases the audio output device, and the speech synthesizer, LLM manager and commentary cache if created by the
+        commentator
+        """
+        if self.audio_player:
+            self.audio_player.close()
+        if self._owns_speech_synthesizer:
+            self.speech_synthesizer.close()
+        if self._owns_llm_manager:
+            self.llm_manager.close()
+        if self._owned_commentary_cache:
+            self._owned_commentary_cache.close()
+
+    def _vocalize_commentary(
+        self, message: str | Iterable[str], job: CommentaryJob, audio: list[bytes] | None = None
+    ) -> None:
+        """
+        Takes the commentary and speaks it out loud. If environment is set to SILENT_MODE, just logs the commentary
+        instead. Sentences are synthesized in parallel and their audio is queued on the audio player in order, so this
+        returns as soon as synthesis is done and the synthesis of the next commentary can overlap with the playback of
+        this one. The commentary is generated and synthesized before taking the speech lock, so that other games keep
+        generating theirs meanwhile: if no other commentary is being queued, the sentences are queued as soon as they
+        are synthesized, otherwise the whole commentary is synthesized while waiting for its turn
+        :param message: Received commentary message, either whole or as an iterable of sentences. Sentences are
+        synthesized as soon as they are available, so playback starts after the first one is received
+        :param job: Job of the commentary. Vocalization stops as soon as it is stale. The time from receiving a move to
+        queuing the first audio is recorded as the move to speech latency
+        :param audio: Audio of the message, if already synthesized
+        """
+        sentences = split_sentences([message]) if isinstance(message, str) else message
+        # Commentary that was skipped or discarded is empty
+        sentences = (sentence for sentence in sentences if sentence)
+        record_latency = job.received_time is not None and job.priority != CommentaryPriorityEnum.Evaluation
+        if settings.SILENT_MODE:
+            commentary = " ".join(sentences)
+            with self.speech_lock:
+                if commentary and not job.is_stale():
+                    global_logger.info(commentary)
+                    if record_latency:
+                        MOVE_TO_SPEECH_LATENCY.observe(time.monotonic() - job.received_time)
+            return
+
+        if audio is not None:
+            sentences_audio = iter(audio)
+        else:
+            sentences_audio = self.speech_synthesizer.synthesize(sentences)
+        try:
+            self._play_commentary(sentences_audio=sentences_audio, job=job, record_latency=record_latency)
+        finally:
+            # Stops the synthesis of the sentences left when the commentary went stale
+            if audio is None:
+                sentences_audio.close()
+
+    def _play_commentary(self, sentences_audio: Iterator[bytes], job: CommentaryJob, record_latency: bool) -> None:
+        """
+        Queues the audio of a commentary on the audio player, holding the speech lock so that it is not interleaved
+        with the commentary of other games
+        :param sentences_audio: Audio of every sentence of the commentary, possibly still being synthesized
+        :param job: Job of the commentary. Playback stops as soon as it is stale
+        :param record_latency: Whether the time from receiving the move to queuing the first audio is recorded
+        """
+        first_audio = next(sentences_audio, None)
+        if first_audio is None:
+            return
+        if self.speech_lock.acquire(blocking=False):
+            pending_audio = sentences_audio
         else:
-            global_logger.info(message)
+            pending_audio = []
+            for sentence_audio in sentences_audio:
+                if job.is_stale():
+                    break
+                pending_audio.append(sentence_audio)
+            self.speech_lock.acquire()
+        try:
+            for sentence_index, sentence_audio in enumerate(itertools.chain([first_audio], pending_audio)):
+                if job.is_stale():
+                    global_logger.info(f"Stopping {job.priority.name} commentary of game {self.game_key}")
+                    break
+                if sentence_index == 0:
+                    self.commentary_scheduler.start_speaking(job)
+                self.audio_player.play(sentence_audio)
+                if sentence_index == 0 and record_latency:
+                    MOVE_TO_SPEECH_LATENCY.observe(time.monotonic() - job.received_time)
+        finally:
+            self.speech_lock.release()
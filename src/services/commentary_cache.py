@@ -0,0 +1,131 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from conf.settings import settings
+from entities.types import FenPosition
+from utils.logger import global_logger
+
+
+class CommentaryCache:
+    """
+    Persistent cache of LLM commentary, stored in a SQLite file. When the maximum number of entries is exceeded, the
+    least recently used entries are evicted. A single instance is shared by all the games using the file, so that the
+    entry count the eviction relies on and the hit rate cover all of them.
+    """
+
+    def __init__(self, file_path: Path, max_entries: int, bypass: bool = False):
+        """
+        :param file_path: Path of the SQLite file. Created if missing
+        :param max_entries: Maximum number of cached commentaries
+        :param bypass: If true, lookups always miss. New commentary is still stored
+        """
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.hit_count = 0
+        self.miss_count = 0
+
+        Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(file_path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS commentary "
+            "(key TEXT PRIMARY KEY, message TEXT NOT NULL, last_access_time REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS commentary_last_access_time ON commentary (last_access_time)"
+        )
+        self._connection.commit()
+        self._entry_count = self._connection.execute("SELECT COUNT(*) FROM commentary").fetchone()[0]
+
+    @staticmethod
+    def make_key(fen_position: FenPosition, last_move: str, prompt_version: str, model_parameters: str) -> str:
+        """
+        Builds the cache key of a commentary. Move counters are stripped from the FEN, so that the same position
+        reached through a different move order or in a different game shares the same key
+        :param fen_position: Position after the last move
+        :param last_move: Last move, in SAN
+        :param prompt_version: Hash of the prompt templates used to generate the commentary
+        :param model_parameters: Description of the model and parameters used to generate the commentary
+        :return: Cache key
+        """
+        normalized_fen = " ".join(fen_position.split()[:4])
+        return hashlib.sha256(
+            "\x1f".join((normalized_fen, last_move, prompt_version, model_parameters)).encode()
+        ).hexdigest()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hit_count + self.miss_count
+        return self.hit_count / lookups if lookups else 0.0
+
+    def get(self, key: str) -> str | None:
+        """
+        Looks up a cached commentary, marking it as recently used
+        :param key: Key built with `make_key`
+        :return: The cached commentary, or None on a miss
+        """
+        with self._lock:
+            if self.bypass:
+                self.miss_count += 1
+                return None
+            row = self._connection.execute("SELECT message FROM commentary WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.miss_count += 1
+                return None
+            self._connection.execute(
+                "UPDATE commentary SET last_access_time = ? WHERE key = ?", (time.time(), key)
+            )
+            self._connection.commit()
+            self.hit_count += 1
+
+        global_logger.debug(f"Commentary cache hit, hit rate: {self.hit_rate:.2%}")
+        return row[0]
+
+    def put(self, key: str, message: str) -> None:
+        """
+        Stores a commentary, evicting the least recently used entries if the cache is full
+        :param key: Key built with `make_key`
+        :param message: Commentary to store
+        """
+        with self._lock:
+            is_new_entry = (
+                self._connection.execute("SELECT 1 FROM commentary WHERE key = ?", (key,)).fetchone() is None
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO commentary (key, message, last_access_time) VALUES (?, ?, ?)",
+                (key, message, time.time()),
+            )
+            self._entry_count += is_new_entry
+
+            if self._entry_count > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM commentary WHERE key IN "
+                    "(SELECT key FROM commentary ORDER BY last_access_time LIMIT ?)",
+                    (self._entry_count - self.max_entries,),
+                )
+                self._entry_count = self.max_entries
+            self._connection.commit()
+
+    def close(self) -> None:
+        """
+        Closes the underlying SQLite connection
+        """
+        with self._lock:
+            self._connection.close()
+
+
+def create_commentary_cache() -> CommentaryCache | None:
+    """
+    Creates the commentary cache according to the settings
+    :return: Commentary cache, None if disabled
+    """
+    if not settings.COMMENTARY_CACHE_ENABLED:
+        return None
+    return CommentaryCache(
+        file_path=settings.COMMENTARY_CACHE_FILE_PATH,
+        max_entries=settings.COMMENTARY_CACHE_MAX_ENTRIES,
+        bypass=settings.COMMENTARY_CACHE_BYPASS,
+    )
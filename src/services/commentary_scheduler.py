@@ -0,0 +1,141 @@
+import threading
+import time
+from dataclasses import dataclass, field
+
+from entities.entities import CommentaryPriorityEnum
+from entities.types import GameKey
+from services.audio_player import AudioPlayer
+from utils.logger import global_logger
+from utils.metrics import COMMENTARY_PREEMPTIONS
+
+
+@dataclass
+class CommentaryJob:
+    """
+    A commentary being generated and spoken
+    """
+
+    game_key: GameKey
+    priority: CommentaryPriorityEnum
+    expiry_time: float | None = None
+    """
+    Monotonic time after which the commentary is too late to be worth saying. Never expires if None
+    """
+    received_time: float | None = None
+    """
+    Monotonic time at which the commentated message was received
+    """
+    cancelled: threading.Event = field(default_factory=threading.Event)
+
+    def is_stale(self) -> bool:
+        """
+        :return: True if the commentary was preempted by a more urgent one or is too late
+        """
+        return self.cancelled.is_set() or (self.expiry_time is not None and time.monotonic() > self.expiry_time)
+
+
+class CommentaryScheduler:
+    """
+    Keeps the commentary on the current state of the games. More urgent messages preempt less urgent commentary, a new
+    game preempting anything else and a move preempting the evaluation commentary of its game: the LLM requests of the
+    preempted commentary are cancelled and, if it is being spoken, playback is interrupted. Commentary older than the
+    maximum staleness is not generated, or stops being spoken, so that the speech never lags far behind the board.
+    """
+
+    def __init__(self, max_staleness_seconds: float, audio_player: AudioPlayer | None = None):
+        """
+        :param max_staleness_seconds: Maximum time between receiving a message and speaking its commentary
+        :param audio_player: Player whose playback is interrupted when the commentary being spoken is preempted
+        """
+        self.max_staleness_seconds = max_staleness_seconds
+        self.audio_player = audio_player
+        self._active_jobs: dict[GameKey, CommentaryJob] = {}
+        self._speaking_job: CommentaryJob | None = None
+        self._lock = threading.Lock()
+
+    def start_job(
+        self, game_key: GameKey, priority: CommentaryPriorityEnum, received_time: float | None = None
+    ) -> CommentaryJob:
+        """
+        Registers the commentary of a game about to be generated. Games are commentated one message at a time, so a
+        game has at most one active job
+        :param game_key: Game being commentated
+        :param priority: Urgency of the commentary
+        :param received_time: Monotonic time at which the commentated message was received, if known
+        :return: Job of the commentary, to be passed to `finish_job` when done
+        """
+        job = CommentaryJob(
+            game_key=game_key,
+            priority=priority,
+            expiry_time=received_time + self.max_staleness_seconds if received_time is not None else None,
+            received_time=received_time,
+        )
+        with self._lock:
+            self._active_jobs[game_key] = job
+        return job
+
+    def finish_job(self, job: CommentaryJob) -> None:
+        """
+        Unregisters a job once its commentary has been generated and queued for playback. Its audio may still be
+        playing, and can still be interrupted
+        """
+        with self._lock:
+            if self._active_jobs.get(job.game_key) is job:
+                del self._active_jobs[job.game_key]
+
+    def start_speaking(self, job: CommentaryJob) -> None:
+        """
+        Records that the audio of a job is being queued for playback
+        """
+        with self._lock:
+            self._speaking_job = job
+
+    def get_active_priority(self, game_key: GameKey) -> CommentaryPriorityEnum | None:
+        """
+        :return: Priority of the commentary being generated for the game, None if there is none
+        """
+        with self._lock:
+            job = self._active_jobs.get(game_key)
+        return job.priority if job else None
+
+    def is_stale(self, game_key: GameKey) -> bool:
+        """
+        :return: True if the commentary being generated for the game is stale
+        """
+        with self._lock:
+            job = self._active_jobs.get(game_key)
+        return job is not None and job.is_stale()
+
+    def preempt(self, game_key: GameKey, priority: CommentaryPriorityEnum) -> None:
+        """
+        Called whenever a message arrives. Cancels the less urgent commentary it preempts, and interrupts playback if
+        that commentary or a stale one is being spoken
+        :param game_key: Game of the message
+        :param priority: Urgency of the commentary of the message
+        """
+        with self._lock:
+            for job in self._active_jobs.values():
+                if self._preempts(job=job, game_key=game_key, priority=priority) and not job.cancelled.is_set():
+                    global_logger.info(f"Cancelling {job.priority.name} commentary of game {job.game_key}")
+                    COMMENTARY_PREEMPTIONS.inc(action="cancelled")
+                    job.cancelled.set()
+
+            speaking_job = self._speaking_job
+            if speaking_job is None or not self.audio_player or not self.audio_player.buffered_samples:
+                return
+            is_stale = speaking_job.game_key == game_key and speaking_job.is_stale()
+            if is_stale or self._preempts(job=speaking_job, game_key=game_key, priority=priority):
+                global_logger.info(
+                    f"Interrupting {speaking_job.priority.name} commentary of game {speaking_job.game_key}"
+                )
+                COMMENTARY_PREEMPTIONS.inc(action="interrupted")
+                speaking_job.cancelled.set()
+                self._speaking_job = None
+                self.audio_player.interrupt()
+
+    @staticmethod
+    def _preempts(job: CommentaryJob, game_key: GameKey, priority: CommentaryPriorityEnum) -> bool:
+        """
+        :return: True if a message of the given game and priority preempts the commentary of the job
+        """
+        return job.priority > priority and (job.game_key == game_key or priority == CommentaryPriorityEnum.NewGame)
@@ -0,0 +1,202 @@
+import threading
+import time
+from concurrent.futures import Executor, Future
+from dataclasses import dataclass, field
+
+import chess
+
+from services.llm_manager import LLMManager, PreparedMessage
+from services.position_features import extract_position_features
+from services.speech_synthesizer import SpeechSynthesizer
+from utils.logger import global_logger
+from utils.metrics import SPECULATIONS
+from utils.text import split_sentences
+
+
+class SpeculationBudget:
+    """
+    Rolling hourly cap on the number of speculative LLM calls, shared by all games, so that speculation on fast games
+    cannot multiply the cost of the commentary. Also keeps the hit rate of the speculations.
+    """
+
+    WINDOW_SECONDS = 3600
+
+    def __init__(self, max_calls_per_hour: int):
+        self.max_calls_per_hour = max_calls_per_hour
+        self.hit_count = 0
+        self.miss_count = 0
+        self._call_times: list[float] = []
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Share of the played moves on which a speculation was made that had been predicted
+        """
+        with self._lock:
+            total = self.hit_count + self.miss_count
+            return self.hit_count / total if total else 0.0
+
+    def try_spend(self) -> bool:
+        """
+        Spends one call of the budget, if any is left
+        :return: True if the call can be made
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._call_times = [call_time for call_time in self._call_times if now - call_time < self.WINDOW_SECONDS]
+            if len(self._call_times) >= self.max_calls_per_hour:
+                return False
+            self._call_times.append(now)
+            return True
+
+    def record(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hit_count += 1
+            else:
+                self.miss_count += 1
+
+
+@dataclass(frozen=True)
+class PreparedCommentary:
+    prepared_message: PreparedMessage
+    audio: list[bytes] | None = None
+    """
+    Synthesized commentary, if pre-synthesis is enabled
+    """
+
+
+@dataclass
+class _Speculation:
+    future: Future
+    cancelled: threading.Event = field(default_factory=threading.Event)
+
+
+class CommentarySpeculator:
+    """
+    Prepares the commentary of the moves predicted by the engines before they are played. Live evaluations carry the
+    best line of every engine, whose first move is the predicted reply: its commentary is generated, and optionally
+    synthesized, in the background while the engines think. When the predicted move is played the prepared commentary
+    is used straight away, otherwise it is discarded.
+    """
+
+    def __init__(
+        self,
+        llm_manager: LLMManager,
+        executor: Executor,
+        budget: SpeculationBudget,
+        max_predictions_per_position: int,
+        speech_synthesizer: SpeechSynthesizer | None = None,
+        wait_timeout_seconds: float | None = None,
+    ):
+        """
+        :param llm_manager: Manager of the LLM of the game, whose chat history the commentary follows
+        :param executor: Executor running the speculations
+        :param budget: Budget of speculative LLM calls, shared by all games
+        :param max_predictions_per_position: Maximum number of different moves speculated on from the same position
+        :param speech_synthesizer: If provided, the prepared commentary is also synthesized
+        :param wait_timeout_seconds: Maximum time to wait for a speculation still in progress when its move is played
+        """
+        self.llm_manager = llm_manager
+        self.executor = executor
+        self.budget = budget
+        self.max_predictions_per_position = max_predictions_per_position
+        self.speech_synthesizer = speech_synthesizer
+        self.wait_timeout_seconds = wait_timeout_seconds
+
+        self._position_key: str | None = None
+        self._speculations: dict[str, _Speculation] = {}
+        self._lock = threading.Lock()
+
+    def speculate(self, board: chess.Board, san_move: str, opening: str | None) -> None:
+        """
+        Starts preparing the commentary of a predicted move, unless it is already being prepared, too many moves are
+        already being prepared for the position or the budget is spent
+        :param board: Current position. Not modified
+        :param san_move: Predicted move in SAN
+        :param opening: Name of the opening, if known
+        """
+        try:
+            move = board.parse_san(san_move)
+        except ValueError:
+            # Evaluation of an older position
+            return
+        position_key = board.fen()
+        with self._lock:
+            if position_key != self._position_key:
+                self._discard_speculations()
+                self._position_key = position_key
+            if move.uci() in self._speculations or len(self._speculations) >= self.max_predictions_per_position:
+                return
+            if not self.budget.try_spend():
+                SPECULATIONS.inc(outcome="over_budget")
+                return
+            SPECULATIONS.inc(outcome="started")
+            cancelled = threading.Event()
+            future = self.executor.submit(
+                self._prepare, board=board.copy(stack=False), move=move, opening=opening, cancelled=cancelled
+            )
+            self._speculations[move.uci()] = _Speculation(future=future, cancelled=cancelled)
+
+    def take(self, board_before: chess.Board, move: chess.Move) -> PreparedCommentary | None:
+        """
+        Gets the commentary prepared for a move that was just played, discarding all other speculations
+        :param board_before: Position before the move
+        :param move: Move played
+        :return: Prepared commentary, or None if the move was not predicted or its commentary could not be prepared
+        """
+        with self._lock:
+            speculation = None
+            # Only moves played from a position that was speculated on count towards the hit rate
+            if self._speculations and board_before.fen() == self._position_key:
+                speculation = self._speculations.pop(move.uci(), None)
+                self.budget.record(hit=speculation is not None)
+                SPECULATIONS.inc(outcome="hit" if speculation else "miss")
+            self._discard_speculations()
+            self._position_key = None
+        if speculation is None:
+            return None
+        try:
+            prepared_commentary = speculation.future.result(timeout=self.wait_timeout_seconds)
+        except Exception:
+            global_logger.exception("Failed to prepare speculative commentary")
+            return None
+        return prepared_commentary if prepared_commentary.prepared_message.message else None
+
+    def discard(self) -> None:
+        """
+        Discards all speculations, e.g. when a new game starts
+        """
+        with self._lock:
+            self._discard_speculations()
+            self._position_key = None
+
+    def _discard_speculations(self) -> None:
+        """
+        Cancels the speculations in progress. Must be called with the lock held
+        """
+        for speculation in self._speculations.values():
+            speculation.cancelled.set()
+            speculation.future.cancel()
+        self._speculations.clear()
+
+    def _prepare(
+        self, board: chess.Board, move: chess.Move, opening: str | None, cancelled: threading.Event
+    ) -> PreparedCommentary:
+        """
+        Generates, and optionally synthesizes, the commentary of a predicted move. Runs on the executor
+        """
+        position_features = extract_position_features(board_before=board, move=move, opening=opening)
+        last_move = board.san(move)
+        board.push(move)
+        prepared_message = self.llm_manager.prepare_commentating_message(
+            fen_position=board.fen(),
+            last_move=last_move,
+            position_facts=position_features.format(),
+            is_cancelled=cancelled.is_set,
+        )
+        audio = None
+        if self.speech_synthesizer and prepared_message.message and not cancelled.is_set():
+            audio = list(self.speech_synthesizer.synthesize(split_sentences([prepared_message.message])))
+        return PreparedCommentary(prepared_message=prepared_message, audio=audio)
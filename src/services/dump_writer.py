@@ -0,0 +1,233 @@
+import gzip
+import io
+import json
+import re
+import threading
+from pathlib import Path
+from typing import IO, Literal
+
+from utils.logger import global_logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DumpCompression = Literal["none", "gzip", "zstd"]
+
+COMPRESSION_SUFFIXES: dict[DumpCompression, str] = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+INDEX_FILE_SUFFIX = ".index.jsonl"
+GAME_ROUND_REGEX = re.compile(r'"[Rr]ound":"?([0-9.]+)')
+TIMESTAMP_SEPARATOR = "\t"
+
+
+def format_dump_record(message: str, received_timestamp: float) -> str:
+    """
+    Formats a received message as a line of a dump file, prefixed with its receive timestamp
+    :param message: Received message
+    :param received_timestamp: Unix timestamp at which the message was received
+    :return: Line to append to the dump file, including the trailing newline
+    """
+    return f"{received_timestamp:.6f}{TIMESTAMP_SEPARATOR}{message}\n"
+
+
+def parse_dump_record(line: str) -> tuple[float | None, str]:
+    """
+    Parses a line of a dump file. Lines written before receive timestamps were recorded only contain the message
+    :param line: Line of the dump file, with or without trailing newline
+    :return: Receive timestamp (None if not recorded) and message
+    """
+    line = line.rstrip("\n")
+    timestamp, separator, message = line.partition(TIMESTAMP_SEPARATOR)
+    if separator:
+        try:
+            return float(timestamp), message
+        except ValueError:
+            pass
+    return None, line
+
+
+def get_dump_file_path(file_path: Path, compression: DumpCompression) -> Path:
+    """
+    Adds the suffix of the compression to a dump file path, if missing
+    :param file_path: Configured dump file path
+    :param compression: Compression of the dump
+    :return: Path of the dump file
+    """
+    file_path = Path(file_path)
+    suffix = COMPRESSION_SUFFIXES[compression]
+    return file_path if not suffix or file_path.suffix == suffix else file_path.with_name(file_path.name + suffix)
+
+
+def get_index_file_path(dump_file_path: Path) -> Path:
+    """
+    :param dump_file_path: Path of a dump file
+    :return: Path of the offset index of the dump file
+    """
+    dump_file_path = Path(dump_file_path)
+    return dump_file_path.with_name(dump_file_path.name + INDEX_FILE_SUFFIX)
+
+
+def open_dump_file(dump_file_path: Path, start_offset: int = 0) -> IO[str]:
+    """
+    Opens a dump file for reading as text, decompressing it if needed based on its suffix
+    :param dump_file_path: Path of the dump file
+    :param start_offset: Byte offset at which to start reading. Must come from the offset index of the dump
+    :return: Text file object
+    """
+    dump_file_path = Path(dump_file_path)
+    raw_file = open(dump_file_path, "rb")
+    raw_file.seek(start_offset)
+    if dump_file_path.suffix == COMPRESSION_SUFFIXES["gzip"]:
+        binary_file = gzip.GzipFile(fileobj=raw_file)
+    elif dump_file_path.suffix == COMPRESSION_SUFFIXES["zstd"]:
+        if zstandard is None:
+            raise RuntimeError("The zstandard package is required to read zstd compressed dumps")
+        binary_file = zstandard.ZstdDecompressor().stream_reader(raw_file, read_across_frames=True, closefd=True)
+    else:
+        binary_file = raw_file
+    return io.TextIOWrapper(binary_file, encoding="utf-8")
+
+
+def find_game_offset(dump_file_path: Path, game_round: str) -> int | None:
+    """
+    Looks up in the offset index of a dump the position of the first frame containing messages of a game
+    :param dump_file_path: Path of the dump file
+    :param game_round: Round of the game, e.g. "29.4"
+    :return: Byte offset to pass to `open_dump_file`, or None if the game is not in the index
+    """
+    index_file_path = get_index_file_path(dump_file_path)
+    if not index_file_path.exists():
+        return None
+    with open(index_file_path, "r") as file:
+        for line in file:
+            entry = json.loads(line)
+            if entry["round"] == game_round:
+                return entry["offset"]
+    return None
+
+
+class DumpWriter:
+    """
+    Writes received messages to a dump file from a background thread. Messages are buffered in memory and flushed when
+    the buffer grows too large or too much time has passed. Every flush is written as an independent compressed frame,
+    and an offset index records the frame in which each game first appears, so readers can seek straight to a game.
+    """
+
+    def __init__(
+        self, file_path: Path, compression: DumpCompression, flush_interval_seconds: float, flush_max_bytes: int
+    ):
+        """
+        :param file_path: Path of the dump file. The suffix of the compression is added if missing
+        :param compression: Compression of the written frames
+        :param flush_interval_seconds: Maximum time messages are buffered before being written
+        :param flush_max_bytes: Size of the buffer above which it is written immediately
+        """
+        if compression == "zstd" and zstandard is None:
+            raise RuntimeError("The zstandard package is required to write zstd compressed dumps")
+
+        self.file_path = get_dump_file_path(file_path=file_path, compression=compression)
+        self.index_file_path = get_index_file_path(self.file_path)
+        self.compression = compression
+        self.flush_interval_seconds = flush_interval_seconds
+        self.flush_max_bytes = flush_max_bytes
+
+        self._buffer: list[str] = []
+        self._buffer_bytes = 0
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._last_indexed_round = None
+
+    def start(self) -> None:
+        """
+        Starts the background writer thread, if not running already
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="dump-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, message: str, received_timestamp: float) -> None:
+        """
+        Buffers a message to be written. Never blocks on disk
+        :param message: Received message
+        :param received_timestamp: Unix timestamp at which the message was received
+        """
+        record = format_dump_record(message=message, received_timestamp=received_timestamp)
+        with self._condition:
+            self._buffer.append(record)
+            self._buffer_bytes += len(record)
+            if self._buffer_bytes >= self.flush_max_bytes:
+                self._condition.notify()
+
+    def close(self) -> None:
+        """
+        Writes all buffered messages and stops the background writer thread
+        """
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        """
+        Main loop of the background writer thread
+        """
+        while not self._stop_event.is_set():
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._buffer_bytes >= self.flush_max_bytes or self._stop_event.is_set(),
+                    timeout=self.flush_interval_seconds,
+                )
+                records = self._buffer
+                self._buffer = []
+                self._buffer_bytes = 0
+            self._flush(records=records)
+
+        with self._condition:
+            records = self._buffer
+            self._buffer = []
+            self._buffer_bytes = 0
+        self._flush(records=records)
+
+    def _flush(self, records: list[str]) -> None:
+        """
+        Writes records as a single frame at the end of the dump file and updates the offset index
+        :param records: Formatted records to write
+        """
+        if not records:
+            return
+        try:
+            data = "".join(records).encode("utf-8")
+            if self.compression == "gzip":
+                data = gzip.compress(data)
+            elif self.compression == "zstd":
+                data = zstandard.ZstdCompressor().compress(data)
+
+            with open(self.file_path, "ab") as file:
+                frame_offset = file.tell()
+                file.write(data)
+            self._update_index(records=records, frame_offset=frame_offset)
+        except OSError:
+            global_logger.exception(f"Failed to write {len(records)} messages to the dump file")
+
+    def _update_index(self, records: list[str], frame_offset: int) -> None:
+        """
+        Adds an index entry for every game whose messages start appearing in the frame
+        :param records: Records written in the frame
+        :param frame_offset: Byte offset of the frame in the dump file
+        """
+        index_entries = []
+        for record in records:
+            match = GAME_ROUND_REGEX.search(record)
+            if match and match.group(1) != self._last_indexed_round:
+                self._last_indexed_round = match.group(1)
+                index_entries.append(json.dumps({"round": self._last_indexed_round, "offset": frame_offset}) + "\n")
+        if index_entries:
+            with open(self.index_file_path, "a") as file:
+                file.writelines(index_entries)
@@ -0,0 +1,252 @@
+import statistics
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+
+from entities.entities import EvalCommentaryReasonEnum
+from entities.types import GameKey
+
+MATE_EVALUATION_PAWNS = 100.0
+
+
+def parse_evaluation(position_evaluation: str | float) -> float | None:
+    """
+    Parses an engine evaluation, in pawns from the point of view of white. Mate scores such as "M12", "#-3" or "-M5"
+    are mapped to +/- MATE_EVALUATION_PAWNS
+    :param position_evaluation: Evaluation as received from the engine
+    :return: Evaluation in pawns, or None if it cannot be parsed
+    """
+    try:
+        return float(position_evaluation)
+    except (TypeError, ValueError):
+        pass
+    text = str(position_evaluation).strip().upper()
+    if "M" in text or "#" in text:
+        return -MATE_EVALUATION_PAWNS if "-" in text else MATE_EVALUATION_PAWNS
+    return None
+
+
+def parse_wdl_score(wdl: str | None) -> float | None:
+    """
+    Converts a win/draw/loss triplet (e.g. "911 71 18", in permille) into the expected score for white
+    :param wdl: Win/draw/loss triplet as received from the engine
+    :return: Expected score between 0 and 1, or None if it cannot be parsed
+    """
+    try:
+        win, draw, loss = (float(value) for value in str(wdl).split())
+    except (TypeError, ValueError):
+        return None
+    total = win + draw + loss
+    return (win + draw / 2) / total if total else None
+
+
+def parse_depth(depth: str | int | None) -> int | None:
+    """
+    Parses the search depth of an engine, e.g. "25/68" (depth/selective depth)
+    :param depth: Depth as received from the engine
+    :return: Depth, or None if it cannot be parsed
+    """
+    try:
+        return int(str(depth).split("/")[0])
+    except ValueError:
+        return None
+
+
+@dataclass(frozen=True)
+class EngineEvaluation:
+    engine_name: str
+    position_evaluation: str
+    evaluation_pawns: float
+    score: float | None
+    depth: int | None
+    best_line: str
+    timestamp: float
+
+
+@dataclass(frozen=True)
+class EvalCommentaryTrigger:
+    reason: EvalCommentaryReasonEnum
+    evaluations: list[EngineEvaluation]
+    """
+    Latest evaluation of every engine that is currently reporting, the one that triggered the commentary last
+    """
+
+
+@dataclass
+class _GameEvalState:
+    history_by_engine: dict[str, deque[EngineEvaluation]] = field(default_factory=dict)
+    commentated_evaluation_pawns: float | None = None
+    commentated_score: float | None = None
+    last_commentary_time: float = float("-inf")
+    disagreement_commentated: bool = False
+
+
+class EvalTracker:
+    """
+    Keeps the evaluation, WDL and depth history of every engine on every game, and decides when the evaluations are
+    worth commentating. Reports of concurrent engines are coalesced into a single consensus evaluation, and commentary
+    is only triggered when the consensus swings significantly since the last commentated evaluation, or when engines
+    strongly disagree with each other.
+    """
+
+    HISTORY_LENGTH = 64
+    MAX_TRACKED_GAMES = 8
+    CLIPPED_EVALUATION_PAWNS = 10.0
+
+    def __init__(
+        self,
+        swing_threshold_pawns: float,
+        swing_threshold_score: float,
+        disagreement_threshold_pawns: float,
+        min_depth: int,
+        coalescing_window_seconds: float,
+        min_interval_seconds: float,
+    ):
+        """
+        :param swing_threshold_pawns: Change of the consensus evaluation, in pawns, that triggers commentary
+        :param swing_threshold_score: Change of the consensus expected score (from WDL) that triggers commentary
+        :param disagreement_threshold_pawns: Spread between engine evaluations, in pawns, that triggers commentary
+        :param min_depth: Reports with a lower search depth are recorded but never trigger commentary
+        :param coalescing_window_seconds: Reports older than this are not part of the consensus evaluation
+        :param min_interval_seconds: Minimum time between two commentaries triggered on the same game
+        """
+        self.swing_threshold_pawns = swing_threshold_pawns
+        self.swing_threshold_score = swing_threshold_score
+        self.disagreement_threshold_pawns = disagreement_threshold_pawns
+        self.min_depth = min_depth
+        self.coalescing_window_seconds = coalescing_window_seconds
+        self.min_interval_seconds = min_interval_seconds
+
+        self._games: OrderedDict[GameKey, _GameEvalState] = OrderedDict()
+
+    def add_evaluation(
+        self,
+        game_key: GameKey,
+        engine_name: str,
+        position_evaluation: str,
+        best_line: str,
+        wdl: str | None = None,
+        depth: str | None = None,
+        timestamp: float | None = None,
+    ) -> EvalCommentaryTrigger | None:
+        """
+        Records an engine report and decides whether it should be commentated
+        :param game_key: Game the evaluation refers to
+        :param engine_name: Name of the engine that provides the evaluation
+        :param position_evaluation: Evaluation of the position
+        :param best_line: Best line proposed by the evaluating engine
+        :param wdl: Win/draw/loss triplet, if provided by the engine
+        :param depth: Search depth, if provided by the engine
+        :param timestamp: Time of the report. Defaults to now
+        :return: Trigger describing why the evaluation should be commentated, or None if it should not
+        """
+        evaluation_pawns = parse_evaluation(position_evaluation)
+        if evaluation_pawns is None:
+            return None
+
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        evaluation = EngineEvaluation(
+            engine_name=engine_name,
+            position_evaluation=str(position_evaluation),
+            evaluation_pawns=max(-self.CLIPPED_EVALUATION_PAWNS, min(self.CLIPPED_EVALUATION_PAWNS, evaluation_pawns)),
+            score=parse_wdl_score(wdl),
+            depth=parse_depth(depth),
+            best_line=best_line,
+            timestamp=timestamp,
+        )
+        game_state = self._get_game_state(game_key=game_key)
+        game_state.history_by_engine.setdefault(engine_name, deque(maxlen=self.HISTORY_LENGTH)).append(evaluation)
+
+        if evaluation.depth is not None and evaluation.depth < self.min_depth:
+            return None
+
+        current_evaluations = self._get_current_evaluations(game_state=game_state, now=timestamp)
+        consensus_evaluation_pawns = statistics.median(e.evaluation_pawns for e in current_evaluations)
+        scores = [e.score for e in current_evaluations if e.score is not None]
+        consensus_score = statistics.median(scores) if scores else None
+
+        if game_state.commentated_evaluation_pawns is None:
+            # The first evaluation of a game is the reference for the following ones
+            game_state.commentated_evaluation_pawns = consensus_evaluation_pawns
+            game_state.commentated_score = consensus_score
+            return None
+
+        reason = self._get_trigger_reason(
+            game_state=game_state,
+            current_evaluations=current_evaluations,
+            consensus_evaluation_pawns=consensus_evaluation_pawns,
+            consensus_score=consensus_score,
+        )
+        if reason is None or timestamp - game_state.last_commentary_time < self.min_interval_seconds:
+            return None
+
+        game_state.commentated_evaluation_pawns = consensus_evaluation_pawns
+        game_state.commentated_score = consensus_score
+        game_state.last_commentary_time = timestamp
+        if reason == EvalCommentaryReasonEnum.EngineDisagreement:
+            game_state.disagreement_commentated = True
+        return EvalCommentaryTrigger(reason=reason, evaluations=current_evaluations)
+
+    def get_history(self, game_key: GameKey, engine_name: str) -> list[EngineEvaluation]:
+        """
+        :param game_key: Game the evaluations refer to
+        :param engine_name: Name of the engine
+        :return: Recent evaluations of the engine on the game, oldest first
+        """
+        game_state = self._games.get(game_key)
+        if not game_state:
+            return []
+        return list(game_state.history_by_engine.get(engine_name, []))
+
+    def _get_game_state(self, game_key: GameKey) -> _GameEvalState:
+        """
+        Gets the state of a game, creating it if needed and forgetting the least recently updated games
+        """
+        if game_key not in self._games:
+            self._games[game_key] = _GameEvalState()
+            while len(self._games) > self.MAX_TRACKED_GAMES:
+                self._games.popitem(last=False)
+        self._games.move_to_end(game_key)
+        return self._games[game_key]
+
+    def _get_current_evaluations(self, game_state: _GameEvalState, now: float) -> list[EngineEvaluation]:
+        """
+        Gets the latest deep enough evaluation of every engine that reported within the coalescing window. The most
+        recent evaluation is always last
+        """
+        current_evaluations = []
+        for history in game_state.history_by_engine.values():
+            latest_evaluation = next(
+                (e for e in reversed(history) if e.depth is None or e.depth >= self.min_depth), None
+            )
+            if latest_evaluation and now - latest_evaluation.timestamp <= self.coalescing_window_seconds:
+                current_evaluations.append(latest_evaluation)
+        return sorted(current_evaluations, key=lambda e: e.timestamp)
+
+    def _get_trigger_reason(
+        self,
+        game_state: _GameEvalState,
+        current_evaluations: list[EngineEvaluation],
+        consensus_evaluation_pawns: float,
+        consensus_score: float | None,
+    ) -> EvalCommentaryReasonEnum | None:
+        """
+        Decides whether the current evaluations are significant with respect to the last commentated ones
+        """
+        if len(current_evaluations) >= 2:
+            evaluations_pawns = [e.evaluation_pawns for e in current_evaluations]
+            spread_pawns = max(evaluations_pawns) - min(evaluations_pawns)
+            if spread_pawns < self.disagreement_threshold_pawns / 2:
+                game_state.disagreement_commentated = False
+            elif spread_pawns >= self.disagreement_threshold_pawns and not game_state.disagreement_commentated:
+                return EvalCommentaryReasonEnum.EngineDisagreement
+
+        if abs(consensus_evaluation_pawns - game_state.commentated_evaluation_pawns) >= self.swing_threshold_pawns:
+            return EvalCommentaryReasonEnum.EvaluationSwing
+        if (
+            consensus_score is not None
+            and game_state.commentated_score is not None
+            and abs(consensus_score - game_state.commentated_score) >= self.swing_threshold_score
+        ):
+            return EvalCommentaryReasonEnum.EvaluationSwing
+        return None
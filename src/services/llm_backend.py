@@ -0,0 +1,424 @@
+import random
+import statistics
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Iterator, TypeVar
+
+from langchain_core.messages import BaseMessage
+
+from conf.settings import settings
+from utils.logger import global_logger
+from utils.rate_limiter import RateLimiter
+
+T = TypeVar("T")
+
+
+class LLMDeadlineExceededError(TimeoutError):
+    """
+    Raised when no response of the LLM was received before the deadline of the call, retries and hedges included
+    """
+
+
+class LLMCancelledError(Exception):
+    """
+    Raised when a call is cancelled by the caller before a response was received
+    """
+
+
+class LLMBackend(ABC):
+    """
+    Sends chat messages to an LLM. Every call is bounded by a deadline, failed requests are retried with jittered
+    exponential backoff, and when a request takes longer than a percentile of the recent latencies a second, hedged
+    request is sent and the first response wins. If a rate limiter is set, calls wait for their slot before their
+    deadline starts, so that waiting for their turn does not time them out. Retries wait for a slot too, and requests
+    are only hedged when a slot is free right away. Implementations only provide single requests.
+    """
+
+    LATENCY_HISTORY_LENGTH = 100
+    HEDGE_MIN_SAMPLES = 20
+    CANCEL_CHECK_INTERVAL_SECONDS = 0.05
+
+    def __init__(
+        self,
+        deadline_seconds: float,
+        max_retries: int,
+        retry_base_delay_seconds: float,
+        hedge_percentile: float | None,
+        max_concurrent_requests: int,
+        rate_limiter: RateLimiter | None = None,
+    ):
+        """
+        :param deadline_seconds: Maximum duration of a call, retries and hedges included
+        :param max_retries: Maximum number of retries of a call after a retryable error
+        :param retry_base_delay_seconds: Base of the exponential backoff between retries
+        :param hedge_percentile: Percentile of the recent latencies after which a hedged request is sent, e.g. 95. No
+        request is hedged if None
+        :param max_concurrent_requests: Maximum number of requests in flight, hedged requests included
+        :param rate_limiter: Rate limit of all the requests sent, possibly shared with other backends. Not limited if
+        None
+        """
+        self.deadline_seconds = deadline_seconds
+        self.max_retries = max_retries
+        self.retry_base_delay_seconds = retry_base_delay_seconds
+        if hedge_percentile is not None and not 1 <= hedge_percentile <= 99:
+            raise ValueError(f"The hedge percentile must be between 1 and 99, got {hedge_percentile}")
+        self.hedge_percentile = hedge_percentile
+        self.rate_limiter = rate_limiter
+        self.retryable_errors: tuple[type[Exception], ...] = ()
+
+        self.retried_count = 0
+        self.hedged_count = 0
+        self.deadline_exceeded_count = 0
+
+        self._latencies_seconds: deque[float] = deque(maxlen=self.LATENCY_HISTORY_LENGTH)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_requests, thread_name_prefix="llm-request")
+
+    @property
+    @abstractmethod
+    def model_description(self) -> str:
+        """
+        Model and parameters that affect the responses, used to key cached responses
+        """
+
+    @abstractmethod
+    def count_tokens(self, messages: list[BaseMessage]) -> int:
+        """
+        :param messages: Messages to count
+        :return: Number of tokens of the messages for the model
+        """
+
+    @abstractmethod
+    def _invoke_once(self, messages: list[BaseMessage], timeout_seconds: float) -> str:
+        """
+        Sends a single request and waits for the whole response
+        :param messages: Messages to send
+        :param timeout_seconds: Maximum duration of the request
+        :return: Content of the response
+        """
+
+    @abstractmethod
+    def _stream_once(self, messages: list[BaseMessage], timeout_seconds: float) -> Iterator[str]:
+        """
+        Sends a single streaming request
+        :param messages: Messages to send
+        :param timeout_seconds: Maximum time to wait for each chunk
+        :return: Iterator over the chunks of the response
+        """
+
+    def invoke(self, messages: list[BaseMessage], is_cancelled: Callable[[], bool] | None = None) -> str:
+        """
+        Sends the messages to the LLM and waits for the whole response
+        :param messages: Messages to send
+        :param is_cancelled: Polled while waiting, the call is abandoned with LLMCancelledError as soon as it returns
+        True. Requests already sent are left to complete and their responses are discarded
+        :return: Content of the response
+        """
+        is_cancelled = is_cancelled or (lambda: False)
+        self._wait_for_rate_limit()
+        deadline = time.monotonic() + self.deadline_seconds
+        return self._call_with_retries(
+            lambda: self._invoke_hedged(messages=messages, deadline=deadline, is_cancelled=is_cancelled),
+            deadline,
+            is_cancelled=is_cancelled,
+        )
+
+    def stream(self, messages: list[BaseMessage], is_cancelled: Callable[[], bool] | None = None) -> Iterator[str]:
+        """
+        Sends the messages to the LLM and streams the response. Requests are retried until the first chunk is received,
+        streams are never hedged
+        :param messages: Messages to send
+        :param is_cancelled: Checked before every retry and chunk, the stream is closed with LLMCancelledError as soon
+        as it returns True
+        :return: Iterator over the chunks of the response
+        """
+        is_cancelled = is_cancelled or (lambda: False)
+        self._wait_for_rate_limit()
+        deadline = time.monotonic() + self.deadline_seconds
+        chunks, first_chunk = self._call_with_retries(
+            lambda: self._start_stream(messages=messages, deadline=deadline), deadline, is_cancelled=is_cancelled
+        )
+        if first_chunk is None:
+            return
+        try:
+            yield first_chunk
+            for chunk in chunks:
+                if is_cancelled():
+                    raise LLMCancelledError("Streamed response cancelled")
+                if time.monotonic() > deadline:
+                    self.deadline_exceeded_count += 1
+                    raise LLMDeadlineExceededError(f"Streamed response not complete after {self.deadline_seconds} s")
+                yield chunk
+        finally:
+            # Closes the connection of a stream that is not read to the end, so the server stops generating
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+
+    def warm_up(self) -> None:
+        """
+        Prepares the backend, e.g. opens connections, so that the first call is not delayed by cold start costs
+        """
+
+    def close(self) -> None:
+        """
+        Stops accepting requests. Requests in flight are completed and their responses discarded
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _call_with_retries(self, call: Callable[[], T], deadline: float, is_cancelled: Callable[[], bool]) -> T:
+        """
+        Calls a function, retrying it with full jitter exponential backoff while it raises retryable errors. The first
+        attempt is expected to have waited for the rate limit already, retries wait for it here
+        :param call: Function sending the request
+        :param deadline: Monotonic time after which no retry is attempted
+        :param is_cancelled: Checked before every attempt
+        :return: Result of the first successful call
+        """
+        for attempt in range(self.max_retries + 1):
+            if is_cancelled():
+                raise LLMCancelledError("Call cancelled before a response was received")
+            try:
+                return call()
+            except self.retryable_errors as error:
+                delay_seconds = random.uniform(0, self.retry_base_delay_seconds * 2**attempt)
+                if attempt == self.max_retries:
+                    raise
+                if time.monotonic() + delay_seconds >= deadline:
+                    self.deadline_exceeded_count += 1
+                    raise LLMDeadlineExceededError(f"No time left to retry after: {error}") from error
+                global_logger.warning(f"LLM request failed, retrying in {delay_seconds:.2f} s: {error}")
+                self.retried_count += 1
+                time.sleep(delay_seconds)
+                self._wait_for_rate_limit()
+                if time.monotonic() >= deadline:
+                    self.deadline_exceeded_count += 1
+                    raise LLMDeadlineExceededError(f"No time left to retry after: {error}") from error
+
+    def _invoke_hedged(self, messages: list[BaseMessage], deadline: float, is_cancelled: Callable[[], bool]) -> str:
+        """
+        Sends a request, and a hedged copy of it if the first one is slower than usual
+        :param messages: Messages to send
+        :param deadline: Monotonic time by which a response must be received
+        :param is_cancelled: Polled while waiting for the responses
+        :return: Content of the first successful response
+        """
+        futures = {self._submit_request(messages=messages, deadline=deadline)}
+        hedge_delay_seconds = self._get_hedge_delay_seconds()
+        hedge_time = time.monotonic() + hedge_delay_seconds if hedge_delay_seconds is not None else None
+        if hedge_time is not None and hedge_time >= deadline:
+            hedge_time = None
+
+        error = None
+        while futures:
+            if is_cancelled():
+                for future in futures:
+                    future.cancel()
+                raise LLMCancelledError("Call cancelled before a response was received")
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if hedge_time is not None and now >= hedge_time:
+                hedge_time = None
+                # Hedging is skipped rather than delaying the calls queued behind the rate limit
+                if self.rate_limiter is None or self.rate_limiter.try_acquire():
+                    self.hedged_count += 1
+                    futures.add(self._submit_request(messages=messages, deadline=deadline))
+            wait_seconds = min(deadline, hedge_time or deadline) - now
+            done, futures = wait(
+                futures, timeout=min(wait_seconds, self.CANCEL_CHECK_INTERVAL_SECONDS), return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is None:
+                    # Slower requests still in flight are left to complete, and their responses are discarded
+                    return future.result()
+                error = future.exception()
+        if error is not None and not futures:
+            raise error
+        self.deadline_exceeded_count += 1
+        raise LLMDeadlineExceededError(f"No response after {self.deadline_seconds} s")
+
+    def _submit_request(self, messages: list[BaseMessage], deadline: float) -> Future:
+        """
+        Sends a single request on the request executor, recording its latency when successful
+        """
+
+        def run() -> str:
+            start_time = time.monotonic()
+            content = self._invoke_once(messages=messages, timeout_seconds=max(0.0, deadline - start_time))
+            with self._lock:
+                self._latencies_seconds.append(time.monotonic() - start_time)
+            return content
+
+        return self._executor.submit(run)
+
+    def _start_stream(self, messages: list[BaseMessage], deadline: float) -> tuple[Iterator[str], str | None]:
+        """
+        Sends a streaming request and waits for its first chunk, so that failures to connect can be retried
+        :return: Iterator over the remaining chunks and the first chunk, None if the response is empty
+        """
+        chunks = self._stream_once(messages=messages, timeout_seconds=max(0.0, deadline - time.monotonic()))
+        return chunks, next(chunks, None)
+
+    def _wait_for_rate_limit(self) -> None:
+        """
+        Waits until the next request can be sent without exceeding the rate limit, if any. Runs on the calling thread
+        """
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+
+    def _get_hedge_delay_seconds(self) -> float | None:
+        """
+        :return: Time after which a request is hedged, or None if hedging is disabled or there are too few samples
+        """
+        if self.hedge_percentile is None:
+            return None
+        with self._lock:
+            if len(self._latencies_seconds) < self.HEDGE_MIN_SAMPLES:
+                return None
+            latencies_seconds = list(self._latencies_seconds)
+        return statistics.quantiles(latencies_seconds, n=100)[round(self.hedge_percentile) - 1]
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    Backend for the OpenAI API, or any server compatible with it. All requests share a pool of HTTP connections
+    """
+
+    MODEL_TEMPERATURE = 0
+
+    def __init__(
+        self,
+        model_name: str,
+        base_url: str | None,
+        request_timeout_seconds: float,
+        max_connections: int,
+        **kwargs,
+    ):
+        """
+        :param model_name: Name of the model
+        :param base_url: URL of the API. The OpenAI API is used if None
+        :param request_timeout_seconds: Maximum duration of a single request
+        :param max_connections: Size of the pool of HTTP connections
+        :param kwargs: Deadline, retry and hedging parameters of LLMBackend
+        """
+        super().__init__(**kwargs)
+        # Imported here since they are slow to import and not needed by other backends
+        import httpx
+        import openai
+        from langchain_openai import ChatOpenAI
+
+        self.model_name = model_name
+        self.request_timeout_seconds = request_timeout_seconds
+        self.retryable_errors = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+        self.http_client: httpx.Client = httpx.Client(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        self.openai_client = openai.OpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=base_url,
+            timeout=request_timeout_seconds,
+            # Retries are handled by the backend, within the deadline of the call
+            max_retries=0,
+            http_client=self.http_client,
+        )
+        self.chat_model = ChatOpenAI(
+            client=self.openai_client.chat.completions,
+            openai_api_key=settings.OPENAI_API_KEY,
+            model=model_name,
+            temperature=self.MODEL_TEMPERATURE,
+        )
+
+    @property
+    def model_description(self) -> str:
+        return f"{self.model_name}:{self.MODEL_TEMPERATURE}"
+
+    def count_tokens(self, messages: list[BaseMessage]) -> int:
+        return self.chat_model.get_num_tokens_from_messages(messages)
+
+    def warm_up(self) -> None:
+        """
+        Loads the tokenizer of the model and opens a pooled connection to the API
+        """
+        try:
+            self.count_tokens([])
+            self.openai_client.models.list()
+        except Exception as error:
+            global_logger.warning(f"Failed to warm up the LLM backend: {error}")
+
+    def close(self) -> None:
+        super().close()
+        self.http_client.close()
+
+    def _invoke_once(self, messages: list[BaseMessage], timeout_seconds: float) -> str:
+        timeout_seconds = min(timeout_seconds, self.request_timeout_seconds)
+        return self.chat_model.invoke(messages, timeout=timeout_seconds).content
+
+    def _stream_once(self, messages: list[BaseMessage], timeout_seconds: float) -> Iterator[str]:
+        timeout_seconds = min(timeout_seconds, self.request_timeout_seconds)
+        return (chunk.content for chunk in self.chat_model.stream(messages, timeout=timeout_seconds))
+
+
+class FakeLLMBackend(LLMBackend):
+    """
+    Backend answering locally with canned commentary after a fixed latency. Used to run the pipeline without network
+    access, e.g. in benchmarks
+    """
+
+    def __init__(self, latency_seconds: float = 0.0, **kwargs):
+        """
+        :param latency_seconds: Time taken by every request
+        :param kwargs: Deadline, retry and hedging parameters of LLMBackend
+        """
+        super().__init__(**kwargs)
+        self.latency_seconds = latency_seconds
+        self.call_count = 0
+
+    @property
+    def model_description(self) -> str:
+        return "fake"
+
+    def count_tokens(self, messages: list[BaseMessage]) -> int:
+        return sum(len(str(message.content).split()) for message in messages)
+
+    def _invoke_once(self, messages: list[BaseMessage], timeout_seconds: float) -> str:
+        self.call_count += 1
+        if self.latency_seconds > timeout_seconds:
+            time.sleep(timeout_seconds)
+            raise TimeoutError("Fake request timed out")
+        time.sleep(self.latency_seconds)
+        return f"What a moment in this game. The latest update was: {str(messages[-1].content)[:80]}."
+
+    def _stream_once(self, messages: list[BaseMessage], timeout_seconds: float) -> Iterator[str]:
+        response = self._invoke_once(messages=messages, timeout_seconds=timeout_seconds)
+        for word in response.split(" "):
+            yield word + " "
+
+
+def create_llm_backend(rate_limiter: RateLimiter | None = None) -> LLMBackend:
+    """
+    Creates the LLM backend selected in the settings
+    :param rate_limiter: Rate limit of all the requests of the backend. Not limited if None
+    :return: LLM backend
+    """
+    backend_parameters = dict(
+        deadline_seconds=settings.LLM_CALL_DEADLINE_SECONDS,
+        max_retries=settings.LLM_MAX_RETRIES,
+        retry_base_delay_seconds=settings.LLM_RETRY_BASE_DELAY_SECONDS,
+        hedge_percentile=settings.LLM_HEDGE_PERCENTILE,
+        max_concurrent_requests=settings.HTTP_MAX_CONNECTIONS,
+        rate_limiter=rate_limiter,
+    )
+    if settings.LLM_BACKEND == "fake":
+        return FakeLLMBackend(**backend_parameters)
+    return OpenAIBackend(
+        model_name=settings.LLM_MODEL_NAME,
+        base_url=settings.LLM_BASE_URL,
+        request_timeout_seconds=settings.LLM_REQUEST_TIMEOUT_SECONDS,
+        max_connections=settings.HTTP_MAX_CONNECTIONS,
+        **backend_parameters,
+    )
@@ -1,10 +1,31 @@
-from langchain.memory import ChatMessageHistory
-from langchain_core.prompts import ChatPromptTemplate, PromptTemplate, MessagesPlaceholder
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterator
 
-from langchain_openai import ChatOpenAI
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate, MessagesPlaceholder
 
 from conf.settings import settings
 from entities.types import FenPosition
+from services.chat_memory import SummarizingChatMemory
+from services.commentary_cache import CommentaryCache
+from services.llm_backend import LLMBackend, LLMCancelledError, LLMDeadlineExceededError, create_llm_backend
+from utils.logger import global_logger
+from utils.metrics import LLM_CALLS, LLM_TOKENS, STAGE_LATENCY
+from utils.text import split_sentences
+
+
+@dataclass(frozen=True)
+class PreparedMessage:
+    """
+    Commentary generated ahead of time, not yet in the chat history
+    """
+
+    prompt: str
+    message: str
+    cache_key: str | None = None
 
 
 class LLMManager:
@@ -28,27 +49,27 @@ class LLMManager:
 
     STARTUP_PROMPT = PromptTemplate.from_template(
         "We are now starting the commentary for the first time. Current game is between {white_name} (with the "
-        "white pieces) and {black_name} with the black pieces. The current position is {fen_position}. Just commentate"
-        "on the position. Do not make up moves. Repeat the name of the players",
-        input_types={"last_move": str, "fen_position": FenPosition, "black_name": str, "white_name": str},
+        "white pieces) and {black_name} with the black pieces. The opening is {opening}. The current position is "
+        "{fen_position}. Just commentate on the position. Do not make up moves. Repeat the name of the players",
+        input_types={"fen_position": FenPosition, "black_name": str, "white_name": str, "opening": str},
     )
 
     NEW_GAME_PROMPT = PromptTemplate.from_template(
-        "Another move has been made. Last move is {last_move}. Current board position is {fen_position}",
+        "The previous game is over and a new one is starting. "
+        "Current game is between {white_name} (with the white pieces) and {black_name} with the black pieces. "
+        "The opening is {opening}. The current position is {fen_position}",
         input_types={
-            "last_move": str,
+            "black_name": str,
+            "white_name": str,
             "fen_position": FenPosition,
+            "opening": str,
         },
     )
 
     COMMENTATING_PROMPT = PromptTemplate.from_template(
-        "The previous game is over and a new one is starting. "
-        "Current game is between {white_name} (with the white pieces) and {black_name} with the black pieces. "
-        "The current position is {fen_position}",
+        "Another move has been made. {position_facts}",
         input_types={
-            "black_name": str,
-            "white_name": str,
-            "fen_position": FenPosition,
+            "position_facts": str,
         },
     )
 
@@ -64,47 +85,286 @@ class LLMManager:
         },
     )
 
-    MODEL_TEMPERATURE = 0
+    ENGINE_DISAGREEMENT_PROMPT = PromptTemplate.from_template(
+        "The chess engines disagree on the current position. {engine_evaluations}. "
+        "Point out the disagreement and what it could mean for the game",
+        input_types={"engine_evaluations": str},
+    )
+
+    UNKNOWN_OPENING = "unknown"
 
-    def __init__(self):
-        self.chat_history = ChatMessageHistory()
+    # Changes whenever a prompt changes, so that commentary generated with older prompts is not reused
+    PROMPT_VERSION = hashlib.sha256(
+        "\x1f".join(
+            [str(message) for message in BASE_PROMPT.messages]
+            + [
+                prompt.template
+                for prompt in (
+                    STARTUP_PROMPT,
+                    NEW_GAME_PROMPT,
+                    COMMENTATING_PROMPT,
+                    EVALUATION_UPDATE_PROMPT,
+                    ENGINE_DISAGREEMENT_PROMPT,
+                )
+            ]
+        ).encode()
+    ).hexdigest()
 
-        self.chain = self.BASE_PROMPT | ChatOpenAI(
-            openai_api_key=settings.OPENAI_API_KEY, model="gpt-4-turbo", temperature=self.MODEL_TEMPERATURE
+    def __init__(
+        self,
+        llm_backend: LLMBackend | None = None,
+        is_stale: Callable[[], bool] | None = None,
+        commentary_cache: CommentaryCache | None = None,
+        summary_executor: ThreadPoolExecutor | None = None,
+    ):
+        """
+        :param llm_backend: Backend the prompts are sent to, so that it can be shared. The backend selected in the
+        settings is created if None
+        :param is_stale: Returns True when the position being commentated has been superseded by a newer one. Requests
+        are cancelled as soon as the position is stale, and responses received once it is stale are discarded
+        :param commentary_cache: Cache of move commentary, shared by all games. Not closed by the manager. Commentary
+        is not cached if None
+        :param summary_executor: Executor summarizing the chat history in the background, shared by all games. The chat
+        history uses a thread of its own if None
+        """
+        self.llm_backend = llm_backend or create_llm_backend()
+        self.is_stale = is_stale or (lambda: False)
+        self.chat_history = SummarizingChatMemory(
+            llm_backend=self.llm_backend,
+            max_verbatim_turns=settings.CHAT_HISTORY_MAX_VERBATIM_TURNS,
+            summary_executor=summary_executor,
         )
+        self.discarded_response_count = 0
+
+        self.last_prompt_token_count = 0
+        self.total_prompt_token_count = 0
+
+        self.commentary_cache = commentary_cache
 
     def generate_startup_commentating_message(
-        self, fen_position: str, last_move: str, black_name: str, white_name: str
-    ) -> str:
-        self.chat_history.add_user_message(
-            self.STARTUP_PROMPT.format(
-                last_move=last_move, fen_position=fen_position, black_name=black_name, white_name=white_name
-            )
+        self,
+        fen_position: str,
+        black_name: str,
+        white_name: str,
+        opening: str | None = None,
+        stream: bool = False,
+    ) -> str | Iterator[str]:
+        prompt = self.STARTUP_PROMPT.format(
+            fen_position=fen_position,
+            black_name=black_name,
+            white_name=white_name,
+            opening=opening or self.UNKNOWN_OPENING,
         )
-        response = self.chain.invoke(input={"messages": self.chat_history.messages})
-        return response.content
+        return self._get_response(prompt=prompt, stream=stream)
+
+    def generate_commentating_message(
+        self, fen_position: FenPosition, last_move: str, position_facts: str, stream: bool = False
+    ) -> str | Iterator[str]:
+        prompt = self.COMMENTATING_PROMPT.format(position_facts=position_facts)
+
+        cache_key = self._make_commentating_cache_key(fen_position=fen_position, last_move=last_move)
+        if cache_key:
+            cached_message = self.commentary_cache.get(cache_key)
+            if cached_message is not None:
+                self.chat_history.add_user_message(prompt)
+                self.chat_history.add_ai_message(cached_message)
+                return split_sentences([cached_message]) if stream else cached_message
+
+        return self._get_response(prompt=prompt, stream=stream, cache_key=cache_key)
+
+    def prepare_commentating_message(
+        self,
+        fen_position: FenPosition,
+        last_move: str,
+        position_facts: str,
+        is_cancelled: Callable[[], bool] | None = None,
+    ) -> PreparedMessage:
+        """
+        Generates the commentary of a move ahead of time, e.g. for a move predicted by the engines, without adding it to
+        the chat history. It is added with `add_prepared_message` once the move is actually played
+        :param fen_position: Position after the move
+        :param last_move: Move in SAN
+        :param position_facts: Facts about the move and the resulting position
+        :param is_cancelled: Returns True when the commentary is no longer needed, cancelling the request
+        :return: Prepared commentary, with an empty message if no response was received
+        """
+        prompt = self.COMMENTATING_PROMPT.format(position_facts=position_facts)
+        cache_key = self._make_commentating_cache_key(fen_position=fen_position, last_move=last_move)
+        cached_message = self.commentary_cache.get(cache_key) if cache_key else None
+        if cached_message is not None:
+            return PreparedMessage(prompt=prompt, message=cached_message)
 
-    def generate_commentating_message(self, fen_position: FenPosition, last_move: str) -> str:
-        self.chat_history.add_user_message(
-            self.COMMENTATING_PROMPT.format(last_move=last_move, fen_position=fen_position)
+        messages = self.BASE_PROMPT.format_messages(
+            messages=self.chat_history.messages + [HumanMessage(content=prompt)]
         )
-        response = self.chain.invoke(input={"messages": self.chat_history.messages})
-        return response.content
+        LLM_TOKENS.inc(self.llm_backend.count_tokens(messages), direction="prompt")
+        try:
+            message = self.llm_backend.invoke(messages, is_cancelled=is_cancelled)
+        except (LLMDeadlineExceededError, LLMCancelledError):
+            LLM_CALLS.inc(outcome="speculation_failed")
+            return PreparedMessage(prompt=prompt, message="")
+        LLM_CALLS.inc(outcome="speculation")
+        LLM_TOKENS.inc(self.llm_backend.count_tokens([AIMessage(content=message)]), direction="completion")
+        return PreparedMessage(prompt=prompt, message=message, cache_key=cache_key)
+
+    def add_prepared_message(self, prepared_message: PreparedMessage) -> None:
+        """
+        Adds commentary generated ahead of time to the chat history, as if it had just been generated
+        :param prepared_message: Commentary returned by `prepare_commentating_message`
+        """
+        self.chat_history.add_user_message(prepared_message.prompt)
+        self.chat_history.add_ai_message(prepared_message.message)
+        if prepared_message.cache_key and self.commentary_cache:
+            self.commentary_cache.put(key=prepared_message.cache_key, message=prepared_message.message)
 
     def generate_new_game_commentating_message(
-        self, fen_position: FenPosition, black_name: str, white_name: str
-    ) -> str:
-        self.chat_history.add_user_message(
-            self.NEW_GAME_PROMPT.format(black_name=black_name, white_name=white_name, fen_position=fen_position)
+        self,
+        fen_position: FenPosition,
+        black_name: str,
+        white_name: str,
+        opening: str | None = None,
+        stream: bool = False,
+    ) -> str | Iterator[str]:
+        # Nothing said about the previous game is relevant anymore
+        self.chat_history.clear()
+        prompt = self.NEW_GAME_PROMPT.format(
+            black_name=black_name,
+            white_name=white_name,
+            fen_position=fen_position,
+            opening=opening or self.UNKNOWN_OPENING,
         )
-        response = self.chain.invoke(input={"messages": self.chat_history.messages})
-        return response.content
-
-    def generate_eval_commentating_message(self, engine_name: str, position_evaluation: str, best_line: str) -> str:
-        self.chat_history.add_user_message(
-            self.EVALUATION_UPDATE_PROMPT.format(
-                engine_name=engine_name, position_evaluation=position_evaluation, best_line=best_line
-            )
+        return self._get_response(prompt=prompt, stream=stream)
+
+    def generate_eval_commentating_message(
+        self, engine_name: str, position_evaluation: str, best_line: str, stream: bool = False
+    ) -> str | Iterator[str]:
+        prompt = self.EVALUATION_UPDATE_PROMPT.format(
+            engine_name=engine_name, position_evaluation=position_evaluation, best_line=best_line
         )
-        response = self.chain.invoke(input={"messages": self.chat_history.messages})
-        return response.content
+        return self._get_response(prompt=prompt, stream=stream)
+
+    def generate_engine_disagreement_commentating_message(
+        self, engine_evaluations: str, stream: bool = False
+    ) -> str | Iterator[str]:
+        prompt = self.ENGINE_DISAGREEMENT_PROMPT.format(engine_evaluations=engine_evaluations)
+        return self._get_response(prompt=prompt, stream=stream)
+
+    def close(self) -> None:
+        """
+        Stops summarizing the chat history. The LLM backend and the commentary cache are left open
+        """
+        self.chat_history.close()
+
+    def _get_response(self, prompt: str, stream: bool, cache_key: str | None = None) -> str | Iterator[str]:
+        """
+        Sends the current chat history followed by the prompt to the LLM. The prompt is added to the chat history
+        together with its response, and left out of it if no response is recorded
+        :param prompt: Content of the new user message
+        :param stream: If true, the response is streamed and returned sentence by sentence as soon as each sentence is
+        complete. Otherwise, waits for the whole completion
+        :param cache_key: If provided, the complete response is stored in the commentary cache under this key
+        :return: The full response, or an iterator over the sentences of the response if streaming. Empty if no
+        response was received in time or the position became stale in the meantime
+        """
+        messages = self.BASE_PROMPT.format_messages(
+            messages=self.chat_history.messages + [HumanMessage(content=prompt)]
+        )
+        self._count_prompt_tokens(messages=messages)
+        if stream:
+            return self._stream_response_sentences(prompt=prompt, messages=messages, cache_key=cache_key)
+
+        try:
+            with STAGE_LATENCY.time(stage="llm_response"):
+                message = self.llm_backend.invoke(messages, is_cancelled=self.is_stale)
+        except LLMDeadlineExceededError as error:
+            global_logger.warning(f"Skipping commentary: {error}")
+            LLM_CALLS.inc(outcome="deadline_exceeded")
+            return ""
+        except LLMCancelledError:
+            global_logger.info("Cancelled commentary of a position that is no longer current")
+            LLM_CALLS.inc(outcome="cancelled")
+            return ""
+        if self.is_stale():
+            global_logger.info("Discarding commentary of a position that is no longer current")
+            self.discarded_response_count += 1
+            LLM_CALLS.inc(outcome="discarded")
+            return ""
+        LLM_CALLS.inc(outcome="ok")
+        self._store_response(prompt=prompt, message=message, cache_key=cache_key)
+        return message
+
+    def _stream_response_sentences(
+        self, prompt: str, messages: list[BaseMessage], cache_key: str | None
+    ) -> Iterator[str]:
+        """
+        Streams the response of the LLM to the given messages, splitting it into sentences
+        :param prompt: Content of the new user message, added to the chat history with the sentences received
+        :param messages: Messages to send to the LLM, system prompt included
+        :param cache_key: If provided, the complete response is stored in the commentary cache under this key
+        :return: Iterator over the sentences of the response. Stops early if the position becomes stale
+        """
+        sentences = []
+        start_time = time.perf_counter()
+        try:
+            for sentence in split_sentences(self.llm_backend.stream(messages, is_cancelled=self.is_stale)):
+                if self.is_stale():
+                    global_logger.info("Discarding the rest of the commentary of a position that is no longer current")
+                    self.discarded_response_count += 1
+                    LLM_CALLS.inc(outcome="discarded")
+                    break
+                if not sentences:
+                    STAGE_LATENCY.observe(time.perf_counter() - start_time, stage="llm_first_sentence")
+                sentences.append(sentence)
+                yield sentence
+            else:
+                STAGE_LATENCY.observe(time.perf_counter() - start_time, stage="llm_response")
+                LLM_CALLS.inc(outcome="ok")
+                self._store_response(prompt=prompt, message=" ".join(sentences), cache_key=cache_key)
+                return
+        except LLMDeadlineExceededError as error:
+            global_logger.warning(f"Stopping commentary: {error}")
+            LLM_CALLS.inc(outcome="deadline_exceeded")
+        except LLMCancelledError:
+            global_logger.info("Cancelled the rest of the commentary of a position that is no longer current")
+            LLM_CALLS.inc(outcome="cancelled")
+        # Only what was actually said is remembered, and incomplete responses are never cached
+        if sentences:
+            self._store_response(prompt=prompt, message=" ".join(sentences), cache_key=None)
+
+    def _make_commentating_cache_key(self, fen_position: FenPosition, last_move: str) -> str | None:
+        """
+        The prompt is built from the precomputed facts, the position and move are only used to key the cache
+        :return: Key of the commentary of a move in the commentary cache, None if the cache is disabled
+        """
+        if not self.commentary_cache:
+            return None
+        return self.commentary_cache.make_key(
+            fen_position=fen_position,
+            last_move=last_move,
+            prompt_version=self.PROMPT_VERSION,
+            model_parameters=self.llm_backend.model_description,
+        )
+
+    def _store_response(self, prompt: str, message: str, cache_key: str | None) -> None:
+        """
+        Records a prompt and its response in the chat history and, if a key is provided, the response in the commentary
+        cache
+        :param prompt: Content of the user message the response answers
+        :param message: Response of the LLM
+        :param cache_key: Key under which to cache the response
+        """
+        self.chat_history.add_user_message(prompt)
+        self.chat_history.add_ai_message(message)
+        LLM_TOKENS.inc(self.llm_backend.count_tokens([AIMessage(content=message)]), direction="completion")
+        if cache_key and self.commentary_cache:
+            self.commentary_cache.put(key=cache_key, message=message)
+
+    def _count_prompt_tokens(self, messages: list[BaseMessage]) -> None:
+        """
+        Counts the tokens of the prompt about to be sent, including the system prompt, and keeps track of the totals
+        :param messages: Messages that will be sent, system prompt included
+        """
+        self.last_prompt_token_count = self.llm_backend.count_tokens(messages)
+        self.total_prompt_token_count += self.last_prompt_token_count
+        LLM_TOKENS.inc(self.last_prompt_token_count, direction="prompt")
+        global_logger.info(f"Prompt tokens: {self.last_prompt_token_count}")
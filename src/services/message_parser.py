@@ -0,0 +1,132 @@
+import json
+from collections import OrderedDict
+
+from utils.logger import global_logger
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+class MessageParser:
+    """
+    Fast, selective parsing of chess information messages. Only the event name is read to decide whether a message is
+    relevant, and only the fields that are actually used are decoded from the large `pgn` frames.
+    """
+
+    PAYLOAD_START_INDEX = 2
+    HEADERS_KEY = '"Headers":'
+    MOVES_KEY = '"Moves":['
+    FEN_KEY = '"fen":"'
+    BEST_LINE_KEY = '"pv":{'
+    MAX_TRACKED_GAMES = 8
+
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, max_tracked_games: int = MAX_TRACKED_GAMES):
+        """
+        :param max_tracked_games: Number of games whose latest position is remembered. The least recently updated game
+        is forgotten first, and its next frame is never skipped
+        """
+        self.max_tracked_games = max_tracked_games
+        # Latest position of the recent games, by round, so that games whose frames take turns are deduplicated apart
+        self._last_game_fens: OrderedDict[str | None, str | None] = OrderedDict()
+        self.skipped_duplicate_count = 0
+
+    @classmethod
+    def peek_event_name(cls, message: str) -> str | None:
+        """
+        Reads the event name of a chess information message (e.g. 42["pgn",{...}]) without decoding its body
+        :param message: Received message
+        :return: Event name, or None if the message is malformed
+        """
+        name_start_index = cls.PAYLOAD_START_INDEX + 2
+        if not message.startswith('["', cls.PAYLOAD_START_INDEX):
+            return None
+        name_end_index = message.find('"', name_start_index)
+        return message[name_start_index:name_end_index] if name_end_index != -1 else None
+
+    def parse_game_data(self, message: str) -> dict | None:
+        """
+        Extracts the headers and the moves from a `pgn` message. The engine options and the rest of the frame are not
+        decoded. The latest position is found with string searches, and frames where it is the same as in the previous
+        frame of the game are skipped before decoding the moves, which make up most of the frame
+        :param message: Received `pgn` message
+        :return: Dict with the `Headers` and `Moves` of the game, or None if the frame is a duplicate
+        """
+        moves_index = message.find(self.MOVES_KEY)
+        headers_index = message.find(self.HEADERS_KEY)
+        if moves_index == -1 or headers_index == -1:
+            return self._parse_game_data_fully(message=message)
+
+        try:
+            headers, _ = self._decoder.raw_decode(message, headers_index + len(self.HEADERS_KEY))
+            game_round = headers.get("Round")
+            fen = self._find_last_move_fen(message=message, moves_index=moves_index)
+            if fen is not None and fen == self._last_game_fens.get(game_round):
+                self.skipped_duplicate_count += 1
+                return None
+            # Moves are in chronological order, so the latest position is in the last one
+            moves, _ = self._decoder.raw_decode(message, moves_index + len(self.MOVES_KEY) - 1)
+            self._remember_last_game_fen(game_round=game_round, fen=moves[-1].get("fen") if moves else None)
+        except (ValueError, AttributeError, TypeError):
+            global_logger.warning("Failed to selectively parse game data, falling back to a full parse")
+            return self._parse_game_data_fully(message=message)
+        return {"Headers": headers, "Moves": moves}
+
+    @classmethod
+    def parse_live_eval_data(cls, message: str) -> dict:
+        """
+        Decodes the body of a `liveeval` message
+        :param message: Received `liveeval` message
+        :return: Dict with the live evaluation data
+        """
+        return json_loads(message[cls.PAYLOAD_START_INDEX :])[1]
+
+    def _find_last_move_fen(self, message: str, moves_index: int) -> str | None:
+        """
+        Finds the position after the last move of a `pgn` message without decoding it. Every move carries its best line,
+        whose moves hold positions too, so the position of the last move is the last one that is not in a best line
+        :param message: Received `pgn` message
+        :param moves_index: Index of the `Moves` array in the message
+        :return: FEN of the last move, or None if not found
+        """
+        search_end_index = len(message)
+        best_line_index = message.rfind(self.BEST_LINE_KEY, moves_index)
+        if best_line_index != -1:
+            # The moves of a best line are flat objects, so the first closing bracket ends them
+            best_line_end_index = message.find("]", best_line_index)
+            if best_line_end_index == -1:
+                return None
+            # Unless a later move without a best line follows, the last move is the one of the last best line
+            if message.find(self.FEN_KEY, best_line_end_index) == -1:
+                search_end_index = best_line_index
+        fen_index = message.rfind(self.FEN_KEY, moves_index, search_end_index)
+        if fen_index == -1:
+            return None
+        fen_start_index = fen_index + len(self.FEN_KEY)
+        return message[fen_start_index : message.find('"', fen_start_index)]
+
+    def _parse_game_data_fully(self, message: str) -> dict:
+        """
+        Decodes the whole `pgn` message. Used when the frame does not have the expected layout
+        :param message: Received `pgn` message
+        :return: Dict with the game data
+        """
+        game_data = json_loads(message[self.PAYLOAD_START_INDEX :])[1]
+        moves = game_data.get("Moves")
+        game_round = (game_data.get("Headers") or {}).get("Round")
+        self._remember_last_game_fen(game_round=game_round, fen=moves[-1].get("fen") if moves else None)
+        return game_data
+
+    def _remember_last_game_fen(self, game_round: str | None, fen: str | None) -> None:
+        """
+        Records the latest position of a game, forgetting the least recently updated game if too many are tracked
+        """
+        self._last_game_fens[game_round] = fen
+        self._last_game_fens.move_to_end(game_round)
+        while len(self._last_game_fens) > self.max_tracked_games:
+            self._last_game_fens.popitem(last=False)
@@ -0,0 +1,118 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Literal
+
+from utils.logger import global_logger
+from utils.metrics import MetricsRegistry
+
+MetricsExport = Literal["none", "http", "file"]
+
+
+class MetricsExporter:
+    """
+    Exports the metrics in the Prometheus text format, either on an HTTP endpoint to be scraped or by periodically
+    rewriting a file, e.g. for the textfile collector of the node exporter.
+    """
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    METRICS_PATH = "/metrics"
+
+    def __init__(
+        self,
+        metrics_registry: MetricsRegistry,
+        export: MetricsExport,
+        http_port: int,
+        file_path: Path,
+        file_interval_seconds: float,
+    ):
+        """
+        :param metrics_registry: Registry of the metrics to export
+        :param export: How metrics are exported. Nothing is exported if "none"
+        :param http_port: Port of the HTTP endpoint
+        :param file_path: Path of the metrics file
+        :param file_interval_seconds: Interval between two writes of the metrics file
+        """
+        self.metrics_registry = metrics_registry
+        self.export = export
+        self.http_port = http_port
+        self.file_path = Path(file_path)
+        self.file_interval_seconds = file_interval_seconds
+
+        self._http_server: ThreadingHTTPServer | None = None
+        self._thread: threading.Thread | None = None
+        self._stop_event = threading.Event()
+
+    def start(self) -> None:
+        """
+        Starts exporting on a background thread, if not running already
+        """
+        if self.export == "none" or (self._thread and self._thread.is_alive()):
+            return
+        self._stop_event.clear()
+        if self.export == "http":
+            self._http_server = ThreadingHTTPServer(("", self.http_port), self._create_request_handler())
+            self._thread = threading.Thread(target=self._http_server.serve_forever, name="metrics-http", daemon=True)
+            global_logger.info(f"Serving metrics on port {self.http_port}{self.METRICS_PATH}")
+        else:
+            self.file_path.parent.mkdir(parents=True, exist_ok=True)
+            self._thread = threading.Thread(target=self._run_file_export, name="metrics-file", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        """
+        Stops exporting. The metrics file, if any, is written one last time
+        """
+        self._stop_event.set()
+        if self._http_server:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def write_file(self) -> None:
+        """
+        Writes the current metrics to the metrics file. The file is replaced atomically, so readers never see it half
+        written
+        """
+        temporary_file_path = self.file_path.with_name(self.file_path.name + ".tmp")
+        try:
+            temporary_file_path.write_text(self.metrics_registry.render())
+            os.replace(temporary_file_path, self.file_path)
+        except OSError:
+            global_logger.exception("Failed to write the metrics file")
+
+    def _run_file_export(self) -> None:
+        """
+        Main loop of the file export thread
+        """
+        while not self._stop_event.wait(timeout=self.file_interval_seconds):
+            self.write_file()
+        self.write_file()
+
+    def _create_request_handler(self) -> type[BaseHTTPRequestHandler]:
+        """
+        :return: Handler of the HTTP requests, serving the metrics on METRICS_PATH
+        """
+        exporter = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != exporter.METRICS_PATH:
+                    self.send_error(404)
+                    return
+                body = exporter.metrics_registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", exporter.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                # Scrapes are frequent, they are not worth a log line each
+                pass
+
+        return MetricsRequestHandler
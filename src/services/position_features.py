@@ -0,0 +1,183 @@
+import re
+from dataclasses import dataclass
+
+import chess
+
+PIECE_VALUES = {chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9, chess.KING: 0}
+MOVE_NUMBER_REGEX = re.compile(r"^(\d+)\.(\.\.)?(.*)$")
+MAX_THREATS = 3
+
+
+@dataclass(frozen=True)
+class PositionFeatures:
+    """
+    Compact facts about a move and the resulting position, computed locally so that the LLM does not have to work them
+    out from a FEN
+    """
+
+    move_label: str
+    """
+    Move number and move in SAN, e.g. "40. Nd3" or "40... Bd8"
+    """
+    piece_moved: str
+    captured_piece: str | None
+    is_check: bool
+    is_checkmate: bool
+    is_castling: bool
+    promotion: str | None
+    material_balance: int
+    """
+    Material balance in pawns from the point of view of white
+    """
+    material: str
+    threats: list[str]
+    opening: str | None
+
+    def format(self) -> str:
+        """
+        :return: Compact, token cheap description of the features
+        """
+        facts = [f"{self.move_label}: {self.piece_moved} move"]
+        if self.is_castling:
+            facts.append("castling")
+        if self.captured_piece:
+            facts.append(f"captures a {self.captured_piece}")
+        if self.promotion:
+            facts.append(f"promotes to a {self.promotion}")
+        if self.is_checkmate:
+            facts.append("checkmate")
+        elif self.is_check:
+            facts.append("check")
+
+        description = ", ".join(facts) + ". "
+        if self.material_balance:
+            leader = "White" if self.material_balance > 0 else "Black"
+            description += f"{leader} is up {abs(self.material_balance)} in material ({self.material}). "
+        else:
+            description += f"Material is even ({self.material}). "
+        if self.threats:
+            description += "Threats: " + "; ".join(self.threats) + ". "
+        if self.opening:
+            description += f"Opening: {self.opening}."
+        return description.strip()
+
+
+def get_material_balance(board: chess.Board) -> int:
+    """
+    :param board: Board to evaluate
+    :return: Material balance in pawns from the point of view of white
+    """
+    return sum(
+        value * (len(board.pieces(piece_type, chess.WHITE)) - len(board.pieces(piece_type, chess.BLACK)))
+        for piece_type, value in PIECE_VALUES.items()
+    )
+
+
+def describe_material(board: chess.Board) -> str:
+    """
+    :param board: Board to describe
+    :return: Pieces of both sides in a compact notation, e.g. "White KRBNPPP vs Black KRBPP"
+    """
+    sides = []
+    for color, color_name in ((chess.WHITE, "White"), (chess.BLACK, "Black")):
+        pieces = "".join(
+            chess.piece_symbol(piece_type).upper() * len(board.pieces(piece_type, color))
+            for piece_type in (chess.KING, chess.QUEEN, chess.ROOK, chess.BISHOP, chess.KNIGHT, chess.PAWN)
+        )
+        sides.append(f"{color_name} {pieces}")
+    return " vs ".join(sides)
+
+
+def find_threats(board: chess.Board) -> list[str]:
+    """
+    Finds the pieces of the side to move that are attacked and either undefended or attacked by a cheaper piece
+    :param board: Board to analyse
+    :return: Human readable descriptions of the most valuable threatened pieces
+    """
+    threats = []
+    color = board.turn
+    for square, piece in board.piece_map().items():
+        if piece.color != color or piece.piece_type == chess.KING:
+            continue
+        attackers = board.attackers(not color, square)
+        if not attackers:
+            continue
+        cheapest_attacker_value = min(PIECE_VALUES[board.piece_type_at(attacker)] for attacker in attackers)
+        is_defended = bool(board.attackers(color, square))
+        if not is_defended or cheapest_attacker_value < PIECE_VALUES[piece.piece_type]:
+            status = "undefended" if not is_defended else "attacked by a cheaper piece"
+            description = (
+                f"{chess.COLOR_NAMES[color]} {chess.piece_name(piece.piece_type)} on {chess.square_name(square)} "
+                f"is {status}"
+            )
+            threats.append((PIECE_VALUES[piece.piece_type], description))
+    return [description for _, description in sorted(threats, reverse=True)[:MAX_THREATS]]
+
+
+def extract_position_features(board_before: chess.Board, move: chess.Move, opening: str | None) -> PositionFeatures:
+    """
+    Computes the features of a move and of the position it leads to
+    :param board_before: Board before the move is played. Not modified
+    :param move: Move played
+    :param opening: Name of the opening, e.g. "B40 Sicilian defence", if known
+    :return: Features of the move and of the resulting position
+    """
+    piece = board_before.piece_at(move.from_square)
+    captured_piece_type = None
+    if board_before.is_capture(move):
+        captured_piece_type = (
+            chess.PAWN if board_before.is_en_passant(move) else board_before.piece_type_at(move.to_square)
+        )
+
+    move_number = board_before.fullmove_number
+    san = board_before.san(move)
+    move_label = f"{move_number}. {san}" if board_before.turn == chess.WHITE else f"{move_number}... {san}"
+
+    board_after = board_before.copy(stack=False)
+    board_after.push(move)
+    return PositionFeatures(
+        move_label=move_label,
+        piece_moved=f"{chess.COLOR_NAMES[piece.color]} {chess.piece_name(piece.piece_type)}" if piece else "unknown",
+        captured_piece=chess.piece_name(captured_piece_type) if captured_piece_type else None,
+        is_check=board_after.is_check(),
+        is_checkmate=board_after.is_checkmate(),
+        is_castling=board_before.is_castling(move),
+        promotion=chess.piece_name(move.promotion) if move.promotion else None,
+        material_balance=get_material_balance(board_after),
+        material=describe_material(board_after),
+        threats=find_threats(board_after),
+        opening=opening,
+    )
+
+
+def truncate_best_line(best_line: str, max_plies: int) -> str:
+    """
+    Truncates an engine principal variation to its first plies, keeping move numbers
+    :param best_line: Principal variation in SAN, e.g. "40...g4 41. Bc4 Bf6 42. Rc2"
+    :param max_plies: Maximum number of plies to keep
+    :return: Truncated principal variation, e.g. "40...g4 41. Bc4"
+    """
+    tokens = []
+    plies = 0
+    for token in best_line.split():
+        match = MOVE_NUMBER_REGEX.match(token)
+        # Move numbers are glued to the move for black ("40...g4") but separate for white ("41. Bc4")
+        san = match.group(3) if match else token
+        if plies >= max_plies:
+            break
+        tokens.append(token)
+        plies += bool(san)
+    return " ".join(tokens)
+
+
+def get_first_move(best_line: str) -> str | None:
+    """
+    :param best_line: Principal variation in SAN, e.g. "40...g4 41. Bc4 Bf6"
+    :return: First move of the principal variation in SAN, e.g. "g4", or None if it is empty
+    """
+    for token in best_line.split():
+        match = MOVE_NUMBER_REGEX.match(token)
+        san = match.group(3) if match else token
+        if san:
+            return san
+    return None
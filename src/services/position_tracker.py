@@ -0,0 +1,142 @@
+from dataclasses import dataclass, field
+from typing import Sequence
+
+import chess
+
+from entities.entities import PlayedMove, PositionUpdateKindEnum
+from entities.types import FenPosition
+from utils.logger import global_logger
+
+
+def get_fullmove_number(fen_position: FenPosition) -> int | None:
+    """
+    Reads the fullmove number of a FEN without building a board
+    :param fen_position: Position in FEN
+    :return: Fullmove number, or None if the FEN does not have one
+    """
+    try:
+        return int(fen_position.split()[5])
+    except (IndexError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class PositionUpdate:
+    kind: PositionUpdateKindEnum
+    board_before: chess.Board | None = None
+    """
+    Board before the last move, if the last move is known
+    """
+    move: chess.Move | None = None
+    """
+    Last move, leading to the received position
+    """
+    skipped_moves: list[str] = field(default_factory=list)
+    """
+    Moves in SAN played since the previous position and before the last move, caught up from the received moves
+    """
+
+
+class PositionTracker:
+    """
+    Follows the position of a single game from the received frames. Repeated frames are recognised by their FEN string
+    without building a board, and new moves are applied incrementally to the tracked board. When frames were missed,
+    the moves sent with every frame are used to catch up, so that a gap of a few plies is not mistaken for a new game.
+    """
+
+    def __init__(self):
+        self.board: chess.Board | None = None
+        self.fen_position: FenPosition | None = None
+        """
+        Last received FEN. Compared as received, since FENs from the server and from python-chess may differ in the en
+        passant square
+        """
+
+    def update(self, fen_position: FenPosition, last_move: str, moves: Sequence[PlayedMove] = ()) -> PositionUpdate:
+        """
+        Updates the tracked position from a received frame
+        :param fen_position: Received position
+        :param last_move: Last move in SAN, leading to the received position
+        :param moves: Latest moves of the game sent with the frame, in chronological order
+        :return: What changed since the previous frame
+        """
+        if fen_position == self.fen_position:
+            return PositionUpdate(kind=PositionUpdateKindEnum.Duplicate)
+        moves = list(moves) or [PlayedMove(san=last_move, fen_position=fen_position)]
+
+        if self.board is None:
+            self._reset(fen_position=fen_position)
+            return PositionUpdate(kind=PositionUpdateKindEnum.Initial)
+
+        update = self._catch_up(fen_position=fen_position, moves=moves)
+        if update is not None:
+            return update
+
+        # The previous position is not among the received moves, either too many frames were missed or a new game
+        # started. Games only move forward, so a lower move number means a new game
+        fullmove_number = get_fullmove_number(fen_position)
+        if fullmove_number is None or fullmove_number < self.board.fullmove_number or fullmove_number == 1:
+            self._reset(fen_position=fen_position)
+            return PositionUpdate(kind=PositionUpdateKindEnum.NewGame)
+
+        global_logger.info(
+            f"Lost track of the game at move {self.board.fullmove_number}, resuming at move {fullmove_number}"
+        )
+        board_before, move = self._get_last_move_from_frame(moves=moves)
+        self._reset(fen_position=fen_position)
+        return PositionUpdate(kind=PositionUpdateKindEnum.Resync, board_before=board_before, move=move)
+
+    def _catch_up(self, fen_position: FenPosition, moves: list[PlayedMove]) -> PositionUpdate | None:
+        """
+        Applies the received moves played since the tracked position
+        :return: Update with the applied moves, or None if the tracked position cannot be linked to the received moves
+        """
+        # Either the tracked position is the result of one of the received moves, or the first received move is played
+        # from it
+        start_index = 0
+        for index in range(len(moves) - 1, -1, -1):
+            if moves[index].fen_position == self.fen_position:
+                start_index = index + 1
+                break
+        new_moves = moves[start_index:]
+        if not new_moves:
+            return None
+
+        board = self.board.copy(stack=False)
+        try:
+            for played_move in new_moves[:-1]:
+                board.push_san(played_move.san)
+            board_before = board.copy(stack=False)
+            move = board.push_san(new_moves[-1].san)
+        except ValueError:
+            return None
+        # Only the piece placement is compared, the rest of the FEN is not formatted identically everywhere
+        if board.board_fen() != fen_position.split(" ", 1)[0]:
+            return None
+
+        self.board = board
+        self.fen_position = fen_position
+        return PositionUpdate(
+            kind=PositionUpdateKindEnum.Moves,
+            board_before=board_before,
+            move=move,
+            skipped_moves=[played_move.san for played_move in new_moves[:-1]],
+        )
+
+    def _reset(self, fen_position: FenPosition) -> None:
+        self.board = chess.Board(fen=fen_position)
+        self.fen_position = fen_position
+
+    @staticmethod
+    def _get_last_move_from_frame(moves: list[PlayedMove]) -> tuple[chess.Board | None, chess.Move | None]:
+        """
+        Rebuilds the last move from the position before it, if the frame contains it
+        :return: Board before the last move and the last move, or None for both if they cannot be rebuilt
+        """
+        if len(moves) < 2:
+            return None, None
+        try:
+            board_before = chess.Board(fen=moves[-2].fen_position)
+            return board_before, board_before.parse_san(moves[-1].san)
+        except ValueError:
+            return None, None
@@ -0,0 +1,131 @@
+import math
+import statistics
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterator
+
+from services.dump_writer import open_dump_file, parse_dump_record
+from utils.logger import global_logger
+
+
+def parse_replay_speed(speed: str) -> float:
+    """
+    Parses a replay speed mode
+    :param speed: "realtime", "asap" (as fast as possible) or an acceleration factor such as "10x"
+    :return: Acceleration factor, math.inf for as fast as possible
+    :raises ValueError: If the speed is not one of the modes nor a positive factor
+    """
+    speed = speed.strip().lower()
+    if speed == "realtime":
+        return 1.0
+    if speed == "asap":
+        return math.inf
+    try:
+        factor = float(speed.removesuffix("x"))
+    except ValueError:
+        factor = math.nan
+    if not factor > 0:
+        raise ValueError(f'Replay speed must be "realtime", "asap" or a positive factor such as "10x", got: {speed}')
+    return factor
+
+
+@dataclass
+class ReplaySummary:
+    message_count: int = 0
+    elapsed_seconds: float = 0.0
+    handling_latencies_seconds: list[float] = field(default_factory=list)
+    max_lag_seconds: float = 0.0
+    drain_seconds: float = 0.0
+    coalesced_count: int = 0
+    dropped_count: int = 0
+
+    @property
+    def throughput_messages_per_second(self) -> float:
+        return self.message_count / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+    def format(self) -> str:
+        """
+        :return: Human readable summary of the replay
+        """
+        latencies_milliseconds = sorted(latency * 1000 for latency in self.handling_latencies_seconds)
+        if len(latencies_milliseconds) >= 2:
+            percentiles = statistics.quantiles(latencies_milliseconds, n=100)
+            p50, p95, p99 = percentiles[49], percentiles[94], percentiles[98]
+        else:
+            p50 = p95 = p99 = latencies_milliseconds[0] if latencies_milliseconds else 0.0
+        return (
+            f"Replayed {self.message_count} messages in {self.elapsed_seconds:.2f} s "
+            f"({self.throughput_messages_per_second:.1f} messages/s). "
+            f"Handling latency p50: {p50:.2f} ms, p95: {p95:.2f} ms, p99: {p99:.2f} ms, "
+            f"max: {latencies_milliseconds[-1] if latencies_milliseconds else 0.0:.2f} ms. "
+            f"Max lag behind schedule: {self.max_lag_seconds:.2f} s. "
+            f"Commentary finished {self.drain_seconds:.2f} s after the last message, "
+            f"{self.coalesced_count} messages coalesced and {self.dropped_count} dropped"
+        )
+
+
+class DumpReplayer:
+    """
+    Replays a dump file line by line, without loading it in memory, reproducing the recorded arrival timing of the
+    messages scaled by a speed factor.
+    """
+
+    def __init__(self, handle_message: Callable[[str], None], speed: float, default_interval_seconds: float):
+        """
+        :param handle_message: Called with every replayed message
+        :param speed: Acceleration factor with respect to the recorded timing, math.inf to replay as fast as possible
+        :param default_interval_seconds: Interval between messages of dumps without recorded timestamps, at speed 1
+        """
+        self.handle_message = handle_message
+        self.speed = speed
+        self.default_interval_seconds = default_interval_seconds
+
+    @staticmethod
+    def iter_records(dump_data_filepath: Path, start_offset: int = 0) -> Iterator[tuple[float | None, str]]:
+        """
+        Lazily reads the records of a dump file, compressed or not
+        :param dump_data_filepath: Path of the dump file
+        :param start_offset: Byte offset at which to start reading, taken from the offset index of the dump
+        :return: Iterator over receive timestamps (None if not recorded) and messages
+        """
+        with open_dump_file(dump_data_filepath, start_offset=start_offset) as file:
+            for line in file:
+                if line.strip():
+                    yield parse_dump_record(line)
+
+    def replay(self, dump_data_filepath: Path, start_offset: int = 0) -> ReplaySummary:
+        """
+        Replays all the messages of a dump file
+        :param dump_data_filepath: Path of the dump file
+        :param start_offset: Byte offset at which to start replaying, taken from the offset index of the dump
+        :return: Throughput and latency summary of the replay
+        """
+        summary = ReplaySummary()
+        start_time = time.perf_counter()
+        first_timestamp = None
+        scheduled_offset_seconds = 0.0
+
+        for received_timestamp, message in self.iter_records(dump_data_filepath, start_offset=start_offset):
+            if received_timestamp is not None:
+                first_timestamp = received_timestamp if first_timestamp is None else first_timestamp
+                scheduled_offset_seconds = (received_timestamp - first_timestamp) / self.speed
+            elif summary.message_count:
+                scheduled_offset_seconds += self.default_interval_seconds / self.speed
+
+            delay_seconds = start_time + scheduled_offset_seconds - time.perf_counter()
+            if delay_seconds > 0:
+                time.sleep(delay_seconds)
+            elif math.isfinite(self.speed):
+                summary.max_lag_seconds = max(summary.max_lag_seconds, -delay_seconds)
+
+            handling_start_time = time.perf_counter()
+            try:
+                self.handle_message(message)
+            except Exception:
+                global_logger.exception("Failed to handle replayed message")
+            summary.handling_latencies_seconds.append(time.perf_counter() - handling_start_time)
+            summary.message_count += 1
+
+        summary.elapsed_seconds = time.perf_counter() - start_time
+        return summary
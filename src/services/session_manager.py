@@ -0,0 +1,481 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Hashable
+
+from conf.settings import settings
+from entities.entities import CommentaryPriorityEnum, PositionData, PositionEvaluationData
+from entities.types import GameKey
+from services.audio_player import AudioPlayer, create_audio_player
+from services.audio_sinks import HttpStreamSink
+from services.chess_commentator import ChessCommentator
+from services.commentary_cache import CommentaryCache, create_commentary_cache
+from services.commentary_scheduler import CommentaryScheduler
+from services.commentary_speculator import CommentarySpeculator, SpeculationBudget
+from services.llm_backend import LLMBackend, create_llm_backend
+from services.llm_manager import LLMManager
+from services.speech_synthesizer import SpeechSynthesizer, create_speech_synthesizer
+from services.work_queue import LatestWinsQueue
+from utils.logger import global_logger
+from utils.metrics import STAGE_LATENCY, global_metrics
+
+
+@dataclass
+class SharedResources:
+    """
+    Resources that are expensive to create and shared by all commentary sessions: the speech synthesizer with its voice
+    models and audio cache, the audio output, the LLM backend with its pool of HTTP connections, and the commentary
+    cache.
+    """
+
+    llm_backend: LLMBackend
+    commentary_scheduler: CommentaryScheduler
+    speech_synthesizer: SpeechSynthesizer | None = None
+    audio_player: AudioPlayer | None = None
+    speech_lock: threading.Lock = field(default_factory=threading.Lock)
+    """
+    Held while the audio of a commentary is queued, so that commentary of different sessions is never interleaved
+    """
+    commentary_cache: CommentaryCache | None = None
+    """
+    Cache of move commentary, if enabled
+    """
+    speculation_budget: SpeculationBudget | None = None
+    """
+    Budget of speculative LLM calls, if speculation is enabled
+    """
+    speculation_executor: ThreadPoolExecutor | None = None
+    """
+    Executor preparing the commentary of predicted moves, if speculation is enabled
+    """
+    summary_executor: ThreadPoolExecutor | None = None
+    """
+    Executor summarizing the chat histories of all sessions in the background. Every session uses a thread of its own
+    if None
+    """
+
+    @classmethod
+    def create(cls) -> "SharedResources":
+        """
+        Creates the shared resources according to the settings. The voice models and the LLM backend are warmed up in
+        the background, so that this returns quickly and the warm up overlaps with the connection to the websocket
+        """
+        llm_backend = create_llm_backend()
+        threading.Thread(target=llm_backend.warm_up, name="llm-warm-up", daemon=True).start()
+        commentary_cache = create_commentary_cache()
+        summary_executor = ThreadPoolExecutor(
+            max_workers=settings.MAX_CONCURRENT_COMMENTARIES, thread_name_prefix="chat-summary"
+        )
+        speculation_budget = None
+        speculation_executor = None
+        if settings.SPECULATION_ENABLED:
+            speculation_budget = SpeculationBudget(max_calls_per_hour=settings.SPECULATION_MAX_CALLS_PER_HOUR)
+            speculation_executor = ThreadPoolExecutor(
+                max_workers=settings.SPECULATION_MAX_PREDICTIONS_PER_POSITION * settings.MAX_CONCURRENT_COMMENTARIES,
+                thread_name_prefix="speculation",
+            )
+        if settings.SILENT_MODE:
+            return cls(
+                llm_backend=llm_backend,
+                commentary_scheduler=CommentaryScheduler(
+                    max_staleness_seconds=settings.COMMENTARY_MAX_STALENESS_SECONDS
+                ),
+                commentary_cache=commentary_cache,
+                speculation_budget=speculation_budget,
+                speculation_executor=speculation_executor,
+                summary_executor=summary_executor,
+            )
+
+        speech_synthesizer = create_speech_synthesizer()
+        audio_player = create_audio_player(sample_rate=speech_synthesizer.sample_rate)
+        audio_player.start()
+        return cls(
+            llm_backend=llm_backend,
+            commentary_scheduler=CommentaryScheduler(
+                max_staleness_seconds=settings.COMMENTARY_MAX_STALENESS_SECONDS, audio_player=audio_player
+            ),
+            speech_synthesizer=speech_synthesizer,
+            audio_player=audio_player,
+            commentary_cache=commentary_cache,
+            speculation_budget=speculation_budget,
+            speculation_executor=speculation_executor,
+            summary_executor=summary_executor,
+        )
+
+    def close(self) -> None:
+        """
+        Plays the remaining audio and releases all resources
+        """
+        if self.audio_player:
+            self.audio_player.flush()
+            self.audio_player.close()
+        if self.speculation_executor:
+            self.speculation_executor.shutdown(wait=True, cancel_futures=True)
+        if self.summary_executor:
+            # Summaries in progress are cancelled by their closed sessions, before the LLM backend is closed
+            self.summary_executor.shutdown(wait=True, cancel_futures=True)
+        if self.speech_synthesizer:
+            self.speech_synthesizer.close()
+        if self.commentary_cache:
+            self.commentary_cache.close()
+        self.llm_backend.close()
+
+
+class CommentarySession:
+    """
+    Commentary state of a single game: its own commentator, with an isolated chat history, and its own latest-wins
+    queue of pending messages, taken by priority. Runs as a coroutine on the event loop of the session manager.
+    """
+
+    def __init__(self, game_key: GameKey, shared_resources: SharedResources, max_queue_size: int):
+        self.game_key = game_key
+        self.work_queue = LatestWinsQueue(max_size=max_queue_size)
+        self.commentary_scheduler = shared_resources.commentary_scheduler
+        llm_manager = LLMManager(
+            llm_backend=shared_resources.llm_backend,
+            is_stale=self.is_stale,
+            commentary_cache=shared_resources.commentary_cache,
+            summary_executor=shared_resources.summary_executor,
+        )
+        commentary_speculator = None
+        if shared_resources.speculation_budget and shared_resources.speculation_executor:
+            commentary_speculator = CommentarySpeculator(
+                llm_manager=llm_manager,
+                executor=shared_resources.speculation_executor,
+                budget=shared_resources.speculation_budget,
+                max_predictions_per_position=settings.SPECULATION_MAX_PREDICTIONS_PER_POSITION,
+                speech_synthesizer=shared_resources.speech_synthesizer if settings.SPECULATION_PRESYNTHESIZE else None,
+                wait_timeout_seconds=settings.LLM_CALL_DEADLINE_SECONDS,
+            )
+        self.chess_commentator = ChessCommentator(
+            llm_manager=llm_manager,
+            speech_synthesizer=shared_resources.speech_synthesizer,
+            audio_player=shared_resources.audio_player,
+            speech_lock=shared_resources.speech_lock,
+            commentary_scheduler=shared_resources.commentary_scheduler,
+            game_key=game_key,
+            commentary_speculator=commentary_speculator,
+        )
+        self.last_activity_time = time.monotonic()
+        self._has_position = False
+
+        self._has_work = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self, slots: asyncio.Semaphore, executor: ThreadPoolExecutor) -> None:
+        """
+        Starts processing the queue of the session
+        :param slots: Semaphore bounding how many sessions process an item at the same time
+        :param executor: Executor on which the blocking commentary work is run
+        """
+        self._task = asyncio.create_task(self._run(slots=slots, executor=executor), name=f"session-{self.game_key}")
+
+    def stop(self) -> asyncio.Task | None:
+        """
+        Stops processing the queue. The item currently being processed, if any, is completed in the executor
+        :return: Task of the session, cancelled, to be awaited for it to finish. None if the session was never started
+        """
+        if self._task:
+            self._task.cancel()
+        return self._task
+
+    def close(self) -> None:
+        """
+        Releases the chat history of the session. The shared resources are left open
+        """
+        self.chess_commentator.llm_manager.close()
+
+    def put(self, key: Hashable, item: PositionData | PositionEvaluationData) -> None:
+        """
+        Enqueues an item, superseding any pending item with the same key. A position also supersedes the pending
+        evaluations, which refer to an older position, and the first position of the game is a new game. Less urgent
+        commentary in progress is preempted
+        """
+        if isinstance(item, PositionData):
+            priority = CommentaryPriorityEnum.Move if self._has_position else CommentaryPriorityEnum.NewGame
+            self._has_position = True
+            self.work_queue.discard(lambda pending_item: isinstance(pending_item, PositionEvaluationData))
+        else:
+            priority = CommentaryPriorityEnum.Evaluation
+        self.commentary_scheduler.preempt(game_key=self.game_key, priority=priority)
+        self.work_queue.put(key=key, item=item, priority=priority)
+        self.last_activity_time = time.monotonic()
+        self._has_work.set()
+
+    @property
+    def is_idle(self) -> bool:
+        return self.work_queue.unfinished_count == 0
+
+    def has_newer_position(self) -> bool:
+        """
+        :return: True if a position is waiting to be commentated, making the commentary in progress stale
+        """
+        return self.work_queue.has_pending(lambda item: isinstance(item, PositionData))
+
+    def is_stale(self) -> bool:
+        """
+        :return: True if the commentary in progress was superseded by a newer position, preempted by a more urgent
+        message or is too old. The commentary of a new game is never superseded by its next move
+        """
+        is_new_game = self.commentary_scheduler.get_active_priority(self.game_key) == CommentaryPriorityEnum.NewGame
+        is_superseded = not is_new_game and self.has_newer_position()
+        return is_superseded or self.commentary_scheduler.is_stale(self.game_key)
+
+    async def _run(self, slots: asyncio.Semaphore, executor: ThreadPoolExecutor) -> None:
+        """
+        Processes items one at a time, so that the commentary of a game stays in order. Waiters on the semaphore are
+        served first come first served, and each session waits for at most one slot, so sessions take turns fairly
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._has_work.wait()
+            async with slots:
+                # Taken only once a slot is free, so that items superseded while waiting are never processed
+                item = self.work_queue.get(timeout=0)
+                if item is None:
+                    self._has_work.clear()
+                    continue
+                try:
+                    await loop.run_in_executor(executor, self._process_item, item)
+                except Exception:
+                    global_logger.exception(f"Failed to process work item of game {self.game_key}: {item}")
+                finally:
+                    self.work_queue.task_done()
+                    self.last_activity_time = time.monotonic()
+
+    def _process_item(self, item: PositionData | PositionEvaluationData) -> None:
+        """
+        Passes a single item to the matching method of the chess commentator. Runs on the executor
+        :param item: Item taken from the work queue
+        """
+        if item.received_time is not None:
+            STAGE_LATENCY.observe(time.monotonic() - item.received_time, stage="queue_wait")
+        if isinstance(item, PositionData):
+            self.chess_commentator.process_position_data(
+                fen_position=item.fen_position,
+                last_move=item.last_move,
+                white_name=item.white_name,
+                black_name=item.black_name,
+                opening=item.opening,
+                received_time=item.received_time,
+                moves=item.moves,
+            )
+        elif isinstance(item, PositionEvaluationData):
+            self.chess_commentator.process_position_evaluation_data(
+                engine_name=item.engine_name,
+                position_evaluation=item.position_evaluation,
+                best_line=item.best_line,
+                game_key=item.game_key,
+                wdl=item.wdl,
+                depth=item.depth,
+                received_time=item.received_time,
+            )
+        else:
+            global_logger.warning(f"Unknown work item type: {type(item)}")
+
+
+class SessionManager:
+    """
+    Commentates several games concurrently from a single process. Every game, identified by its round, gets its own
+    commentary session, while the voice model, audio output and HTTP connection pool are shared. Sessions run as
+    coroutines on one event loop thread, and their blocking LLM and synthesis work is scheduled fairly on a bounded
+    executor, so the number of threads does not grow with the number of games.
+    """
+
+    IDLE_CHECK_INTERVAL_SECONDS = 0.05
+
+    def __init__(self, shared_resources: SharedResources | None = None):
+        self.shared_resources = shared_resources or SharedResources.create()
+        self.sessions: dict[GameKey, CommentarySession] = {}
+
+        self._loop = asyncio.new_event_loop()
+        self._thread: threading.Thread | None = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.MAX_CONCURRENT_COMMENTARIES, thread_name_prefix="commentary"
+        )
+        self._slots: asyncio.Semaphore | None = None
+        # Cancelled tasks of retired sessions, awaited on stop if they have not finished yet
+        self._retired_tasks: set[asyncio.Task] = set()
+        self._retired_coalesced_count = 0
+        self._retired_dropped_count = 0
+        self._register_metrics()
+
+    @property
+    def coalesced_count(self) -> int:
+        return self._retired_coalesced_count + sum(s.work_queue.coalesced_count for s in self.sessions.values())
+
+    @property
+    def dropped_count(self) -> int:
+        return self._retired_dropped_count + sum(s.work_queue.dropped_count for s in self.sessions.values())
+
+    def start(self) -> None:
+        """
+        Starts the event loop thread, if not running already
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run_loop, name="session-manager", daemon=True)
+        self._thread.start()
+
+    def submit(self, game_key: GameKey, key: Hashable, item: PositionData | PositionEvaluationData) -> None:
+        """
+        Enqueues an item on the session of its game. Thread safe and never blocks, meant to be called from the threads
+        receiving messages
+        :param game_key: Game the item refers to
+        :param key: Key identifying which items supersede each other
+        :param item: Item to be commentated
+        """
+        self._loop.call_soon_threadsafe(self._submit, game_key, key, item)
+
+    def wait_until_idle(self) -> None:
+        """
+        Blocks until every submitted item has been processed
+        """
+        asyncio.run_coroutine_threadsafe(self._wait_until_idle(), self._loop).result()
+
+    def stop(self) -> None:
+        """
+        Stops all sessions and the event loop, then releases the shared resources
+        """
+        if self._thread and self._thread.is_alive():
+            asyncio.run_coroutine_threadsafe(self._stop_sessions(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+        self.shared_resources.close()
+
+    def _register_metrics(self) -> None:
+        """
+        Exposes the state of the sessions and of the shared resources as metrics
+        """
+        global_metrics.register_callback(
+            "commentator_sessions", "Active commentary sessions", "gauge", lambda: len(self.sessions)
+        )
+        global_metrics.register_callback(
+            "commentator_queue_depth",
+            "Messages waiting to be commentated, over all sessions",
+            "gauge",
+            lambda: sum(len(session.work_queue) for session in list(self.sessions.values())),
+        )
+        global_metrics.register_callback(
+            "commentator_messages_coalesced_total",
+            "Pending messages superseded by a newer one",
+            "counter",
+            lambda: self.coalesced_count,
+        )
+        global_metrics.register_callback(
+            "commentator_messages_dropped_total",
+            "Pending messages dropped because a queue was full",
+            "counter",
+            lambda: self.dropped_count,
+        )
+        llm_backend = self.shared_resources.llm_backend
+        for name, description, attribute in (
+            ("commentator_llm_retries_total", "Retried LLM requests", "retried_count"),
+            ("commentator_llm_hedged_requests_total", "Hedged LLM requests", "hedged_count"),
+            ("commentator_llm_deadline_exceeded_total", "LLM calls past their deadline", "deadline_exceeded_count"),
+        ):
+            global_metrics.register_callback(
+                name, description, "counter", lambda attribute=attribute: getattr(llm_backend, attribute)
+            )
+        audio_player = self.shared_resources.audio_player
+        if audio_player:
+            global_metrics.register_callback(
+                "commentator_audio_buffered_seconds",
+                "Audio queued for playback",
+                "gauge",
+                lambda: audio_player.buffered_samples / audio_player.sample_rate,
+            )
+            for sink in audio_player.sinks:
+                if isinstance(sink, HttpStreamSink):
+                    global_metrics.register_callback(
+                        "commentator_audio_stream_listeners",
+                        "Listeners connected to the audio stream",
+                        "gauge",
+                        lambda sink=sink: sink.listener_count,
+                    )
+        speculation_budget = self.shared_resources.speculation_budget
+        if speculation_budget:
+            global_metrics.register_callback(
+                "commentator_speculation_hit_ratio",
+                "Share of the played moves that had been predicted, over the positions speculated on",
+                "gauge",
+                lambda: speculation_budget.hit_rate,
+            )
+
+    def _run_loop(self) -> None:
+        """
+        Main function of the event loop thread
+        """
+        asyncio.set_event_loop(self._loop)
+        self._slots = asyncio.Semaphore(settings.MAX_CONCURRENT_COMMENTARIES)
+        self._loop.run_forever()
+
+    def _submit(self, game_key: GameKey, key: Hashable, item: PositionData | PositionEvaluationData) -> None:
+        """
+        Enqueues an item on the session of its game, creating the session if needed. Runs on the event loop
+        """
+        session = self.sessions.get(game_key)
+        if session is None:
+            session = self._create_session(game_key=game_key)
+        session.put(key=key, item=item)
+
+    def _create_session(self, game_key: GameKey) -> CommentarySession:
+        """
+        Creates and starts the session of a new game, retiring idle sessions first. Runs on the event loop
+        """
+        self._retire_sessions()
+        global_logger.info(f"Starting commentary session for game {game_key}")
+        session = CommentarySession(
+            game_key=game_key, shared_resources=self.shared_resources, max_queue_size=settings.WORK_QUEUE_MAX_SIZE
+        )
+        session.start(slots=self._slots, executor=self._executor)
+        self.sessions[game_key] = session
+        return session
+
+    def _retire_sessions(self) -> None:
+        """
+        Stops the sessions of games that have been idle for too long, and the least recently active idle sessions if
+        there are too many. Runs on the event loop
+        """
+        now = time.monotonic()
+        idle_sessions = sorted(
+            (session for session in self.sessions.values() if session.is_idle), key=lambda s: s.last_activity_time
+        )
+        for session in idle_sessions:
+            is_expired = now - session.last_activity_time > settings.SESSION_IDLE_TIMEOUT_SECONDS
+            is_extra = len(self.sessions) >= settings.MAX_SESSIONS
+            if not is_expired and not is_extra:
+                continue
+            global_logger.info(f"Stopping commentary session for game {session.game_key}")
+            task = session.stop()
+            if task:
+                self._retired_tasks.add(task)
+                task.add_done_callback(self._retired_tasks.discard)
+            session.close()
+            self._retired_coalesced_count += session.work_queue.coalesced_count
+            self._retired_dropped_count += session.work_queue.dropped_count
+            del self.sessions[session.game_key]
+
+    async def _wait_until_idle(self) -> None:
+        """
+        Waits until every session has processed all of its items. Runs on the event loop
+        """
+        while not all(session.is_idle for session in self.sessions.values()):
+            await asyncio.sleep(self.IDLE_CHECK_INTERVAL_SECONDS)
+
+    async def _stop_sessions(self) -> None:
+        """
+        Stops all sessions and waits for their tasks to finish, so that their cleanup runs before the loop is stopped.
+        Runs on the event loop
+        """
+        tasks = list(self._retired_tasks)
+        for session in self.sessions.values():
+            task = session.stop()
+            if task:
+                tasks.append(task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for session in self.sessions.values():
+            session.close()
@@ -1,4 +1,5 @@
 import json
+import random
 import threading
 import time
 from pathlib import Path
@@ -7,93 +8,231 @@ import websocket
 from websocket import WebSocket
 
 from conf.settings import settings
-from entities.entities import MessageTypeEnum
+from entities.entities import MessageTypeEnum, PlayedMove, PositionData, PositionEvaluationData
 from services.chess_commentator import ChessCommentator
+from services.message_parser import MessageParser
+from services.dump_writer import DumpWriter, find_game_offset
+from services.replay import DumpReplayer
+from services.session_manager import SessionManager
 from utils.logger import global_logger
+from utils.metrics import MESSAGES_RECEIVED, SOCKET_CONNECTIONS, STAGE_LATENCY
 
 
 class SocketConnector:
+    """
+    Receives the games from a Socket.IO websocket. The connection is supervised by the thread calling `connect`: when it
+    closes or fails, it is opened again after an exponential backoff with jitter. Socket.IO heartbeats are sent by a
+    single heartbeat thread, which closes the connection when the server stops answering, so that the number of
+    threads stays the same however many times the connection is reopened.
+    """
+
     TCEC_SOCKET_URL = "wss://tcec-chess.com/socket.io/?EIO=3&transport=websocket"
-    KEEP_ALIVE_SLEEP_TIME_SECONDS = 1
-    PING_INTERVAL_SECONDS = 5
-    PING_TIMEOUT_SECONDS = 10
+    PING_INTERVAL_SECONDS = 25
+    """
+    Default Socket.IO heartbeat interval, until the server sends its own in the open packet
+    """
+    PING_TIMEOUT_SECONDS = 20
+    """
+    Default time to wait for a Socket.IO pong, until the server sends its own in the open packet
+    """
+    STABLE_CONNECTION_SECONDS = 60
+    """
+    Connections that stayed open for this long reset the reconnection backoff
+    """
+    POLL_INTERVAL_SECONDS = 1
+    """
+    Maximum time the connection waits for data before checking whether it was closed from another thread
+    """
 
     MESSAGE_TYPE_MAX_LENGTH = 3
     DUMP_FILEPATH = Path(__file__).parent.parent / "dump.txt"
 
     RUN_FROM_LOCAL_TIME_INTERVAL_SECONDS = 1
 
-    def __init__(self):
-        self.socket = websocket.WebSocketApp(
-            self.TCEC_SOCKET_URL,
-            on_open=self._on_open,
-            on_message=self._on_message,
-            on_error=self._on_error,
-            on_close=self._on_close,
-        )
+    def __init__(self, session_manager: SessionManager, socket_url: str = TCEC_SOCKET_URL):
+        """
+        :param session_manager: Manager of the commentary sessions the received games are passed to. May be shared by
+        several connectors
+        :param socket_url: Websocket to connect to
+        """
+        self.socket_url = socket_url
+        self.socket: websocket.WebSocketApp | None = None
         self.stop_thread_event = threading.Event()
-        self.handlers_by_message_type = {MessageTypeEnum.ChessInformationMessageType: self._chess_information_handler}
+        self.handlers_by_message_type = {
+            MessageTypeEnum.ChessInformationMessageType: self._chess_information_handler,
+            MessageTypeEnum.FirstPingMessageType: self._open_packet_handler,
+            MessageTypeEnum.PingMessageType: self._ping_handler,
+            MessageTypeEnum.PongMessageType: self._pong_handler,
+            MessageTypeEnum.EmptyPostPingMessageType: self._empty_message_handler,
+        }
+        self.message_parser = MessageParser(max_tracked_games=settings.MAX_SESSIONS)
+
+        self.dump_writer = None
+        if settings.DUMP_RAW_MESSAGES:
+            self.dump_writer = DumpWriter(
+                file_path=settings.DATA_DUMP_FILE_PATH,
+                compression=settings.DUMP_COMPRESSION,
+                flush_interval_seconds=settings.DUMP_FLUSH_INTERVAL_SECONDS,
+                flush_max_bytes=settings.DUMP_FLUSH_MAX_BYTES,
+            )
+
+        self.session_manager = session_manager
 
-        self.chess_commentator = ChessCommentator()
+        self.ping_interval_seconds = self.PING_INTERVAL_SECONDS
+        self.ping_timeout_seconds = self.PING_TIMEOUT_SECONDS
+        self._opened_time: float | None = None
+        self._last_ping_time: float | None = None
+        self._last_pong_time: float | None = None
+        self._lock = threading.Lock()
+        # Wakes up the heartbeat thread when the heartbeat interval changes or the connector is disconnected
+        self._heartbeat_event = threading.Event()
 
     def connect(self) -> None:
         """
-        Connects to the websocket
+        Connects to the websocket, and reconnects whenever the connection is closed or fails, until `disconnect` is
+        called. Blocks meanwhile
         """
         global_logger.info("Starting socket connection")
-        self.socket.run_forever(ping_interval=self.PING_TIMEOUT_SECONDS, ping_timeout=self.PING_INTERVAL_SECONDS)
+        self.session_manager.start()
+        if self.dump_writer:
+            self.dump_writer.start()
+        heartbeat_thread = threading.Thread(target=self._send_heartbeats, name="socket-heartbeat", daemon=True)
+        heartbeat_thread.start()
+
+        failed_attempts = 0
+        while True:
+            with self._lock:
+                if self.stop_thread_event.is_set():
+                    break
+                # A WebSocketApp cannot be run again once closed, every connection gets its own
+                self.socket = websocket.WebSocketApp(
+                    self.socket_url,
+                    on_open=self._on_open,
+                    on_message=self._on_message,
+                    on_error=self._on_error,
+                    on_close=self._on_close,
+                )
+                self._opened_time = None
+            # Returns once the connection is closed, the reconnection is handled here. The websocket-level ping timeout
+            # only bounds how long the connection waits for data, no websocket-level ping is sent
+            self.socket.run_forever(ping_timeout=self.POLL_INTERVAL_SECONDS, reconnect=0)
+            if self.stop_thread_event.is_set():
+                break
 
-    def run_from_local_dump(self, dump_data_filepath: Path) -> None:
+            if self._opened_time is not None and time.monotonic() - self._opened_time >= self.STABLE_CONNECTION_SECONDS:
+                failed_attempts = 0
+            delay_seconds = self._get_reconnect_delay(failed_attempts)
+            failed_attempts += 1
+            global_logger.warning(f"Connection to {self.socket_url} lost, reconnecting in {delay_seconds:.1f} s")
+            self.stop_thread_event.wait(delay_seconds)
+        heartbeat_thread.join()
+
+    def run_from_local_dump(self, dump_data_filepath: Path, speed: float = 1.0, game_round: str | None = None) -> None:
         """
-        Fakes running the websocket by getting data from a local dump file. Useful during development
+        Fakes running the websocket by getting data from a local dump file. Useful during development, and as a load
+        test of the whole pipeline when replaying faster than real time
+        :param dump_data_filepath: Path of the dump file to replay, compressed or not
+        :param speed: Acceleration factor with respect to the recorded timing, math.inf to replay as fast as possible
+        :param game_round: If provided, the replay starts from the first frame of this game, found in the offset index
         """
         global_logger.info("Starting to run from local dump")
-        with open(dump_data_filepath, "r") as file:
-            input_messages = file.readlines()
+        replayer = DumpReplayer(
+            handle_message=self._handle_message,
+            speed=speed,
+            default_interval_seconds=self.RUN_FROM_LOCAL_TIME_INTERVAL_SECONDS,
+        )
 
-        for input_message in input_messages:
-            self._handle_message(input_message)
-            time.sleep(self.RUN_FROM_LOCAL_TIME_INTERVAL_SECONDS)
+        start_offset = 0
+        if game_round:
+            start_offset = find_game_offset(dump_file_path=dump_data_filepath, game_round=game_round)
+            if start_offset is None:
+                global_logger.warning(f"Game {game_round} not found in the dump index, replaying the whole dump")
+                start_offset = 0
+
+        self.session_manager.start()
+        summary = replayer.replay(dump_data_filepath=dump_data_filepath, start_offset=start_offset)
+
+        drain_start_time = time.perf_counter()
+        self.session_manager.wait_until_idle()
+        summary.coalesced_count = self.session_manager.coalesced_count
+        summary.dropped_count = self.session_manager.dropped_count
+        self.session_manager.stop()
+
+        summary.drain_seconds = time.perf_counter() - drain_start_time
+        global_logger.info(summary.format())
 
     def disconnect(self) -> None:
         """
-        Disconnect from the websocket
+        Disconnect from the websocket and stops reconnecting. `connect` returns once the connection is closed
         """
         global_logger.info("Stopping socket connection")
-        self.socket.close()
+        with self._lock:
+            self.stop_thread_event.set()
+            self._heartbeat_event.set()
+            if self.socket:
+                self.socket.close()
+        if self.dump_writer:
+            self.dump_writer.close()
 
-    def keep_alive(self) -> None:
+    def _get_reconnect_delay(self, failed_attempts: int) -> float:
         """
-        Monitors the WebSocket connection and attempts to reconnect if it has been closed.
-        This runs in a separate thread to continuously check connection status.
+        Exponential backoff with jitter, so that connectors that lost the connection at the same time do not all
+        reconnect at once
+        :param failed_attempts: Number of reconnections since the connection was last stable
+        :return: Time to wait before reconnecting
         """
-        while not self.stop_thread_event.is_set():
-            if not self.socket.sock or not self.socket.sock.connected:
-                global_logger.warning("Connection lost, attempting to reconnect...")
-                self.reconnect()
-            time.sleep(self.KEEP_ALIVE_SLEEP_TIME_SECONDS)
+        delay_seconds = min(
+            settings.SOCKET_RECONNECT_MAX_DELAY_SECONDS,
+            settings.SOCKET_RECONNECT_BASE_DELAY_SECONDS * 2**failed_attempts,
+        )
+        return random.uniform(delay_seconds / 2, delay_seconds)
 
-    def reconnect(self) -> None:
+    def _send_heartbeats(self) -> None:
         """
-        Safely attempts to reconnect the WebSocket.
+        Sends the Socket.IO pings of the open connection, and closes it when the previous ping was not answered in time.
+        Runs on the heartbeat thread, for as long as the connector is connected
         """
-        self.disconnect()  # Ensure the connection is cleanly closed before reconnecting
-        self.connect()
+        while not self.stop_thread_event.is_set():
+            self._heartbeat_event.wait(self.ping_interval_seconds)
+            self._heartbeat_event.clear()
+            with self._lock:
+                socket = self.socket
+                is_connected = socket is not None and socket.sock is not None and socket.sock.connected
+                if self.stop_thread_event.is_set() or self._opened_time is None or not is_connected:
+                    continue
+                now = time.monotonic()
+                is_pong_overdue = (
+                    self._last_ping_time is not None
+                    and (self._last_pong_time is None or self._last_pong_time < self._last_ping_time)
+                    and now - self._last_ping_time > self.ping_timeout_seconds
+                )
+                if is_pong_overdue:
+                    global_logger.warning(f"No pong received from {self.socket_url}, closing the connection")
+                    SOCKET_CONNECTIONS.inc(outcome="timed_out")
+                    self._last_ping_time = None
+                    socket.close()
+                    continue
+                self._last_ping_time = now
+            try:
+                socket.send(MessageTypeEnum.PingMessageType.value)
+            except websocket.WebSocketException:
+                global_logger.warning("Failed to send ping, the connection is being closed")
 
-    def _on_open(self, _websocket: WebSocket) -> None:
+    def _on_open(self, websocket_app: websocket.WebSocketApp) -> None:
         """
         Called on opening of WebSocket connection
-        :param _websocket: websocket of the connection being opened
+        :param websocket_app: websocket of the connection being opened
         """
         global_logger.info("WebSocket connection opened.")
-
-        def run():
-            while not self.stop_thread_event.is_set():
-                # Perform tasks, such as sending a periodic message
-                time.sleep(self.KEEP_ALIVE_SLEEP_TIME_SECONDS)
-
-        thread = threading.Thread(target=run)
-        thread.start()
+        SOCKET_CONNECTIONS.inc(outcome="opened")
+        with self._lock:
+            if self.stop_thread_event.is_set():
+                # Disconnected while connecting
+                websocket_app.close()
+                return
+            self._opened_time = time.monotonic()
+            self._last_ping_time = None
+            self._last_pong_time = None
 
     def _on_message(self, _websocket: WebSocket, message: str) -> None:
         """
@@ -102,21 +241,18 @@ class SocketConnector:
         :param message: Content of th emessage
         """
         global_logger.info("Message received")
-        if settings.DUMP_RAW_MESSAGES:
+        if self.dump_writer:
             self._dump_message(message=message)
 
         self._handle_message(message=message)
 
-    @classmethod
-    def _dump_message(cls, message: str) -> None:
+    def _dump_message(self, message: str) -> None:
         """
-        Dump received messages to a local text file.
+        Dump received messages to a local file, together with the time at which they were received. Messages are only
+        buffered here, the dump writer writes them to disk on its own thread
         :param message: Message to append to current file
         """
-        Path(settings.DATA_DUMP_FILE_PATH.parent).mkdir(parents=True, exist_ok=True)
-        with open(settings.DATA_DUMP_FILE_PATH, "a") as file:
-            file.write(message)
-            file.write("\n")
+        self.dump_writer.write(message=message, received_timestamp=time.time())
 
     def _handle_message(self, message: str) -> None:
         """
@@ -126,7 +262,11 @@ class SocketConnector:
         message_type = self._get_message_type(message)
         handler = self.handlers_by_message_type.get(message_type)
         if handler:
-            handler(message)
+            try:
+                handler(message)
+            except Exception:
+                # A malformed message must not close the connection
+                global_logger.exception(f"Failed to handle message of type {message_type}")
         else:
             global_logger.warning(f"No handler available for message_type: {message_type}")
 
@@ -148,59 +288,156 @@ class SocketConnector:
             global_logger.warning(f"Unknown message type: {message_type}")
             return MessageTypeEnum.UnknownMessageType
 
+    def _open_packet_handler(self, message: str) -> None:
+        """
+        Handles the Socket.IO open packet, sent by the server when the connection opens, which contains the heartbeat
+        interval and timeout to use
+        :param message: received message
+        """
+        try:
+            handshake = json.loads(message[1:])
+            self.ping_interval_seconds = handshake["pingInterval"] / 1000
+            self.ping_timeout_seconds = handshake["pingTimeout"] / 1000
+        except (ValueError, KeyError, TypeError):
+            global_logger.warning(f"Unexpected open packet: {message}")
+            return
+        self._heartbeat_event.set()
+
+    def _ping_handler(self, _message: str) -> None:
+        """
+        Answers the Socket.IO pings of the server
+        :param _message: received message
+        """
+        socket = self.socket
+        if socket and socket.sock and socket.sock.connected:
+            socket.send(MessageTypeEnum.PongMessageType.value)
+
+    def _empty_message_handler(self, _message: str) -> None:
+        """
+        Handles Socket.IO messages without content, such as the confirmation of the connection to the namespace
+        :param _message: received message
+        """
+
+    def _pong_handler(self, _message: str) -> None:
+        """
+        Records the answer of the server to the last ping
+        :param _message: received message
+        """
+        with self._lock:
+            self._last_pong_time = time.monotonic()
+
     def _chess_information_handler(self, message: str) -> None:
         """
         Handles messages that contain chess information
         :param message: received message
         """
-        payload = json.loads(message[2:])
-        if payload[0] == "pgn":  # contains the game data
-            self._handle_game_data(game_data=payload[1])
-        if payload[0] == "liveeval":  # contains evaluation of commentating engines
-            self._handle_live_eval_data(live_eval_data=payload[1])
+        received_time = time.monotonic()
+        event_name = self.message_parser.peek_event_name(message)
+        MESSAGES_RECEIVED.inc(event=event_name or "unknown")
+        if event_name == "pgn":  # contains the game data
+            with STAGE_LATENCY.time(stage="parse"):
+                game_data = self.message_parser.parse_game_data(message)
+            if game_data:  # duplicate frames are skipped by the parser
+                self._handle_game_data(game_data=game_data, received_time=received_time)
+        if event_name in ("liveeval", "liveeval1"):  # contains evaluation of commentating engines
+            with STAGE_LATENCY.time(stage="parse"):
+                live_eval_data = self.message_parser.parse_live_eval_data(message)
+            self._handle_live_eval_data(live_eval_data=live_eval_data, received_time=received_time)
 
-    def _handle_game_data(self, game_data: json) -> None:
+    def _handle_game_data(self, game_data: json, received_time: float) -> None:
         """
-        Extract relevant information from the game data and passes it to chess_commentator
+        Extract relevant information from the game data and enqueues it on the session of the game. A newer position of
+        the same game replaces any position still waiting to be commentated
         :param game_data: json containing game data
+        :param received_time: Monotonic time at which the message was received
         """
-        white_name = game_data["Headers"]["White"]
-        black_name = game_data["Headers"]["Black"]
+        headers = game_data.get("Headers") or {}
+        game_key = self._get_game_key(headers.get("Round"))
+        white_name = headers.get("White") or "White"
+        black_name = headers.get("Black") or "Black"
+        opening = " ".join(filter(None, (headers.get("ECO"), headers.get("Opening")))) or None
 
-        last_move_data = game_data["Moves"][0]
-        last_move = last_move_data["m"]
-        current_fen = last_move_data["fen"]
+        # Moves are in chronological order, the last one is the latest move of the game
+        moves = tuple(
+            PlayedMove(san=move_data["m"], fen_position=move_data["fen"])
+            for move_data in game_data.get("Moves") or ()
+            if move_data.get("m") and move_data.get("fen")
+        )
+        if not moves:
+            # e.g. a game that has just started
+            global_logger.debug(f"No moves in the game data of game {game_key}, skipping it")
+            return
+        last_move = moves[-1].san
+        current_fen = moves[-1].fen_position
 
-        self.chess_commentator.process_position_data(
-            fen_position=current_fen, last_move=last_move, white_name=white_name, black_name=black_name
+        self.session_manager.submit(
+            game_key=game_key,
+            key=("pgn", game_key),
+            item=PositionData(
+                game_key=game_key,
+                fen_position=current_fen,
+                last_move=last_move,
+                white_name=white_name,
+                black_name=black_name,
+                opening=opening,
+                received_time=received_time,
+                moves=moves,
+            ),
         )
 
-    def _handle_live_eval_data(self, live_eval_data: json) -> None:
+    def _handle_live_eval_data(self, live_eval_data: json, received_time: float) -> None:
         """
-        Extract relevant information from live evaluation data and passes it to chess_commentator
+        Extract relevant information from live evaluation data and enqueues it on the session of the game. A newer
+        evaluation from the same engine on the same game replaces any evaluation still waiting to be commentated
         :param live_eval_data: json containing live evaluation data
+        :param received_time: Monotonic time at which the message was received
         """
-        engine_name = live_eval_data["engine"]
-        position_evaluation = live_eval_data["eval"]
-        best_line = live_eval_data["pv"]
+        game_key = self._get_game_key(live_eval_data.get("round"))
+        engine_name = live_eval_data.get("engine") or "unknown engine"
+        position_evaluation = live_eval_data.get("eval")
+        best_line = live_eval_data.get("pv")
+        if position_evaluation is None or not best_line:
+            global_logger.debug(f"Incomplete live evaluation of game {game_key}, skipping it")
+            return
+        wdl = live_eval_data.get("wdl")
+        depth = live_eval_data.get("depth")
 
-        self.chess_commentator.process_position_evaluation_data(
-            engine_name=engine_name, position_evaluation=position_evaluation, best_line=best_line
+        self.session_manager.submit(
+            game_key=game_key,
+            key=("liveeval", game_key, engine_name),
+            item=PositionEvaluationData(
+                game_key=game_key,
+                engine_name=engine_name,
+                position_evaluation=position_evaluation,
+                best_line=best_line,
+                wdl=wdl,
+                depth=depth,
+                received_time=received_time,
+            ),
         )
 
     @staticmethod
-    def _on_error(_websocket: WebSocket, error: str) -> None:
+    def _get_game_key(game_round: str | float | None) -> str:
+        """
+        :param game_round: Round of the game, as received
+        :return: Key of the game, the default one if the round is missing
+        """
+        return str(game_round) if game_round not in (None, "") else ChessCommentator.DEFAULT_GAME_KEY
+
+    @staticmethod
+    def _on_error(_websocket: WebSocket, error: Exception) -> None:
         """
-        Called on any error of the websocket. Just logs the error
+        Called on any error of the websocket. Just logs the error, the connection is closed and reopened by `connect`
         :param _websocket: Currently active websocket
-        :param error: String with error message
+        :param error: Error raised by the websocket
         """
-        global_logger.error("Error: ", error)
+        global_logger.error(f"Error: {error}")
 
     @staticmethod
     def _on_close(_websocket: WebSocket, close_status_code: str, close_msg: str) -> None:
         """
-        Called on close of the websocket. Just logs that closing happened, status code and reason for closing
+        Called on close of the websocket. Just logs that closing happened, status code and reason for closing. The
+        connection is reopened by `connect`
         :param _websocket: websocket that was closed
         :param close_status_code: received status message on close
         :param close_msg: Received message on close
@@ -209,3 +446,4 @@ class SocketConnector:
         global_logger.info("Socket was closed")
         global_logger.info(f"close status code: {close_status_code}")
         global_logger.info(f"close msg: {close_msg}")
+        SOCKET_CONNECTIONS.inc(outcome="closed")
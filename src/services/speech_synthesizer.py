@@ -0,0 +1,278 @@
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, Iterator
+
+from conf.settings import settings
+from services.audio_cache import SynthesizedAudioCache
+from utils.logger import global_logger
+from utils.metrics import AUDIO_CACHE_LOOKUPS, STAGE_LATENCY, SYNTHESIS_REAL_TIME_FACTOR
+
+if TYPE_CHECKING:
+    from piper import PiperVoice
+
+
+def load_voice(model_path: Path, intra_op_threads: int) -> "PiperVoice":
+    """
+    Loads a Piper voice whose ONNX inference session uses a limited number of threads
+    :param model_path: Path of the ONNX model. Its config is expected next to it, with an additional .json suffix
+    :param intra_op_threads: Number of threads used by ONNX Runtime within a single inference
+    :return: Loaded voice
+    """
+    # Imported here since onnxruntime is slow to import and not needed in SILENT_MODE
+    import onnxruntime
+    from piper import PiperVoice
+    from piper.config import PiperConfig
+
+    with open(f"{model_path}.json", "r", encoding="utf-8") as config_file:
+        config = PiperConfig.from_dict(json.load(config_file))
+
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = intra_op_threads
+    session_options.inter_op_num_threads = 1
+    return PiperVoice(
+        config=config,
+        session=onnxruntime.InferenceSession(
+            str(model_path), sess_options=session_options, providers=["CPUExecutionProvider"]
+        ),
+    )
+
+
+class SpeechSynthesizer:
+    """
+    Synthesizes sentences in parallel on a pool of worker threads, each with its own Piper voice, and returns their
+    audio in order. ONNX Runtime releases the GIL during inference, and every session is limited to a few intra-op
+    threads, so the workers share the cores instead of competing for them. The voices are loaded and warmed up with a
+    dummy synthesis on the workers themselves, so creating the synthesizer returns immediately and only synthesis waits
+    for them.
+    """
+
+    WARM_UP_TEXT = "Warming up the commentary."
+    MAX_CONCURRENT_UTTERANCES = 32
+    """
+    Number of utterances whose sentences are submitted at the same time. Later ones wait for a feeder to be available
+    """
+
+    def __init__(
+        self,
+        model_path: Path,
+        worker_count: int,
+        intra_op_threads: int,
+        audio_cache: SynthesizedAudioCache | None = None,
+    ):
+        """
+        :param model_path: Path of the ONNX model. Its config is expected next to it, with an additional .json suffix
+        :param worker_count: Number of sentences synthesized at the same time
+        :param intra_op_threads: Number of threads used by ONNX Runtime within the synthesis of a sentence
+        :param audio_cache: Cache of synthesized sentences, closed with the synthesizer
+        """
+        self.model_path = Path(model_path)
+        self.worker_count = worker_count
+        self.intra_op_threads = intra_op_threads
+        self.audio_cache = audio_cache
+        with open(f"{self.model_path}.json", "r", encoding="utf-8") as config_file:
+            self.sample_rate: int = json.load(config_file)["audio"]["sample_rate"]
+
+        # Idle voices. None is put back in line when a voice failed to load, so that waiting synthesis fails too
+        self._voices: queue.Queue["PiperVoice | None"] = queue.Queue()
+        self._loaded_count = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="speech-synthesis")
+        # Feeders mostly wait for the sentences to be generated, so they are not limited by the number of voices
+        self._feeder_executor = ThreadPoolExecutor(
+            max_workers=self.MAX_CONCURRENT_UTTERANCES, thread_name_prefix="speech-synthesis-feeder"
+        )
+        for _ in range(worker_count):
+            self._executor.submit(self._load_voice)
+
+    @property
+    def is_ready(self) -> bool:
+        with self._lock:
+            return self._loaded_count == self.worker_count
+
+    def synthesize(self, sentences: Iterable[str]) -> Iterator[bytes]:
+        """
+        Synthesizes sentences in parallel, as soon as each one is available. Audio of cached sentences is read from the
+        audio cache. The real-time factor of the whole utterance is reported when done. Closing the iterator early stops
+        submitting sentences and cancels the synthesis of those not started yet
+        :param sentences: Sentences to synthesize, possibly still being generated
+        :return: Iterator over the int16 mono PCM of every sentence, in order
+        """
+        futures: queue.Queue[Future | Exception | None] = queue.Queue()
+        stopped = threading.Event()
+        # Sentences are consumed by a feeder, so that audio is returned while later ones are still generated
+        self._feeder_executor.submit(self._submit_sentences, sentences, futures, stopped)
+
+        synthesis_seconds = 0.0
+        audio_bytes = 0
+        sentence_count = 0
+        try:
+            while (future := futures.get()) is not None:
+                if isinstance(future, Exception):
+                    raise future
+                audio, sentence_synthesis_seconds = future.result()
+                synthesis_seconds += sentence_synthesis_seconds
+                audio_bytes += len(audio)
+                sentence_count += 1
+                yield audio
+        finally:
+            stopped.set()
+            while True:
+                try:
+                    future = futures.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(future, Future):
+                    future.cancel()
+
+        self._report_real_time_factor(
+            sentence_count=sentence_count, synthesis_seconds=synthesis_seconds, audio_bytes=audio_bytes
+        )
+
+    def close(self) -> None:
+        """
+        Waits for the synthesis in progress, then releases the voices and the audio cache
+        """
+        self._feeder_executor.shutdown(wait=False, cancel_futures=True)
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        if self.audio_cache:
+            self.audio_cache.close()
+
+    def _load_voice(self) -> None:
+        """
+        Loads and warms up the voice of a worker. Runs on the worker
+        """
+        try:
+            start_time = time.perf_counter()
+            voice = load_voice(model_path=self.model_path, intra_op_threads=self.intra_op_threads)
+            for _ in voice.synthesize_stream_raw(self.WARM_UP_TEXT):
+                pass
+            global_logger.info(f"Voice loaded and warmed up in {time.perf_counter() - start_time:.2f} s")
+        except Exception:
+            global_logger.exception(f"Failed to load the voice model {self.model_path}")
+            voice = None
+        with self._lock:
+            self._loaded_count += 1
+        self._voices.put(voice)
+
+    def _submit_sentences(self, sentences: Iterable[str], futures: queue.Queue, stopped: threading.Event) -> None:
+        """
+        Submits every sentence for synthesis as soon as it is available. Runs on a feeder
+        :param sentences: Sentences to synthesize
+        :param futures: Queue receiving the future of every sentence in order, then None. Errors raised while getting
+        the sentences are passed on instead
+        :param stopped: Set when the audio is no longer wanted, so that the remaining sentences are not submitted
+        """
+        try:
+            for sentence in sentences:
+                if stopped.is_set():
+                    break
+                future = self._executor.submit(self._synthesize_sentence, sentence)
+                futures.put(future)
+                # The consumer may have drained the queue while the sentence was being submitted
+                if stopped.is_set():
+                    future.cancel()
+                    break
+        except Exception as error:
+            futures.put(error)
+        futures.put(None)
+
+    def _synthesize_sentence(self, sentence: str) -> tuple[bytes, float]:
+        """
+        Synthesizes a single sentence with an idle voice, or reads it from the audio cache. Runs on a worker
+        :param sentence: Sentence to synthesize
+        :return: int16 mono PCM of the sentence and the time spent synthesizing it, 0 if it was cached
+        """
+        voice_model = str(self.model_path)
+        if self.audio_cache:
+            cached_audio = self.audio_cache.get(voice_model=voice_model, text=sentence)
+            if cached_audio is not None:
+                AUDIO_CACHE_LOOKUPS.inc(result="hit")
+                return cached_audio, 0.0
+            AUDIO_CACHE_LOOKUPS.inc(result="miss")
+
+        voice = self._voices.get()
+        try:
+            if voice is None:
+                raise RuntimeError(f"The voice model {self.model_path} could not be loaded")
+            start_time = time.perf_counter()
+            audio = b"".join(voice.synthesize_stream_raw(sentence))
+            synthesis_seconds = time.perf_counter() - start_time
+        finally:
+            self._voices.put(voice)
+        STAGE_LATENCY.observe(synthesis_seconds, stage="synthesis")
+
+        if self.audio_cache:
+            self.audio_cache.put(voice_model=voice_model, text=sentence, audio=audio)
+        return audio, synthesis_seconds
+
+    def _report_real_time_factor(self, sentence_count: int, synthesis_seconds: float, audio_bytes: int) -> None:
+        """
+        Logs and records the real-time factor of an utterance: the time spent synthesizing it over its duration
+        """
+        audio_seconds = audio_bytes / 2 / self.sample_rate
+        if not synthesis_seconds or not audio_seconds:
+            return
+        real_time_factor = synthesis_seconds / audio_seconds
+        SYNTHESIS_REAL_TIME_FACTOR.observe(real_time_factor)
+        global_logger.info(
+            f"Synthesized {sentence_count} sentences, {audio_seconds:.1f} s of audio in {synthesis_seconds:.2f} s "
+            f"(real-time factor {real_time_factor:.2f})"
+        )
+
+
+class FakeSpeechSynthesizer(SpeechSynthesizer):
+    """
+    Synthesizer returning silence as long as the sentences would take to say, at a fixed real-time factor, without any
+    voice model. Used to run the pipeline offline, e.g. in benchmarks
+    """
+
+    SECONDS_PER_CHARACTER = 0.06
+    """
+    Approximate speaking rate, used to size the audio of a sentence
+    """
+
+    def __init__(self, sample_rate: int = 22050, real_time_factor: float = 0.0):
+        """
+        :param sample_rate: Sample rate of the audio
+        :param real_time_factor: Time taken by the synthesis of a sentence over its duration
+        """
+        self.sample_rate = sample_rate
+        self.real_time_factor = real_time_factor
+        self.audio_cache = None
+        self.sentence_count = 0
+
+    @property
+    def is_ready(self) -> bool:
+        return True
+
+    def synthesize(self, sentences: Iterable[str]) -> Iterator[bytes]:
+        for sentence in sentences:
+            audio_seconds = len(sentence) * self.SECONDS_PER_CHARACTER
+            time.sleep(audio_seconds * self.real_time_factor)
+            self.sentence_count += 1
+            yield bytes(int(audio_seconds * self.sample_rate) * 2)
+
+    def close(self) -> None:
+        pass
+
+
+def create_speech_synthesizer() -> SpeechSynthesizer:
+    """
+    Creates the speech synthesizer, and its audio cache if enabled, according to the settings
+    :return: Speech synthesizer
+    """
+    audio_cache = None
+    if settings.AUDIO_CACHE_ENABLED:
+        audio_cache = SynthesizedAudioCache(
+            file_path=settings.AUDIO_CACHE_FILE_PATH, max_bytes=settings.AUDIO_CACHE_MAX_BYTES
+        )
+    return SpeechSynthesizer(
+        model_path=settings.VOICE_MODEL_FILE_LOCATION,
+        worker_count=settings.TTS_WORKERS,
+        intra_op_threads=settings.TTS_INTRA_OP_THREADS,
+        audio_cache=audio_cache,
+    )
@@ -0,0 +1,113 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from utils.logger import global_logger
+
+
+class LatestWinsQueue:
+    """
+    Bounded, thread safe priority queue in which every item is stored under a key. Putting an item under a key that is
+    still pending replaces the pending item, so that only the newest item for each key is ever processed. The most
+    urgent pending item is taken first, items of the same priority in FIFO order.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: OrderedDict[Hashable, tuple[int, Any]] = OrderedDict()
+        self._condition = threading.Condition()
+        self._unfinished_items = 0
+
+        self.coalesced_count = 0
+        self.dropped_count = 0
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._items)
+
+    @property
+    def unfinished_count(self) -> int:
+        """
+        Number of items enqueued and not yet marked as done, including the ones being processed
+        """
+        with self._condition:
+            return self._unfinished_items
+
+    def has_pending(self, predicate: Callable[[Any], bool]) -> bool:
+        """
+        :param predicate: Condition on the items
+        :return: True if any pending item satisfies the condition
+        """
+        with self._condition:
+            return any(predicate(item) for _, item in self._items.values())
+
+    def discard(self, predicate: Callable[[Any], bool]) -> int:
+        """
+        Removes the pending items satisfying a condition, counting them as superseded
+        :param predicate: Condition on the items
+        :return: Number of removed items
+        """
+        with self._condition:
+            keys = [key for key, (_, item) in self._items.items() if predicate(item)]
+            for key in keys:
+                del self._items[key]
+            self.coalesced_count += len(keys)
+            self._unfinished_items -= len(keys)
+            if keys:
+                self._condition.notify_all()
+            return len(keys)
+
+    def put(self, key: Hashable, item: Any, priority: int = 0) -> None:
+        """
+        Adds an item to the queue without ever blocking. A pending item with the same key is superseded, while if the
+        queue is full the oldest of the least urgent pending items is dropped to make room
+        :param key: Key identifying which items supersede each other
+        :param item: Item to be enqueued
+        :param priority: Urgency of the item, lower values being taken first
+        """
+        with self._condition:
+            if key in self._items:
+                # Superseded items lose their place in line, the newest information is processed last
+                del self._items[key]
+                self.coalesced_count += 1
+            else:
+                if len(self._items) >= self.max_size:
+                    dropped_key = max(self._items, key=lambda item_key: self._items[item_key][0])
+                    del self._items[dropped_key]
+                    self.dropped_count += 1
+                    self._unfinished_items -= 1
+                    global_logger.warning(f"Work queue is full, dropping item with key: {dropped_key}")
+                self._unfinished_items += 1
+            self._items[key] = (priority, item)
+            self._condition.notify()
+
+    def get(self, timeout: float | None = None) -> Any | None:
+        """
+        Removes and returns the most urgent pending item, the oldest one among equally urgent items. Every returned item
+        must be marked as done with `task_done`
+        :param timeout: Maximum number of seconds to wait for an item. Waits forever if None
+        :return: The most urgent pending item, or None if the timeout expired
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._items, timeout=timeout):
+                return None
+            # The queue is small, a linear scan is cheaper than maintaining a heap of superseded entries
+            key = min(self._items, key=lambda item_key: self._items[item_key][0])
+            _, item = self._items.pop(key)
+            return item
+
+    def task_done(self) -> None:
+        """
+        Marks an item returned by `get` as fully processed
+        """
+        with self._condition:
+            self._unfinished_items -= 1
+            self._condition.notify_all()
+
+    def join(self) -> None:
+        """
+        Blocks until all enqueued items have been processed
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._unfinished_items <= 0)
+
@@ -0,0 +1,197 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+DEFAULT_LATENCY_BUCKETS_SECONDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+LabelValues = tuple[tuple[str, str], ...]
+
+
+def format_labels(label_values: LabelValues) -> str:
+    """
+    :param label_values: Label names and values
+    :return: Labels in the Prometheus text format, e.g. '{stage="llm"}', empty if there are no labels
+    """
+    if not label_values:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in label_values) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """
+        Increments the counter
+        :param amount: Amount to add, must not be negative
+        :param labels: Labels of the incremented series
+        """
+        label_values = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{format_labels(label_values)} {value}" for label_values, value in values.items())
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS_SECONDS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # Per series: count of every bucket (the last one is +Inf), sum and count of the observations
+        self._series: dict[LabelValues, tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        Records an observation
+        :param value: Observed value
+        :param labels: Labels of the series the observation belongs to
+        """
+        label_values = tuple(sorted(labels.items()))
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            bucket_counts, totals = self._series.setdefault(label_values, ([0] * (len(self.buckets) + 1), [0.0, 0]))
+            bucket_counts[bucket_index] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Records the duration of the wrapped block, in seconds
+        :param labels: Labels of the series the observation belongs to
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            series = {labels: (list(counts), list(totals)) for labels, (counts, totals) in self._series.items()}
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for label_values, (bucket_counts, (total, count)) in series.items():
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip((*self.buckets, "+Inf"), bucket_counts):
+                cumulative_count += bucket_count
+                bucket_labels = format_labels((*label_values, ("le", str(upper_bound))))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative_count}")
+            lines.append(f"{self.name}_sum{format_labels(label_values)} {total}")
+            lines.append(f"{self.name}_count{format_labels(label_values)} {count}")
+        return lines
+
+
+class CallbackMetric:
+    """
+    Metric whose value is read from a callback when rendered, for values already tracked by other components such as
+    queue depths
+    """
+
+    def __init__(self, name: str, description: str, metric_type: str, callback: Callable[[], float]):
+        self.name = name
+        self.description = description
+        self.metric_type = metric_type
+        self.callback = callback
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.metric_type}",
+            f"{self.name} {self.callback()}",
+        ]
+
+
+class MetricsRegistry:
+    """
+    Keeps the metrics of the application and renders them in the Prometheus text format. Recording a metric only takes
+    a lock and a few additions, exporting is left to the metrics exporter.
+    """
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram | CallbackMetric] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, description: str) -> Counter:
+        """
+        Gets a counter, creating it if needed
+        """
+        with self._lock:
+            return self._metrics.setdefault(name, Counter(name=name, description=description))
+
+    def histogram(
+        self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS_SECONDS
+    ) -> Histogram:
+        """
+        Gets a histogram, creating it if needed
+        """
+        with self._lock:
+            return self._metrics.setdefault(name, Histogram(name=name, description=description, buckets=buckets))
+
+    def register_callback(self, name: str, description: str, metric_type: str, callback: Callable[[], float]) -> None:
+        """
+        Registers a metric read from a callback, replacing any metric with the same name
+        :param name: Name of the metric
+        :param description: Help text of the metric
+        :param metric_type: "gauge" or "counter"
+        :param callback: Returns the current value of the metric
+        """
+        with self._lock:
+            self._metrics[name] = CallbackMetric(
+                name=name, description=description, metric_type=metric_type, callback=callback
+            )
+
+    def render(self) -> str:
+        """
+        :return: All metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+global_metrics = MetricsRegistry()
+
+STAGE_LATENCY = global_metrics.histogram(
+    "commentator_stage_latency_seconds", "Duration of every stage of the commentary pipeline"
+)
+MOVE_TO_SPEECH_LATENCY = global_metrics.histogram(
+    "commentator_move_to_speech_latency_seconds",
+    "Time from receiving a move to queuing the first audio of its commentary",
+)
+MESSAGES_RECEIVED = global_metrics.counter("commentator_messages_received_total", "Messages received, by event")
+LLM_TOKENS = global_metrics.counter("commentator_llm_tokens_total", "Tokens sent to and received from the LLM")
+LLM_CALLS = global_metrics.counter("commentator_llm_calls_total", "Commentary requested from the LLM, by outcome")
+AUDIO_CACHE_LOOKUPS = global_metrics.counter("commentator_audio_cache_lookups_total", "Audio cache lookups, by result")
+COMMENTARY_PREEMPTIONS = global_metrics.counter(
+    "commentator_commentary_preemptions_total", "Commentary cancelled, interrupted or expired before being said"
+)
+SPECULATIONS = global_metrics.counter(
+    "commentator_speculations_total", "Commentary prepared for predicted moves, by outcome"
+)
+SOCKET_CONNECTIONS = global_metrics.counter(
+    "commentator_socket_connections_total", "Websocket connections opened, closed and timed out"
+)
+AUDIO_SINK_DROPS = global_metrics.counter(
+    "commentator_audio_sink_drops_total", "Audio dropped from recordings and stream listeners disconnected, by sink"
+)
+SYNTHESIS_REAL_TIME_FACTOR = global_metrics.histogram(
+    "commentator_synthesis_real_time_factor",
+    "Time spent synthesizing a commentary over the duration of its audio, below 1 if faster than real time",
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 5),
+)
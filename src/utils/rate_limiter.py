@@ -0,0 +1,43 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Spaces out calls shared by several threads so that no more than a given number start per minute. Calls are let
+    through in the order they arrive, each one waiting for its own slot.
+    """
+
+    def __init__(self, max_calls_per_minute: float):
+        """
+        :param max_calls_per_minute: Maximum number of calls started per minute
+        """
+        self.interval_seconds = 60 / max_calls_per_minute
+        self._next_call_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Waits for the next free slot
+        :return: Time waited
+        """
+        with self._lock:
+            now = time.monotonic()
+            call_time = max(now, self._next_call_time)
+            self._next_call_time = call_time + self.interval_seconds
+        wait_seconds = call_time - now
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+    def try_acquire(self) -> bool:
+        """
+        Takes the next slot only if it is free now, i.e. no other call is waiting
+        :return: Whether the slot was taken
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._next_call_time > now:
+                return False
+            self._next_call_time = now + self.interval_seconds
+        return True
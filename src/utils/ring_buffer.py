@@ -0,0 +1,88 @@
+import threading
+
+import numpy as np
+
+
+class PcmRingBuffer:
+    """
+    Fixed capacity, thread safe ring buffer of int16 PCM samples for a single producer and a single consumer. Writers
+    block while the buffer is full, which bounds how far ahead of playback the synthesis can run.
+    """
+
+    def __init__(self, capacity_samples: int):
+        self.capacity_samples = capacity_samples
+        self._buffer = np.zeros(capacity_samples, dtype=np.int16)
+        self._read_index = 0
+        self._available_samples = 0
+        self._condition = threading.Condition()
+        self._generation = 0
+
+    @property
+    def available_samples(self) -> int:
+        with self._condition:
+            return self._available_samples
+
+    def write(self, samples: np.ndarray, timeout: float | None = None) -> int:
+        """
+        Copies samples into the buffer, blocking while it is full. If the buffer is cleared while waiting, the remaining
+        samples are discarded
+        :param samples: int16 samples to write
+        :param timeout: Maximum number of seconds to wait for free space. Waits forever if None
+        :return: Number of samples actually written
+        """
+        written_samples = 0
+        with self._condition:
+            generation = self._generation
+            while written_samples < len(samples):
+                has_space = self._condition.wait_for(
+                    lambda: self._available_samples < self.capacity_samples or self._generation != generation,
+                    timeout=timeout,
+                )
+                if not has_space or self._generation != generation:
+                    break
+
+                write_index = (self._read_index + self._available_samples) % self.capacity_samples
+                free_samples = self.capacity_samples - self._available_samples
+                count = min(free_samples, len(samples) - written_samples, self.capacity_samples - write_index)
+                self._buffer[write_index : write_index + count] = samples[written_samples : written_samples + count]
+                self._available_samples += count
+                written_samples += count
+                self._condition.notify_all()
+        return written_samples
+
+    def read(self, max_samples: int, timeout: float | None = None) -> np.ndarray:
+        """
+        Removes up to max_samples samples from the buffer, blocking until at least one is available
+        :param max_samples: Maximum number of samples to return
+        :param timeout: Maximum number of seconds to wait for data. Waits forever if None
+        :return: Array of samples, empty if the timeout expired
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._available_samples > 0, timeout=timeout):
+                return np.zeros(0, dtype=np.int16)
+
+            count = min(max_samples, self._available_samples, self.capacity_samples - self._read_index)
+            samples = self._buffer[self._read_index : self._read_index + count].copy()
+            self._read_index = (self._read_index + count) % self.capacity_samples
+            self._available_samples -= count
+            self._condition.notify_all()
+            return samples
+
+    def clear(self) -> None:
+        """
+        Discards all buffered samples and wakes up any blocked writer
+        """
+        with self._condition:
+            self._read_index = 0
+            self._available_samples = 0
+            self._generation += 1
+            self._condition.notify_all()
+
+    def wait_until_empty(self, timeout: float | None = None) -> bool:
+        """
+        Blocks until every buffered sample has been read
+        :param timeout: Maximum number of seconds to wait. Waits forever if None
+        :return: True if the buffer is empty
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._available_samples == 0, timeout=timeout)
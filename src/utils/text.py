@@ -0,0 +1,35 @@
+import re
+from typing import Iterable, Iterator
+
+SENTENCE_BOUNDARY_REGEX = re.compile(r"[.!?]+[\"')\]]*\s+")
+MOVE_NUMBER_REGEX = re.compile(r"(?:^|\s)\d+\.*$")
+MIN_SENTENCE_LENGTH = 20
+
+
+def split_sentences(text_chunks: Iterable[str], min_sentence_length: int = MIN_SENTENCE_LENGTH) -> Iterator[str]:
+    """
+    Splits a stream of text chunks (e.g. LLM tokens) into sentences, yielding each sentence as soon as it is complete.
+    Move numbers such as "40." or "41..." are not treated as the end of a sentence, and sentences shorter than
+    min_sentence_length are merged with the following one to avoid choppy speech.
+    :param text_chunks: Iterable of text chunks of arbitrary length
+    :param min_sentence_length: Minimum length in characters of a yielded sentence (except for the last one)
+    :return: Iterator over complete sentences, stripped of surrounding whitespace
+    """
+    buffer = ""
+    for chunk in text_chunks:
+        buffer += chunk
+        search_start = 0
+        while match := SENTENCE_BOUNDARY_REGEX.search(buffer, search_start):
+            # Wait for the beginning of the next sentence, the boundary could still be a decimal point otherwise
+            if match.end() == len(buffer):
+                break
+            candidate = buffer[: match.end()]
+            if len(candidate.strip()) < min_sentence_length or MOVE_NUMBER_REGEX.search(buffer[: match.start() + 1]):
+                search_start = match.end()
+                continue
+            yield candidate.strip()
+            buffer = buffer[match.end() :]
+            search_start = 0
+
+    if buffer.strip():
+        yield buffer.strip()